@@ -0,0 +1,157 @@
+import os
+import time
+import numpy as np
+
+import numpy_fk
+import reproject_anotation
+import virtual_camera
+
+# ====================================================================
+# カメラ配置の最適化 (Blender不要)
+# 候補のカメラ (仮想カメラ + 既存のカメラ) に全モーションをまとめて投影し、
+# 関節が見えている割合と三角測量の基線の良さが大きくなるように、貪欲法で N 台を選ぶ
+# 選んだカメラは edit_pose_ver16.py の CAMERA_PLACEMENT_FILE に指定すると、実行時にシーンに追加してレンダリングに使う
+# ====================================================================
+
+# --- 設定 ---
+# 評価に使うモーション (ワールド座標の3Dアノテーション)
+MOTION_FILES = reproject_anotation.INPUT_3d_FILES
+# 候補のカメラ (virtual_camera.py の設定で並べる)
+NUM_CANDIDATES = 200
+# 既存のカメラも候補に加える (edit_pose_ver16.py で書き出したキャリブレーション, なければ使わない)
+EXISTING_CALIBRATION_FILE = 'camera_calibration.npz'
+
+# 選ぶカメラの台数の上限
+NUM_SELECTED = 12
+# 1台追加したときのスコアの増加がこの値より小さくなったら、それ以上選ばない
+MIN_GAIN = 1e-3
+# 各関節がこの台数以上のカメラから見えていれば、見えている割合を満点とする
+MIN_VIEWS = 2
+# 三角測量の基線の良さ (2台のカメラの視線がなす角の sin の最大値) の重み
+BASELINE_WEIGHT = 0.5
+
+OUTPUT_CALIBRATION = 'camera_placement.npz'
+# --------------------
+
+# ====================================================================
+# 候補のカメラの評価
+# ====================================================================
+def load_motions(motion_files=MOTION_FILES):
+    """全モーションの3Dキーポイントを (N, 17, 3) につなげる (N は全フレーム数)"""
+    motions = [reproject_anotation.load_world_keypoints(f, reproject_anotation.INPUT_NUM_CAMERAS)
+               for f in motion_files if os.path.exists(f)]
+    return np.concatenate(motions)
+
+def load_candidates(keypoints, num_candidates=NUM_CANDIDATES, existing_file=EXISTING_CALIBRATION_FILE):
+    """仮想カメラと既存のカメラを (カメラ名, カメラ設定, matrix_world) のリストにまとめる"""
+    # 注視点は Root (左右の腰の中点) の平均 (アノテーションのキーポイント0は右足の tail)
+    target = numpy_fk.root_position(keypoints).mean(axis=0)
+    candidates = virtual_camera.build_virtual_cameras(target, num_candidates)
+    if existing_file and os.path.exists(existing_file):
+        existing = [camera for camera in reproject_anotation.load_cameras(existing_file, [], None)
+                    if camera[2].ndim == 2]
+        candidates = existing + candidates
+    return candidates
+
+def evaluate_candidates(keypoints, candidates):
+    """全フレーム・全関節について、候補ごとの可視性 (P, C) と視線の向き (P, C, 3) を求める (P = フレーム数 × 17)"""
+    keypoints_2d, _ = virtual_camera.annotate_virtual_cameras(keypoints, candidates)
+    visible = keypoints_2d[..., 2].astype(bool).transpose(0, 2, 1).reshape(-1, len(candidates))
+
+    camera_locations = np.stack([matrix_world[:3, 3] for _, _, matrix_world in candidates])
+    rays = numpy_fk.normalize(keypoints[:, :, np.newaxis] - camera_locations)
+    rays = rays.reshape(-1, len(candidates), 3).astype(np.float32)
+    return visible, rays
+
+# ====================================================================
+# 貪欲法による選択
+# ====================================================================
+def placement_score(view_count, baseline, min_views=MIN_VIEWS, baseline_weight=BASELINE_WEIGHT):
+    """見えている割合 (MIN_VIEWS 台で満点) + 基線の良さ (最大の sin) の平均"""
+    coverage = np.minimum(view_count, min_views) / min_views
+    return np.mean(coverage, axis=0) + baseline_weight * np.mean(baseline, axis=0)
+
+def select_cameras(visible, rays, num_selected=NUM_SELECTED, min_views=MIN_VIEWS, baseline_weight=BASELINE_WEIGHT,
+                   min_gain=MIN_GAIN):
+    """スコアの増加が最も大きいカメラを1台ずつ選ぶ (増加が min_gain より小さくなったら止める)"""
+    num_points, num_candidates = visible.shape
+    view_count = np.zeros(num_points)
+    baseline = np.zeros(num_points)
+    # pair_baseline[p, c] : 候補 c と選択済みのカメラの組で得られる基線の良さの最大値
+    pair_baseline = np.zeros((num_points, num_candidates), dtype=np.float32)
+
+    selected = []
+    scores = []
+    for _ in range(min(num_selected, num_candidates)):
+        # 全候補のスコアをまとめて計算する
+        candidate_scores = placement_score(
+            view_count[:, np.newaxis] + visible, np.maximum(baseline[:, np.newaxis], pair_baseline),
+            min_views, baseline_weight)
+        candidate_scores[selected] = -np.inf
+        best = int(np.argmax(candidate_scores))
+        if scores and candidate_scores[best] - scores[-1] < min_gain:
+            break
+        selected.append(best)
+        scores.append(candidate_scores[best])
+
+        # 選んだカメラとの組の基線を、全候補についてまとめて更新する
+        view_count += visible[:, best]
+        baseline = np.maximum(baseline, pair_baseline[:, best])
+        cosine = np.einsum('pck,pk->pc', rays, rays[:, best])
+        sine = np.sqrt(np.clip(1.0 - cosine ** 2, 0.0, 1.0)) * (visible & visible[:, best:best + 1])
+        pair_baseline = np.maximum(pair_baseline, sine)
+
+    return selected, np.array(scores)
+
+def evaluate_selection(visible, rays, selected, min_views=MIN_VIEWS, baseline_weight=BASELINE_WEIGHT):
+    """選んだカメラの組のスコア・見えている割合・基線の良さを求める"""
+    view_count = visible[:, selected].sum(axis=1)
+    cosine = np.einsum('pak,pbk->pab', rays[:, selected], rays[:, selected])
+    both = visible[:, selected, np.newaxis] & visible[:, np.newaxis, selected]
+    baseline = np.max(np.sqrt(np.clip(1.0 - cosine ** 2, 0.0, 1.0)) * both, axis=(1, 2))
+    return {
+        'score': float(placement_score(view_count, baseline, min_views, baseline_weight)),
+        'coverage': float(np.mean(np.minimum(view_count, min_views) / min_views)),
+        'visible': float(np.mean(view_count > 0)),
+        'baseline': float(np.mean(baseline)),
+    }
+
+def print_selection(label, result):
+    print(f"{label}: スコア {result['score']:.3f}, 1台以上から見える割合 {result['visible'] * 100:.1f} %, "
+          f"{MIN_VIEWS}台での割合 {result['coverage'] * 100:.1f} %, 基線 (sin) 平均 {result['baseline']:.3f}")
+
+def optimize_placement(motion_files=MOTION_FILES, num_selected=NUM_SELECTED, output_filepath=OUTPUT_CALIBRATION):
+    """全モーションで候補を評価して N 台を選び、キャリブレーションを書き出す"""
+    start = time.perf_counter()
+    keypoints = load_motions(motion_files)
+    candidates = load_candidates(keypoints)
+    visible, rays = evaluate_candidates(keypoints, candidates)
+    print(f"候補 {len(candidates)} 台 × {len(keypoints)} フレームを評価しました ({time.perf_counter() - start:.2f} 秒)")
+
+    # 既存のカメラの組と比較する
+    existing = [c for c, (name, _, _) in enumerate(candidates) if not name.startswith(virtual_camera.CAMERA_PREFIX)]
+    existing_result = evaluate_selection(visible, rays, existing) if existing else None
+    if existing_result:
+        print_selection(f"既存のカメラ {len(existing)} 台", existing_result)
+
+    selected, scores = select_cameras(visible, rays, num_selected)
+    for n in range(1, len(selected) + 1):
+        print(f"  {n:2d} 台目: {candidates[selected[n - 1]][0]} (スコア {scores[n - 1]:.3f})")
+    if len(selected) < min(num_selected, len(candidates)):
+        print(f"スコアの増加が {MIN_GAIN} より小さくなったため、{len(selected)} 台で止めました")
+    if existing_result:
+        # 既存のカメラの組と同じスコアになる最小の台数
+        matched = np.flatnonzero(scores >= existing_result['score'] - 1e-9)
+        if len(matched):
+            print(f"既存のカメラ {len(existing)} 台と同じスコアには {matched[0] + 1} 台で届きます")
+        else:
+            print(f"選んだ {len(selected)} 台では既存のカメラ {len(existing)} 台のスコアに届きません")
+    print_selection(f"選んだカメラ {len(selected)} 台", evaluate_selection(visible, rays, selected))
+
+    virtual_camera.save_virtual_calibration([candidates[c] for c in selected], output_filepath)
+    print(f"✅ 選んだカメラのキャリブレーションを書き出しました: {output_filepath} ({time.perf_counter() - start:.2f} 秒)")
+    return [candidates[c] for c in selected]
+
+# 実行
+if __name__ == "__main__":
+    optimize_placement()
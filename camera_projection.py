@@ -0,0 +1,175 @@
+import numpy as np
+
+# ====================================================================
+# カメラの射影行列とまとめての投影 (Blenderなしでも使える)
+# world_to_camera_view と同じ計算を 3x4 の射影行列にまとめ、
+# 全関節 × 全フレーム × 全カメラを1回の行列積で画像平面に投影する
+# ====================================================================
+
+# Blenderのカメラ座標系 (x右, y上, -z前) → OpenCVのカメラ座標系 (x右, y下, z前)
+BLENDER_TO_OPENCV = np.diag([1.0, -1.0, -1.0])
+
+# ====================================================================
+# 内部パラメータ
+# ====================================================================
+def compute_intrinsics(lens, sensor_width, sensor_height, sensor_fit, shift_x, shift_y,
+                       resolution_x, resolution_y, pixel_aspect_x=1.0, pixel_aspect_y=1.0):
+    """Blenderのカメラ設定から、左上原点のピクセル座標への内部パラメータ K (3x3) を求める"""
+    # 画素の縦横比
+    ycor = pixel_aspect_y / pixel_aspect_x
+
+    # センサーの大きさ (Blenderと同じく、AUTO は縦長の画像でも sensor_width を使う)
+    sensor_size = sensor_height if sensor_fit == 'VERTICAL' else sensor_width
+    # センサーを合わせる方向 (AUTO は画像の長い方)
+    if sensor_fit == 'AUTO':
+        sensor_fit = 'HORIZONTAL' if pixel_aspect_x * resolution_x >= pixel_aspect_y * resolution_y else 'VERTICAL'
+    viewfac = resolution_x if sensor_fit == 'HORIZONTAL' else ycor * resolution_y
+
+    fx = lens * viewfac / sensor_size
+    fy = fx / ycor
+    cx = 0.5 * resolution_x - shift_x * viewfac
+    cy = 0.5 * resolution_y + shift_y * viewfac / ycor
+    return np.array([
+        [fx, 0.0, cx],
+        [0.0, fy, cy],
+        [0.0, 0.0, 1.0],
+    ])
+
+def intrinsics_from_params(params, resolution_x=None, resolution_y=None):
+    """カメラ設定の辞書から K を求める (解像度を変えて計算し直すこともできる)"""
+    return compute_intrinsics(
+        params['lens'], params['sensor_width'], params['sensor_height'], params['sensor_fit'],
+        params['shift_x'], params['shift_y'],
+        params['resolution_x'] if resolution_x is None else resolution_x,
+        params['resolution_y'] if resolution_y is None else resolution_y,
+        params.get('pixel_aspect_x', 1.0), params.get('pixel_aspect_y', 1.0),
+    )
+
+def validate_intrinsics(tolerance=1e-6):
+    """Blenderで確認した焦点距離 [px] と比較する (50 mm, センサー 36 x 24 mm)"""
+    cases = [
+        # (sensor_fit, resolution_x, resolution_y, fx)
+        ('AUTO', 1920, 1080, 50 * 1920 / 36),
+        ('AUTO', 1000, 2000, 50 * 2000 / 36),   # 縦長: 長い方 (縦) に sensor_width を合わせる
+        ('HORIZONTAL', 1000, 2000, 50 * 1000 / 36),
+        ('VERTICAL', 1000, 2000, 50 * 2000 / 24),
+        ('VERTICAL', 1920, 1080, 50 * 1080 / 24),
+    ]
+    ok = True
+    for sensor_fit, resolution_x, resolution_y, expected in cases:
+        K = compute_intrinsics(50.0, 36.0, 24.0, sensor_fit, 0.0, 0.0, resolution_x, resolution_y)
+        if abs(K[0, 0] - expected) > tolerance or abs(K[1, 1] - expected) > tolerance:
+            print(f"❌ {sensor_fit} {resolution_x}x{resolution_y}: fx = {K[0, 0]:.1f}, fy = {K[1, 1]:.1f} (期待値 {expected:.1f})")
+            ok = False
+    if ok:
+        print(f"✅ {len(cases)} 通りのセンサーの合わせ方で、焦点距離が一致しました")
+    return ok
+
+# ====================================================================
+# 外部パラメータ
+# ====================================================================
+def world_to_camera_matrix(camera_matrix_world):
+    """カメラの matrix_world (4x4) から、ワールド → OpenCVカメラ座標の [R | t] (3x4) を求める"""
+    matrix_world = np.asarray(camera_matrix_world, dtype=np.float64)
+    # matrix_world.normalized() と同じく、スケールを除く
+    rotation = matrix_world[..., :3, :3] / np.linalg.norm(matrix_world[..., :3, :3], axis=-2, keepdims=True)
+    location = matrix_world[..., :3, 3]
+
+    # Blenderのカメラ座標: R^T (X - C), その後 OpenCV の向きに変換
+    rotation_inv = np.swapaxes(rotation, -1, -2)
+    R = BLENDER_TO_OPENCV @ rotation_inv
+    t = -(R @ location[..., np.newaxis])
+    return np.concatenate([R, t], axis=-1)
+
+def projection_matrix(K, extrinsic):
+    """P = K @ [R | t]"""
+    return np.asarray(K) @ np.asarray(extrinsic)
+
+# ====================================================================
+# 投影
+# ====================================================================
+def project_points(projection, points):
+    """ワールド座標の点を投影し、(u, v, depth) を返す
+
+    projection: (C, 3, 4) または (F, C, 3, 4)
+    points:     (F, J, 3)
+    戻り値:     (F, C, J, 3)  u, v は左上原点のピクセル座標, depth はカメラ前方の距離
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if points.ndim == 2:
+        points = points[np.newaxis]
+    homogeneous = np.concatenate([points, np.ones(points.shape[:-1] + (1,))], axis=-1)
+
+    projection = np.asarray(projection, dtype=np.float64)
+    if projection.ndim == 2:
+        projection = projection[np.newaxis]
+    if projection.ndim == 3:
+        projected = np.einsum('cij,fnj->fcni', projection, homogeneous)
+    else:
+        projected = np.einsum('fcij,fnj->fcni', projection, homogeneous)
+
+    depth = projected[..., 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        uv = projected[..., :2] / depth[..., np.newaxis]
+    return np.concatenate([uv, depth[..., np.newaxis]], axis=-1)
+
+def in_frame(projected, resolution_x, resolution_y):
+    """画角内 (world_to_camera_view の 0~1 の範囲内で、カメラの前方) かどうか"""
+    u, v, depth = projected[..., 0], projected[..., 1], projected[..., 2]
+    return (0 <= u) & (u <= resolution_x) & (0 <= v) & (v <= resolution_y) & (depth > 0)
+
+# ====================================================================
+# キャリブレーションファイル (全カメラの内部・外部パラメータ)
+# ====================================================================
+# カメラ設定のうち、解像度を変えて K を計算し直すために保存する値
+CAMERA_PARAM_KEYS = ['lens', 'sensor_width', 'sensor_height', 'shift_x', 'shift_y',
+                     'resolution_x', 'resolution_y', 'pixel_aspect_x', 'pixel_aspect_y']
+
+def save_calibration(filepath, camera_names, params_list, matrix_worlds, frames=None):
+    """全カメラの K, R, t (BlenderとOpenCVの両方) と解像度を1つのnpzに書き出す
+
+    Blender: R_blender, t_blender はカメラ → ワールド (matrix_world, カメラは -Z 方向を向き Y が上)
+    OpenCV:  R_opencv, t_opencv はワールド → カメラ (カメラは +Z 方向を向き Y が下)
+    歪みなし (distortion はすべて0) のピンホールモデル
+    動くカメラの場合は matrix_worlds を (F, C, 4, 4) で渡し、R, t, P は (F, C, ...) で保存する
+    """
+    matrix_worlds = np.asarray(matrix_worlds, dtype=np.float64)
+    K = np.stack([intrinsics_from_params(params) for params in params_list])
+    extrinsic = world_to_camera_matrix(matrix_worlds)
+
+    rotation = matrix_worlds[..., :3, :3] / np.linalg.norm(matrix_worlds[..., :3, :3], axis=-2, keepdims=True)
+    calibration = {
+        'camera_names': np.array(camera_names),
+        'K': K,
+        'R_blender': rotation,
+        't_blender': matrix_worlds[..., :3, 3],
+        'R_opencv': extrinsic[..., :3],
+        't_opencv': extrinsic[..., 3],
+        'P': K @ extrinsic,
+        'distortion': np.zeros((len(camera_names), 5)),
+        'resolution': np.array([[params['resolution_x'], params['resolution_y']] for params in params_list]),
+        'sensor_fit': np.array([params['sensor_fit'] for params in params_list]),
+    }
+    for key in CAMERA_PARAM_KEYS:
+        calibration[key] = np.array([params[key] for params in params_list], dtype=np.float64)
+    if frames is not None:
+        calibration['frames'] = np.asarray(frames)
+
+    np.savez_compressed(filepath, **calibration)
+    return calibration
+
+def load_calibration(filepath):
+    """save_calibration で書き出したnpzを読み込み、カメラ設定の辞書のリストも作る"""
+    with np.load(filepath, allow_pickle=False) as data:
+        calibration = {key: data[key] for key in data.files}
+
+    calibration['camera_names'] = [str(name) for name in calibration['camera_names']]
+    calibration['params'] = [
+        dict({key: float(calibration[key][c]) for key in CAMERA_PARAM_KEYS}, sensor_fit=str(calibration['sensor_fit'][c]))
+        for c in range(len(calibration['camera_names']))
+    ]
+    return calibration
+
+# 実行
+if __name__ == "__main__":
+    validate_intrinsics()
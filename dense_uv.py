@@ -0,0 +1,127 @@
+import os
+import time
+import numpy as np
+
+import numpy_fk
+import numpy_lbs
+import camera_projection
+import rasterizer
+import reproject_anotation
+
+# ====================================================================
+# 密な対応 (DensePose と同じ形式の (部位, u, v)) のアノテーション (Blender不要)
+# numpy_lbs で変形したメッシュを rasterizer.py でラスタライズし、各画素の三角形と重心座標から
+# Human_UV.png のUV座標と部位 (三角形の頂点のウェイトが最も大きいボーン) を求める。レンダリングは不要
+# ====================================================================
+
+# --- 設定 ---
+# edit_pose_ver16.py の export_skinning で書き出したメッシュ (triangle_uvs を含む)
+SKINNING_FILE = numpy_lbs.SKINNING_FILE
+CALIBRATION_FILE = 'camera_calibration.npz'
+# 出力の解像度 (None ならキャリブレーションの解像度)
+RESOLUTION_X = None
+RESOLUTION_Y = None
+# 書き出すフレーム (None なら全フレーム)
+FRAMES = None
+
+# フレームごとの書き出し先 (OUTPUT_DIR/dense_uv_0001.npz)
+OUTPUT_DIR = './dense_uv'
+# --------------------
+
+# 部位の番号 (0 は背景, 1 以降はボーンの番号 + 1)
+BACKGROUND_PART = 0
+UV_SCALE = np.iinfo(np.uint16).max
+
+# ====================================================================
+# 三角形ごとの部位
+# ====================================================================
+def triangle_parts(skinning):
+    """三角形の3頂点のウェイトをボーンごとに合計し、最も大きいボーンを部位とする (T,)"""
+    triangles = skinning['triangles']
+    num_bones = len(skinning['bone_names'])
+    indices = skinning['bone_indices'][triangles].reshape(len(triangles), -1)
+    weights = skinning['bone_weights'][triangles].reshape(len(triangles), -1)
+
+    totals = np.zeros((len(triangles), num_bones))
+    np.add.at(totals, (np.repeat(np.arange(len(triangles)), indices.shape[1]), indices.ravel()), weights.ravel())
+    parts = np.argmax(totals, axis=1) + 1
+    parts[totals.max(axis=1) <= 0] = BACKGROUND_PART
+    return parts.astype(np.uint8)
+
+# ====================================================================
+# 画素ごとの (部位, u, v)
+# ====================================================================
+def dense_correspondence(face_buffer, vertices, triangles, triangle_uvs, parts, projection):
+    """三角形の番号の画像 (H, W) から、部位 (H, W, uint8) と u, v (H, W, uint16) を求める
+
+    重心座標は、画面上の重心座標を各頂点の深度で割って正規化する (透視補正)
+    """
+    height, width = face_buffer.shape
+    part_image = np.zeros((height, width), dtype=np.uint8)
+    uv_image = np.zeros((height, width, 2), dtype=np.uint16)
+
+    y, x = np.nonzero(face_buffer >= 0)
+    faces = face_buffer[y, x]
+    projected = camera_projection.project_points(projection, vertices)[0, 0]
+    weights = rasterizer.barycentric(projected[:, :2], triangles, faces, x, y)
+    weights = weights / projected[triangles[faces], 2]
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    uv = np.einsum('pk,pkc->pc', weights, triangle_uvs[faces])
+    part_image[y, x] = parts[faces]
+    uv_image[y, x] = np.round(np.clip(uv, 0.0, 1.0) * UV_SCALE).astype(np.uint16)
+    return part_image, uv_image
+
+def render_dense_uv(vertices, skinning, parts, projections, resolutions, frame=0):
+    """1フレーム分を全カメラでラスタライズし、部位 (C, H, W) と UV (C, H, W, 2) を返す
+
+    projections が (F, C, 3, 4) の場合は frame 番目のフレームの射影行列を使う
+    """
+    part_images, uv_images = [], []
+    projections = rasterizer.frame_projections(projections, frame)
+    for projection, (resolution_x, resolution_y) in zip(projections, resolutions):
+        _, face_buffer = rasterizer.rasterize(vertices, skinning['triangles'], projection, resolution_x, resolution_y)
+        part_image, uv_image = dense_correspondence(face_buffer, vertices, skinning['triangles'],
+                                                    skinning['triangle_uvs'], parts, projection)
+        part_images.append(part_image)
+        uv_images.append(uv_image)
+    return np.stack(part_images), np.stack(uv_images)
+
+def generate_dense_uv(target_dir=numpy_fk.TAGET_DIR, skinning_filepath=SKINNING_FILE,
+                      calibration_file=CALIBRATION_FILE, output_dir=OUTPUT_DIR, frames=FRAMES):
+    """入力キーポイントからメッシュを変形し、フレームごとに全カメラの (部位, u, v) を書き出す"""
+    skinning = numpy_lbs.load_skinning(skinning_filepath)
+    if 'triangle_uvs' not in skinning:
+        print(f"❌ '{skinning_filepath}' にUV座標 (triangle_uvs) がありません。export_skinning で書き出し直してください。")
+        return
+    parts = triangle_parts(skinning)
+
+    rest = numpy_fk.load_armature_rest(numpy_fk.ARMATURE_REST_FILE)
+    files, keypoints = numpy_fk.load_keypoints_sequence(target_dir)
+    keypoints = keypoints * numpy_fk.SCALE_FACTOR
+    if numpy_fk.USE_RETARGET:
+        rest = numpy_fk.retarget_armature_rest(rest, numpy_fk.measure_bone_lengths(keypoints))
+    frames = np.arange(len(files)) if frames is None else np.asarray(frames)
+    quaternions = numpy_fk.solve_rotations(rest, keypoints[frames])
+
+    cameras = reproject_anotation.load_cameras(calibration_file, [], None)
+    projections, resolutions = reproject_anotation.build_projection(cameras, RESOLUTION_X, RESOLUTION_Y)
+    os.makedirs(output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    vertices = numpy_lbs.deform_sequence(rest, quaternions, skinning)
+    for f, frame in enumerate(frames):
+        part_images, uv_images = render_dense_uv(vertices[f].astype(np.float64), skinning, parts, projections,
+                                                 resolutions, frame)
+        output_filepath = os.path.join(output_dir, f"dense_uv_{frame + 1:04d}.npz")
+        np.savez_compressed(output_filepath, part=part_images, u=uv_images[..., 0], v=uv_images[..., 1],
+                            camera_names=np.array([name for name, _, _ in cameras]),
+                            part_names=np.array(['background'] + skinning['bone_names']))
+
+    elapsed = time.perf_counter() - start
+    print(f"✅ {len(frames)} フレーム × {len(cameras)} カメラの (部位, u, v) を書き出しました "
+          f"({elapsed:.2f} 秒): {output_dir}")
+
+# 実行
+if __name__ == "__main__":
+    generate_dense_uv()
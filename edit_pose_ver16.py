@@ -2,88 +2,33 @@ import bpy
 import math
 import os
 import glob
+import sys
+import time
+import tempfile
 import numpy as np
 from mathutils import Vector, Quaternion, Matrix
+from mathutils.bvhtree import BVHTree
 from bpy_extras.object_utils import world_to_camera_view
 
-# 【重要】キーポイントインデックスとボーン名の対応付け (省略せず記述)
-BONE_INDEX_MAP = {
-    'spine.001': 7,
-    'spine.002': 8,
-    'head.001': 9,
-    'head.002': 10,
-    'waist.001.l': 4,
-    'waist.001.r': 1,
-    'shoulder.001.l': 11,
-    'arm.001.l': 12,
-    'arm.002.l': 13,
-    'shoulder.001.r': 14,
-    'arm.001.r': 15,
-    'arm.002.r': 16,
-    'leg.001.l': 5,
-    'leg.002.l': 6,
-    'feet.001.l': 0,
-    'leg.001.r': 2,
-    'leg.002.r': 3,
-    'feet.001.r': 0,
-}
-
-BONE_INDEX_MAP_REVERSE = {
-    7: 'spine.001',
-    8: 'spine.002',
-    9: 'head.001',
-    10: 'head.002',
-    4: 'waist.001.l',
-    1: 'waist.001.r',
-    11: 'shoulder.001.l',
-    12: 'arm.001.l',
-    13: 'arm.002.l',
-    14: 'shoulder.001.r',
-    15: 'arm.001.r',
-    16: 'arm.002.r',
-    5: 'leg.001.l',
-    6: 'leg.002.l',
-    2: 'leg.001.r',
-    3: 'leg.002.r'
-}
-
-PAIR_LIST = {
-    7: 0,
-    8: 7,
-    11: 8,
-    12: 11,
-    13: 12,
-    9: 8,
-    10: 9,
-    14: 8,
-    15: 14,
-    16: 15,
-    4: 0,
-    5: 4,
-    6: 5,
-    1: 0,
-    2: 1,
-    3: 2
-}
-
+# 同じフォルダにあるNumPyのモジュール (numpy_fk.py など) を読み込めるようにする
+SCRIPT_DIR = os.path.dirname(bpy.data.filepath) if bpy.data.filepath else os.getcwd()
+if SCRIPT_DIR not in sys.path:
+    sys.path.append(SCRIPT_DIR)
+
+import numpy_fk
+import ik_refine
+import pose_metrics
+import camera_projection
+import occlusion_numpy
+import virtual_camera
+import numpy_lbs
+
+# 【重要】キーポイントインデックスとボーン名の対応付け (numpy_fk.py に1か所だけ記述し、ここでは参照する)
+BONE_INDEX_MAP = numpy_fk.BONE_INDEX_MAP
+BONE_INDEX_MAP_REVERSE = numpy_fk.BONE_INDEX_MAP_REVERSE
+PAIR_LIST = numpy_fk.PAIR_LIST
 # 回転の計算に用いる, 子ボーンのtail：親ボーンのtail
-PARENT_LIST = {
-    8: 7, #
-    9: 8,
-    10: 9,
-    11: 8, #
-    12: 11,
-    13: 12,
-    14: 8,
-    15: 14,
-    16: 15,
-    1: 7, 
-    2: 1,
-    3: 2,
-    4: 7, #
-    5: 4,
-    6: 5
-}
+PARENT_LIST = numpy_fk.PARENT_LIST
 
 # --- 設定 ---
 # 4台のカメラの名称リスト
@@ -102,13 +47,87 @@ EXTENSION = 'npz'
 # アノテーションデータの書き出し先ファイル
 OUTPUT_2d = 'test_2d_anotation.npz'
 OUTPUT_3d = 'test_3d_anotation.npz'
+# 3Dアノテーションの座標系 ('world': ワールド座標 (S), 'root': Rootボーン基準 (S_root),
+# 'camera': カメラ座標 (S_camera, OpenCVの向き: x右, y下, z前))
+OUTPUT_3D_FRAMES = ['world', 'root', 'camera']
+OUTPUT_3D_KEYS = {'world': 'S', 'root': 'S_root', 'camera': 'S_camera'}
+
+# 全カメラのキャリブレーション (アノテーションと同じフォルダに書き出す)
+CALIBRATION_FILE = os.path.join(os.path.dirname(OUTPUT_2d), 'camera_calibration.npz')
+# virtual_camera.py の仮想カメラをシーンに追加するときのコレクション名
+VIRTUAL_CAMERA_COLLECTION = 'VirtualCameras'
+# camera_placement.py で選んだカメラのキャリブレーション
+# (None でなければ、実行時にシーンにカメラを追加し、CAMERA_NAMES の代わりにレンダリング・アノテーションに使う)
+CAMERA_PLACEMENT_FILE = None
 
 ARMATURE_NAME = "Armature"
 
+# ポーズのリセットと適用を1回の書き込みで行う (False なら従来の2段階処理)
+USE_FUSED_POSE = True
+# リセットの回転の合成 (USE_CLEAR_CORRECTION), 入力キーポイントのスケール (SCALE_FACTOR),
+# ボーンの長さの合わせ込み (USE_RETARGET) は、Blenderなしの処理と食い違わないように numpy_fk.py で設定する
+USE_CLEAR_CORRECTION = numpy_fk.USE_CLEAR_CORRECTION
+SCALE_FACTOR = numpy_fk.SCALE_FACTOR
+USE_RETARGET = numpy_fk.USE_RETARGET
+
+# 反復IKでポーズを微調整する (入力キーポイントとの3D誤差を小さくする)
+USE_IK_REFINEMENT = False
+IK_MAX_ITERATIONS = 10
+
+# 全フレームの処理後に、入力キーポイントとの誤差のレポートを書き出す (pose_metrics.py)
+USE_POSE_METRICS = True
+
+# 人物のメッシュの全頂点を投影して、2Dアノテーションに bbox (x_min, y_min, x_max, y_max) と
+# bbox_truncated (画像の端で切れていれば1) を追記する
+USE_BBOX = True
+# バウンディングボックスに使うメッシュ (None ならアーマチュアの子とアーマチュアモディファイアのメッシュ)
+BBOX_MESH_NAMES = None
+
+# 可視性の判定方法 ('raycast': シーン全体に scene.ray_cast (従来の方法),
+# 'bvh': 遮蔽物のメッシュだけで BVHTree を作り、全カメラ × 全関節をまとめて判定する,
+# 'numpy': 遮蔽物のメッシュの三角形を occlusion_numpy.py でまとめて判定する,
+# 'depth': 各カメラのレンダリングで深度 (Z) パスも出力し、関節の深度と比較する,
+# 'fraction': 'bvh' と同じ BVHTree で関節のまわりの円盤に複数のレイを飛ばし、見えている割合も求める)
+VISIBILITY_MODE = 'raycast'
+# 'bvh' で遮蔽物とするメッシュのコレクション (None なら人物のメッシュのみ)
+OCCLUDER_COLLECTION = None
+# 関節の手前この距離までを遮蔽の判定に使う [m] (check_visibility と同じ)
+VISIBILITY_END_OFFSET = 0.1
+# 'depth' で、関節の深度が深度バッファよりこの値以上奥なら遮蔽とする [m]
+DEPTH_TOLERANCE = 0.1
+# 深度パスの値 ('planar': カメラの前方向の距離, 'radial': カメラからの直線距離)
+DEPTH_PASS_TYPE = 'planar'
+# 'fraction' で関節のまわりに飛ばすレイの本数 (中心を含む) と円盤の半径 [m]
+# 見えている割合は 0~255 (uint8) で2Dアノテーションに visibility_fraction として追記する
+STENCIL_RAYS = 9
+STENCIL_RADIUS = 0.03
+# 'bvh' で前フレームの可視性を再利用する (レイの近くの部位が動いたレイと、当たった三角形から外れたレイだけ判定し直す)
+USE_VISIBILITY_CACHE = False
+# 遮蔽の種類 (occlusion_type: 0 見える, 1 画角外, 2 自己遮蔽, 3 シーンの物体による遮蔽) と、自己遮蔽なら
+# 遮蔽しているボーンのキーポイント番号 (occluder_part, それ以外は -1) を2Dアノテーションに追記する
+# ('raycast', 'bvh' (キャッシュなし), 'fraction' のみ, 判定に使ったレイの当たりから求めるので追加のレイは不要)
+USE_OCCLUSION_LABELS = True
+# occlusion_numpy.py との比較用に書き出すファイル (export_occlusion_scene)
+OCCLUSION_SCENE_FILE = 'occlusion_scene.npz'
+
+# Blenderなしで FK を計算するためのレスト情報 (numpy_fk.py で使用)
+ARMATURE_REST_FILE = 'armature_rest.npz'
+# Blenderなしでメッシュを変形するための頂点・三角形・ウェイト (numpy_lbs.py で使用)
+SKINNING_FILE = 'character_skinning.npz'
+# 1頂点あたりのボーンの数 (ウェイトの大きい順に残し、合計が1になるように正規化する)
+SKINNING_MAX_INFLUENCES = 4
+
 # レンダリング画像の設定
 IMAGE_FORMAT = 'PNG'
 RESOLUTION_X = 1000
 RESOLUTION_Y = 1000
+# 1回のレンダリングで、画像・深度・オブジェクトの番号 (人物のマスク) のパスを
+# カメラ × フレームごとに1つのマルチレイヤー EXR に書き出す (exr_reader.py で配列に分ける)
+USE_EXR_RENDER = False
+# EXR の圧縮 (exr_reader.py は 'NONE', 'ZIPS', 'ZIP' に対応)
+EXR_CODEC = 'ZIP'
+# 人物のメッシュに設定するオブジェクトの番号 (IndexOB パスでこの値の画素が人物のマスクになる, Cycles のみ)
+PERSON_PASS_INDEX = 1
 # --------------------
 
 # ====================================================================
@@ -117,11 +136,15 @@ RESOLUTION_Y = 1000
 def setup_render_settings(scene, output_dir, format):
     """シーンのレンダリング基本設定を行う"""
     scene.render.image_settings.file_format = format
+    if format == 'OPEN_EXR_MULTILAYER':
+        # 深度を丸めないように32bit浮動小数点で保存する
+        scene.render.image_settings.color_depth = '32'
+        scene.render.image_settings.exr_codec = EXR_CODEC
     scene.render.resolution_x = RESOLUTION_X
     scene.render.resolution_y = RESOLUTION_Y
     scene.render.filepath = output_dir # 出力パスの基本設定
 
-def render_from_multiple_cameras(ARMATURE_NAME, image_number):
+def render_from_multiple_cameras(ARMATURE_NAME, image_number, snapshot=None):
     keypoint_2d = {}
     keypoint_3d = {}
     """複数のカメラから順番にレンダリングを実行するメイン関数"""
@@ -129,9 +152,20 @@ def render_from_multiple_cameras(ARMATURE_NAME, image_number):
     formatted_number = f"{image_number:04d}"
     
     # 1. 基本設定の適用
-    setup_render_settings(scene, OUTPUT_DIR, IMAGE_FORMAT)
+    setup_render_settings(scene, OUTPUT_DIR, render_image_format())
+
+    # 2. 深度パスで可視性を求める場合は、先に全カメラをレンダリングして深度を読み出す
+    if VISIBILITY_MODE == 'depth':
+        render_depth_buffers(scene, CAMERA_NAMES, formatted_number)
+
+    # 3. 全カメラの2D・3D・可視性を1回でまとめて求める
+    if snapshot is None:
+        snapshot = ArmatureSnapshot(bpy.data.objects[ARMATURE_NAME])
+    keypoints, labels = extract_keypoints(scene, CAMERA_NAMES, ARMATURE_NAME, snapshot)
+    outputs_3d = compute_3d_outputs(scene, keypoints, snapshot)
+    bboxes = compute_person_bboxes(scene, list(keypoints.keys()), ARMATURE_NAME) if USE_BBOX else {}
     
-    # 2. カメラリストを反復処理
+    # 4. カメラリストを反復処理
     for i, camera_name in enumerate(CAMERA_NAMES):
         camera = bpy.data.objects.get(camera_name)
         
@@ -141,10 +175,16 @@ def render_from_multiple_cameras(ARMATURE_NAME, image_number):
             # **現在のカメラをアクティブなシーンカメラとして設定**
             scene.camera = camera
             
-            keypoint_2d = get_keypoint2d(scene, camera, ARMATURE_NAME)
-            arrange_keypoint(keypoint_2d, OUTPUT_2d, 'keypoints_2d')
-            keypoint_3d = get_keypoint3d(scene, camera, ARMATURE_NAME)
-            arrange_keypoint(keypoint_3d, OUTPUT_3d, 'S')
+            keypoint_2d, keypoint_3d = keypoints[camera_name]
+            extra_2d = dict(bboxes.get(camera_name, {}))
+            # 見えている割合・遮蔽の種類・遮蔽しているボーン
+            extra_2d.update(labels.get(camera_name, {}))
+            if extra_2d:
+                # バウンディングボックスなども同じ行に追記する (1回の書き込み)
+                generate_npz_arrays(OUTPUT_2d, dict(keypoints_2d=keypoint_to_array(keypoint_2d), **extra_2d))
+            else:
+                arrange_keypoint(keypoint_2d, OUTPUT_2d, 'keypoints_2d')
+            generate_npz_arrays(OUTPUT_3d, outputs_3d[camera_name])
 
             print("keypoint_2d")
             #print(keypoint_2d)
@@ -157,55 +197,565 @@ def render_from_multiple_cameras(ARMATURE_NAME, image_number):
             
             # **レンダリングの実行**
             # write_still=True: レンダリングが完了した後、ファイルに画像を保存します。
+            # ('depth' の場合は可視性の判定と同時にレンダリング済み)
             # bpy.ops.render.render(write_still=True)
+            if USE_EXR_RENDER and VISIBILITY_MODE != 'depth':
+                # 画像と全パスを1つの EXR に書き出す (1カメラにつき1回のレンダリング)
+                bpy.ops.render.render(write_still=True)
             
             print(f"レンダリング完了。出力: {scene.render.filepath}")
         else:
             print(f"警告: カメラ '{camera_name}' が見つからないか、カメラオブジェクトではありません。スキップします。")
 
-def get_keypoint2d(scene, camera, armature_name):
-    keypoint_2d = {}
+class ArmatureSnapshot:
+    """1フレーム分のポーズボーンの head / tail / 行列を NumPy 配列で保持する
 
-    """ボーンのワールド座標を画像平面のピクセル座標に変換して表示する"""
+    foreach_get で全ボーンを1回で読み出し、matrix_world もまとめて適用する。
+    同じフレームの処理 (キーポイントの抽出, 可視性, 評価, バウンディングボックス) はこれを共有する
+    """
+    def __init__(self, armature):
+        pose_bones = armature.pose.bones
+        num_bones = len(pose_bones)
+        self.armature_name = armature.name
+        self.bone_names = [pbone.name for pbone in pose_bones]
+
+        heads = np.empty(num_bones * 3, dtype=np.float32)
+        tails = np.empty(num_bones * 3, dtype=np.float32)
+        matrices = np.empty(num_bones * 16, dtype=np.float32)
+        pose_bones.foreach_get('head', heads)
+        pose_bones.foreach_get('tail', tails)
+        pose_bones.foreach_get('matrix', matrices)
+
+        self.matrix_world = np.array(armature.matrix_world, dtype=np.float64)
+        # foreach_get の行列は列優先で並んでいるので転置する
+        self.matrices = matrices.reshape(num_bones, 4, 4).transpose(0, 2, 1).astype(np.float64)
+        self.heads = self.to_world(heads.reshape(num_bones, 3))
+        self.tails = self.to_world(tails.reshape(num_bones, 3))
+        self.matrices_world = self.matrix_world @ self.matrices
+
+    def to_world(self, points):
+        """アーマチュア空間の点 (N, 3) をまとめてワールド座標に変換する"""
+        return points.astype(np.float64) @ self.matrix_world[:3, :3].T + self.matrix_world[:3, 3]
+
+    def keypoints_world(self):
+        """get_keypoint3d と同じ規則で並べた17点のワールド座標 (17, 3)"""
+        keypoints = np.zeros((numpy_fk.NUM_KEYPOINTS, 3))
+        for i, name in enumerate(self.bone_names):
+            keypoints[BONE_INDEX_MAP[name]] = self.tails[i]
+            if name == "spine.001":
+                keypoints[0] = self.heads[i]
+        return keypoints
+
+def extract_keypoints(scene, camera_names, armature_name, snapshot=None):
+    """ボーン座標の取得・投影・可視性判定を1回ずつ行い、カメラごとの2Dと3Dのキーポイントを返す
+
+    2つ目の戻り値は、2Dアノテーションに追記する値 (カメラ名 : {'visibility_fraction', 'occlusion_type',
+    'occluder_part'} のうち、VISIBILITY_MODE と USE_OCCLUSION_LABELS で求めたもの。いずれも (17,))
+    """
     obj = bpy.data.objects.get(armature_name)
     if not obj or obj.type != 'ARMATURE':
         print(f"❌ アーマチュア '{armature_name}' が見つかりません。")
-        return
+        return {}, {}
+
+    cameras = [bpy.data.objects.get(name) for name in camera_names]
+    cameras = [camera for camera in cameras if camera and camera.type == 'CAMERA']
+    if not cameras:
+        return {}, {}
+
+    # 1. 全ボーンのワールド座標 (フレームごとに1回だけ読み出したものを使う)
+    if snapshot is None:
+        snapshot = ArmatureSnapshot(obj)
+    pose_bones = [obj.pose.bones[name] for name in snapshot.bone_names]
+    heads_world = snapshot.heads
+    tails_world = snapshot.tails
+    num_bones = len(pose_bones)
+
+    # 2. 全カメラにまとめて投影する (C, 2B, 3)
+    projection = get_projection_matrices(scene, [camera.name for camera in cameras])
+    points = np.concatenate([heads_world, tails_world])
+    projected = camera_projection.project_points(projection, points)[0]
+    in_view = camera_projection.in_frame(projected, scene.render.resolution_x, scene.render.resolution_y)
+
+    # 3. 画角内の tail だけ遮蔽を判定する (1本のレイは1回だけ)
+    visibility_matrix, details = compute_visibility(scene, cameras, tails_world, in_view[:, num_bones:], obj, snapshot)
+    # 見えている割合・遮蔽の種類・遮蔽しているボーンも、キーポイントと同じ並び (17点) にしておく
+    # Root (spine.001 の head) は遮蔽を判定しないので、画角内なら見えているとする
+    root_bone = snapshot.bone_names.index("spine.001") if "spine.001" in snapshot.bone_names else None
+    root_in_view = in_view[:, root_bone] if root_bone is not None else np.zeros(len(cameras), dtype=bool)
+    labels = {camera.name: {} for camera in cameras}
+    if 'fraction' in details:
+        for c, camera in enumerate(cameras):
+            labels[camera.name]['visibility_fraction'] = arrange_by_keypoint(
+                details['fraction'][c], pose_bones, 255 if root_in_view[c] else 0, 0)
+    if 'hits' in details:
+        occlusion_type, occluder = occlusion_labels(in_view[:, num_bones:], details['hits'],
+                                                    {mesh.name for mesh in find_character_meshes(obj)}, snapshot)
+        # 遮蔽しているボーンの番号は、そのボーンの tail のキーポイント番号にする (足は 17, 18)
+        bone_keypoints = np.array([OCCLUDER_PART_MAP.get(name, -1) for name in snapshot.bone_names] + [-1], dtype=np.int8)
+        for c, camera in enumerate(cameras):
+            root_type = OCCLUSION_VISIBLE if root_in_view[c] else OCCLUSION_OUT_OF_FRAME
+            labels[camera.name].update({
+                'occlusion_type': arrange_by_keypoint(occlusion_type[c], pose_bones, root_type, OCCLUSION_OUT_OF_FRAME),
+                'occluder_part': arrange_by_keypoint(bone_keypoints[occluder[c]], pose_bones, -1, -1),
+            })
+    keypoints = {}
+    for c, camera in enumerate(cameras):
+        keypoint_2d = {}
+        keypoint_3d = {}
+        for i, pbone in enumerate(pose_bones):
+            visibility = int(visibility_matrix[c, i])
+
+            head_px = (projected[c, i, 0], projected[c, i, 1])
+            tail_px = (projected[c, num_bones + i, 0], projected[c, num_bones + i, 1])
+            tail_world = tails_world[i]
+
+            # get_keypoint3d と同じ並びで格納する (2Dも同じ並び)
+            keypoint_2d[BONE_INDEX_MAP[pbone.name]] = (tail_px[0], tail_px[1], visibility)
+            keypoint_3d[BONE_INDEX_MAP[pbone.name]] = (tail_world[0], tail_world[1], tail_world[2], visibility)
+            if pbone.name == "spine.001":
+                keypoint_2d[0] = head_px
+                keypoint_3d[0] = tuple(heads_world[i])
+
+        keypoints[camera.name] = (keypoint_2d, keypoint_3d)
+    return keypoints, labels
+
+def arrange_by_keypoint(values, pose_bones, root_value, fill):
+    """ボーンごとの値 (B,) を、2Dアノテーションのキーポイントと同じ並び (17,) にする
+
+    keypoint_2d と同じ順番で上書きし、0番 (spine.001 の head) には root_value を入れる
+    """
+    arranged = np.full(numpy_fk.NUM_KEYPOINTS, fill, dtype=values.dtype)
+    for i, pbone in enumerate(pose_bones):
+        arranged[BONE_INDEX_MAP[pbone.name]] = values[i]
+        if pbone.name == "spine.001":
+            arranged[0] = root_value
+    return arranged
 
-    matrix_world = obj.matrix_world
-    #print(f"\n[Camera: {camera.name}] Bone 2D Coordinates (Pixel):")
+def compute_visibility(scene, cameras, points_world, in_view, armature, snapshot):
+    """全カメラ × 全点の可視性 (C, N) を VISIBILITY_MODE の方法で求める (画角外は0)
 
-    for pbone in obj.pose.bones:
-        # 1. ワールド座標を計算
-        head_world = matrix_world @ pbone.head
-        tail_world = matrix_world @ pbone.tail
+    可視性と一緒に求めた値も辞書で返す ('fraction': 見えている割合 (C, N),
+    'hits': 遮ったレイの当たり {(カメラ, 点): (位置, オブジェクト名)})
+    """
+    details = {}
+    if VISIBILITY_MODE == 'bvh' and USE_VISIBILITY_CACHE:
+        occluders = get_occluder_meshes(armature)
+        vertices, triangles = get_evaluated_geometry(occluders)
+        visibility = VISIBILITY_CACHE.query(lambda: OcclusionEngine(occluders), camera_locations(cameras),
+                                            points_world, in_view, vertices, triangles, snapshot.heads, snapshot.tails)
+        return visibility, details
+    # 遮ったレイの当たりも残す ('numpy', 'depth' はレイを使わない)
+    hits = {} if USE_OCCLUSION_LABELS and VISIBILITY_MODE not in ('numpy', 'depth') else None
+    if hits is not None:
+        details['hits'] = hits
+    if VISIBILITY_MODE == 'bvh':
+        engine = OcclusionEngine(get_occluder_meshes(armature))
+        return engine.query(camera_locations(cameras), points_world, in_view, hits=hits), details
+    if VISIBILITY_MODE == 'numpy':
+        vertices, triangles = get_evaluated_geometry(get_occluder_meshes(armature))
+        visibility = occlusion_numpy.segment_occlusion(vertices, triangles, camera_locations(cameras), points_world,
+                                                       in_view, VISIBILITY_END_OFFSET)
+        return visibility, details
+    if VISIBILITY_MODE == 'depth':
+        return depth_visibility(scene, cameras, points_world, in_view), details
+    if VISIBILITY_MODE == 'fraction':
+        engine = OcclusionEngine(get_occluder_meshes(armature))
+        visibility, details['fraction'] = engine.query_fraction(camera_locations(cameras), points_world, in_view,
+                                                                hits=hits)
+        return visibility, details
+    return raycast_visibility(scene, cameras, points_world, in_view, hits), details
+
+def raycast_visibility(scene, cameras, points_world, in_view, hits=None):
+    """check_visibility (シーン全体への scene.ray_cast) で1本ずつ判定する"""
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    visibility = np.zeros(in_view.shape, dtype=np.uint8)
+    for c, i in zip(*np.nonzero(in_view)):
+        hit = visibility_ray_hit(scene, cameras[c], Vector(points_world[i]), depsgraph)
+        visibility[c, i] = 0 if hit else 1
+        if hit and hits is not None:
+            hits[c, i] = (np.array(hit[0]), hit[2].name)
+    return visibility
+
+def occlusion_labels(in_view, hits, self_names, snapshot):
+    """遮ったレイの当たりから、遮蔽の種類 (C, N) と遮蔽しているボーンの番号 (C, N, 自己遮蔽以外は -1) を求める
+
+    人物のメッシュ (self_names) に当たったら自己遮蔽とし、当たった位置に最も近いボーンを遮蔽しているボーンとする
+    """
+    occlusion_type = np.where(in_view, OCCLUSION_VISIBLE, OCCLUSION_OUT_OF_FRAME).astype(np.uint8)
+    occluder = np.full(in_view.shape, -1, dtype=np.int64)
+    for (c, i), (location, name) in hits.items():
+        if name in self_names:
+            occlusion_type[c, i] = OCCLUSION_SELF
+            occluder[c, i] = nearest_bone(location, snapshot.heads, snapshot.tails)
+        else:
+            occlusion_type[c, i] = OCCLUSION_SCENE
+    return occlusion_type, occluder
+
+# occlusion_type の値
+OCCLUSION_VISIBLE = 0
+OCCLUSION_OUT_OF_FRAME = 1
+OCCLUSION_SELF = 2
+OCCLUSION_SCENE = 3
+# occluder_part の値 (遮蔽しているボーンの tail のキーポイント番号)
+# BONE_INDEX_MAP では足 (feet.001.l / r) もキーポイント0 (Root) になるので、足は 17, 18 の番号にする
+OCCLUDER_PART_MAP = dict(BONE_INDEX_MAP, **{'feet.001.l': 17, 'feet.001.r': 18})
 
-        # 2. 3Dワールド座標をカメラビューの2D比率(0.0 - 1.0)に変換
-        # 返り値は Vector((x, y, z))。zはカメラからの深度（正ならカメラの前方）
-        head_view = world_to_camera_view(scene, camera, head_world)
-        tail_view = world_to_camera_view(scene, camera, tail_world)
+# ====================================================================
+# 前フレームの可視性を再利用するキャッシュ
+# ====================================================================
+class VisibilityCache:
+    """カメラ × 関節ごとに、前回の可視性を保持して、変わりうるレイだけ判定し直す
+
+    遮蔽物の三角形を最も近いボーンごとの部位に分け、部位ごとの頂点の移動量の最大値を積算する
+    (部位の分け方は判定の正しさには関係せず、細かいほど判定し直すレイが減る)
+    遮られていないレイ: 判定したときのレイと各部位のカプセル (ボーンの線分 + 頂点までの最大距離) の距離を保持し、
+      その部位の移動量 + レイの端点の移動量がどれかの部位で距離以上になったら判定し直す (見落としはない)
+    遮られていたレイ: 当たった三角形を保持し、現在の頂点とレイでまだ交差するかを NumPy でまとめて調べ、
+      交差しなくなったら判定し直す (交差していれば遮蔽のまま, 近似はない)
+    判定し直すレイがなければ、BVHTree も作らない
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.visibility = None
+        self.triangles = None
+        self.hits = 0
+        self.tests = 0
+        self.frames = 0
+        self.built = 0
+        self.elapsed = 0.0
+
+    def query(self, engine_factory, origins, points, mask, vertices, triangles, heads, tails,
+              end_offset=VISIBILITY_END_OFFSET):
+        start = time.perf_counter()
+        origins = np.asarray(origins, dtype=np.float64)
+        points = np.asarray(points, dtype=np.float64)
+        vertices = np.asarray(vertices, dtype=np.float64)
+        ends, lengths = ray_segments(origins, points, end_offset)
+        if self.triangles is None or len(vertices) != len(self.vertices) or len(triangles) != len(self.triangles):
+            self.assign_parts(vertices, triangles, heads, tails)
+            self.visibility = None
+        need = self.stale_rays(origins, ends, lengths, mask, vertices)
+
+        if np.any(need):
+            engine = engine_factory()
+            self.built += 1
+            for c, i in zip(*np.nonzero(need)):
+                hit = engine.ray_cast(origins[c], points[i], end_offset)
+                self.visibility[c, i] = 0 if hit else 1
+                self.hit_triangle[c, i] = hit[1] if hit else -1
+            self.tested[need] = True
+            self.update_bounds(need & (self.visibility == 1), origins, ends, lengths, vertices, heads, tails)
+
+        self.tests += int(np.count_nonzero(need))
+        self.hits += int(np.count_nonzero(mask & ~need))
+        self.frames += 1
+        self.elapsed += time.perf_counter() - start
+        return np.where(mask, self.visibility, 0).astype(np.uint8)
+
+    def assign_parts(self, vertices, triangles, heads, tails):
+        """三角形を重心に最も近いボーンの部位に分け、部位と頂点の組 (重複なし) を作る"""
+        self.triangles = np.asarray(triangles, dtype=np.int64)
+        centers = vertices[self.triangles].mean(axis=1)
+        self.triangle_parts = np.argmin(point_segment_distance(centers[:, np.newaxis], heads, tails), axis=1)
+        pairs = np.unique(np.repeat(self.triangle_parts, 3) * len(vertices) + self.triangles.ravel())
+        self.pair_parts, self.pair_vertices = np.divmod(pairs, len(vertices))
+        self.num_parts = len(heads)
+
+    def stale_rays(self, origins, ends, lengths, mask, vertices):
+        """前回からの移動量を積算し、判定し直すレイ (C, N) を返す"""
+        shape = mask.shape
+        if self.visibility is None or self.visibility.shape != shape:
+            self.visibility = np.zeros(shape, dtype=np.uint8)
+            self.hit_triangle = np.full(shape, -1, dtype=np.int64)
+            self.bound = np.zeros(shape + (self.num_parts,))
+            self.part_motion = np.zeros(shape + (self.num_parts,))
+            self.ray_motion = np.zeros(shape)
+            self.tested = np.zeros(shape, dtype=bool)
+        else:
+            # レイ (線分) の点は、両端の移動量の大きい方以上は動かない
+            end_move = np.linalg.norm(ends - self.ends, axis=-1)
+            camera_move = np.linalg.norm(origins - self.origins, axis=-1)
+            self.ray_motion += np.maximum(end_move, camera_move[:, np.newaxis])
+            # 部位の面の点は、その部位の頂点の移動量の最大値以上は動かない
+            vertex_move = np.linalg.norm(vertices - self.vertices, axis=-1)
+            part_move = np.zeros(self.num_parts)
+            np.maximum.at(part_move, self.pair_parts, vertex_move[self.pair_vertices])
+            self.part_motion += part_move
+
+        self.ends = ends.copy()
+        self.origins = origins.copy()
+        self.vertices = vertices.copy()
+
+        # 画角外になったレイは、次に画角内になったときに判定し直す
+        self.tested &= mask
+        visible = self.tested & (self.visibility == 1)
+        motion = self.ray_motion[..., np.newaxis] + self.part_motion
+        moved = np.any((motion > 0) & (motion >= self.bound), axis=-1)
+        occluded = self.tested & (self.visibility == 0)
+        return mask & (~self.tested | (visible & moved) | (occluded & ~self.still_occluded(occluded, origins, ends, lengths)))
+
+    def still_occluded(self, occluded, origins, ends, lengths):
+        """遮られていたレイ (C, N) が、前回当たった三角形とまだ交差するか"""
+        result = np.zeros(occluded.shape, dtype=bool)
+        cameras, joints = np.nonzero(occluded)
+        if len(cameras):
+            v0, v1, v2 = np.moveaxis(self.vertices[self.triangles[self.hit_triangle[cameras, joints]]], 1, 0)
+            directions = (ends[cameras, joints] - origins[cameras]) / np.maximum(lengths[cameras, joints], 1e-12)[:, np.newaxis]
+            t = occlusion_numpy.ray_triangle_distance(origins[cameras], directions, v0, v1, v2)
+            result[cameras, joints] = (lengths[cameras, joints] > 0) & (t <= lengths[cameras, joints])
+        return result
+
+    def update_bounds(self, rays, origins, ends, lengths, vertices, heads, tails):
+        """判定した遮られていないレイ (C, N) と、各部位のカプセルの距離を保持し、移動量を0に戻す"""
+        # 部位のカプセルの半径 (部位の頂点とボーンの線分の最大距離, 部位の三角形はカプセルの内側に入る)
+        radius = np.full(self.num_parts, -np.inf)
+        np.maximum.at(radius, self.pair_parts,
+                      point_segment_distance(vertices[self.pair_vertices], heads[self.pair_parts], tails[self.pair_parts]))
+        cameras, joints = np.nonzero(rays)
+        distance = virtual_camera.segment_distance(origins[cameras, np.newaxis], ends[cameras, joints, np.newaxis],
+                                                   heads[np.newaxis], tails[np.newaxis])
+        # 長さのないレイは、何かが動いたら判定し直す
+        self.bound[cameras, joints] = np.where(lengths[cameras, joints, np.newaxis] > 0, distance - radius, 0.0)
+        self.part_motion[cameras, joints] = 0.0
+        self.ray_motion[cameras, joints] = 0.0
+
+    def report(self):
+        total = self.hits + self.tests
+        if total:
+            print(f"可視性のキャッシュ: {self.hits} / {total} 本を再利用 (ヒット率 {self.hits / total * 100:.1f} %), "
+                  f"判定 {self.tests} 本, BVHTree を作ったフレーム {self.built} / {self.frames}, "
+                  f"1フレームあたり {self.elapsed / max(self.frames, 1) * 1000:.1f} ms")
+
+def ray_segments(origins, points, end_offset=VISIBILITY_END_OFFSET):
+    """カメラ位置 (C, 3) から全点 (N, 3) へのレイの終点 (C, N, 3, 点の手前 end_offset) と長さ (C, N) を返す"""
+    offset = points[np.newaxis] - origins[:, np.newaxis]
+    distance = np.linalg.norm(offset, axis=-1)
+    lengths = distance - end_offset
+    ends = origins[:, np.newaxis] + offset * (np.maximum(lengths, 0.0) / np.maximum(distance, 1e-12))[..., np.newaxis]
+    return ends, lengths
+
+def point_segment_distance(points, heads, tails):
+    """点と線分 heads-tails の距離 (ブロードキャスト可能な (..., 3))"""
+    segment = tails - heads
+    ratio = np.clip(np.sum((points - heads) * segment, axis=-1) / np.maximum(np.sum(segment ** 2, axis=-1), 1e-12), 0, 1)
+    return np.linalg.norm(heads + ratio[..., np.newaxis] * segment - points, axis=-1)
+
+def nearest_bone(point, heads, tails):
+    """点に最も近いボーン (線分) の番号"""
+    return int(np.argmin(point_segment_distance(point, heads, tails)))
+
+VISIBILITY_CACHE = VisibilityCache()
 
-        # 3. 比率をピクセル座標に変換
-        # Blenderの画像座標系は左下が(0,0)のため、必要に応じて上下反転の処理を行う
-        head_px = (head_view.x * RESOLUTION_X, (1.0 - head_view.y) * RESOLUTION_Y)
-        tail_px = (tail_view.x * RESOLUTION_X, (1.0 - tail_view.y) * RESOLUTION_Y)
+# ====================================================================
+# マルチレイヤー EXR (1回のレンダリングで画像・深度・マスクを書き出す)
+# ====================================================================
+def render_image_format():
+    return 'OPEN_EXR_MULTILAYER' if USE_EXR_RENDER else IMAGE_FORMAT
 
-        # ⭐ 可視性判定 (Ray Cast)
-        # 画角外なら問答無用で 0、画角内ならレイキャストで判定
-        if not (0 <= tail_view.x <= 1 and 0 <= tail_view.y <= 1 and tail_view.z > 0):
-            visibility = 0
-        else:
-            visibility = check_visibility(scene, camera, tail_world)
+def setup_exr_render(scene, armature_name=ARMATURE_NAME):
+    """深度・オブジェクトの番号のパスを有効にし、人物のメッシュに PERSON_PASS_INDEX を設定する (実行ごとに1回)"""
+    view_layer = bpy.context.view_layer
+    view_layer.use_pass_z = True
+    view_layer.use_pass_object_index = True
+    # 背景を透明にして、アルファも前景のマスクとして使えるようにする
+    scene.render.film_transparent = True
 
-        # カメラの画角内（0.0~1.0の範囲内）にあるかチェック
-        in_view = "In Frame" if (0 <= head_view.x <= 1 and 0 <= head_view.y <= 1) else "Out of Frame"
+    meshes = find_character_meshes(bpy.data.objects[armature_name])
+    for obj in meshes:
+        obj.pass_index = PERSON_PASS_INDEX
+    print(f"マルチレイヤー EXR で書き出します (人物のメッシュ {len(meshes)} 個, オブジェクトの番号 {PERSON_PASS_INDEX})")
 
-        keypoint_2d[BONE_INDEX_MAP[pbone.name]] = (tail_px[0], tail_px[1], visibility)
-        if pbone.name == "spine.001":
-            keypoint_2d[0] = head_px
+# ====================================================================
+# 深度パスによる可視性 (レンダリングと同時に求める)
+# ====================================================================
+DEPTH_BUFFERS = {}
+
+def setup_depth_pass(scene):
+    """Zパスを有効にし、コンポジターで深度を Viewer ノードに出力する (実行ごとに1回)"""
+    bpy.context.view_layer.use_pass_z = True
+    scene.use_nodes = True
+    tree = scene.node_tree
+
+    render_layers = next((node for node in tree.nodes if node.type == 'R_LAYERS'), None)
+    if render_layers is None:
+        render_layers = tree.nodes.new('CompositorNodeRLayers')
+    viewer = next((node for node in tree.nodes if node.type == 'VIEWER'), None)
+    if viewer is None:
+        viewer = tree.nodes.new('CompositorNodeViewer')
+    viewer.use_alpha = False
+    tree.links.new(render_layers.outputs['Depth'], viewer.inputs['Image'])
+
+def read_depth_buffer():
+    """直前のレンダリングの深度を Viewer ノードの画像から (H, W) で読み出す (左上原点)"""
+    image = bpy.data.images['Viewer Node']
+    width, height = image.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    # Blenderの画像は左下原点なので上下を反転する
+    return pixels.reshape(height, width, 4)[::-1, :, 0].copy()
+
+def render_depth_buffers(scene, camera_names, formatted_number):
+    """全カメラをレンダリングし (画像も書き出す)、深度バッファをカメラごとに保持する"""
+    DEPTH_BUFFERS.clear()
+    for camera_name in camera_names:
+        camera = bpy.data.objects.get(camera_name)
+        if not camera or camera.type != 'CAMERA':
+            continue
+        scene.camera = camera
+        scene.render.filepath = f"{OUTPUT_DIR}output_{camera_name}_{formatted_number}"
+        bpy.ops.render.render(write_still=True)
+        DEPTH_BUFFERS[camera_name] = read_depth_buffer()
+
+def depth_visibility(scene, cameras, points_world, in_view, tolerance=DEPTH_TOLERANCE):
+    """全カメラ × 全点の深度を深度バッファとまとめて比較し、可視性 (C, N) を返す"""
+    projected = camera_projection.project_points(
+        get_projection_matrices(scene, [camera.name for camera in cameras]), points_world)[0]
+    if DEPTH_PASS_TYPE == 'radial':
+        depth = np.linalg.norm(points_world[np.newaxis] - camera_locations(cameras)[:, np.newaxis], axis=-1)
+    else:
+        depth = projected[..., 2]
+
+    visibility = np.zeros(in_view.shape, dtype=np.uint8)
+    for c, camera in enumerate(cameras):
+        buffer = DEPTH_BUFFERS.get(camera.name)
+        if buffer is None:
+            print(f"警告: カメラ '{camera.name}' の深度バッファがありません。")
+            continue
+        # 解像度の % 設定で深度バッファの大きさが変わる場合もあるので、ピクセル座標を合わせる
+        height, width = buffer.shape
+        x = np.clip((projected[c, :, 0] * width / scene.render.resolution_x).astype(np.int64), 0, width - 1)
+        y = np.clip((projected[c, :, 1] * height / scene.render.resolution_y).astype(np.int64), 0, height - 1)
+        visibility[c] = in_view[c] & (depth[c] - buffer[y, x] <= tolerance)
+    return visibility
+
+def camera_locations(cameras):
+    """カメラのワールド位置 (C, 3)"""
+    return np.array([list(camera.matrix_world.to_translation()) for camera in cameras])
+
+def compute_3d_outputs(scene, keypoints, snapshot):
+    """3Dキーポイントを OUTPUT_3D_FRAMES の座標系に、全カメラ・全関節まとめて変換する"""
+    camera_names = list(keypoints.keys())
+    if not camera_names:
+        return {}
+
+    # (C, 17, 4) : x, y, z, 可視性 (ワールド座標)
+    world = np.stack([keypoint_to_array(keypoints[name][1]).astype(np.float64) for name in camera_names])
+    points = world[..., :3]
+    homogeneous = np.concatenate([points, np.ones(points.shape[:-1] + (1,))], axis=-1)
+
+    arrays = {}
+    if 'world' in OUTPUT_3D_FRAMES:
+        arrays['world'] = world
+
+    if 'root' in OUTPUT_3D_FRAMES:
+        # Rootボーンの行列の逆行列を掛けて、RootのHeadが(0,0,0)になる空間へ飛ばす
+        root_index = snapshot.bone_names.index("Root") if "Root" in snapshot.bone_names else 0
+        inv_root_matrix = np.linalg.inv(snapshot.matrices_world[root_index])
+        root = world.copy()
+        root[..., :3] = homogeneous @ inv_root_matrix[:3].T
+        arrays['root'] = root
+
+    if 'camera' in OUTPUT_3D_FRAMES:
+        # カメラごとの [R | t] (OpenCVの向き) を全関節にまとめて掛ける
+        extrinsics = get_camera_extrinsics(scene, camera_names)
+        camera_space = world.copy()
+        camera_space[..., :3] = np.einsum('cij,cnj->cni', extrinsics, homogeneous)
+        arrays['camera'] = camera_space
+
+    return {
+        name: {OUTPUT_3D_KEYS[frame]: arrays[frame][c] for frame in OUTPUT_3D_FRAMES}
+        for c, name in enumerate(camera_names)
+    }
+
+# ====================================================================
+# 人物のバウンディングボックス (メッシュの頂点を全カメラにまとめて投影する)
+# ====================================================================
+def find_character_meshes(armature, mesh_names=BBOX_MESH_NAMES):
+    """アーマチュアで変形する人物のメッシュを探す"""
+    if mesh_names is not None:
+        return [bpy.data.objects[name] for name in mesh_names if name in bpy.data.objects]
+
+    meshes = []
+    for obj in bpy.data.objects:
+        if obj.type != 'MESH':
+            continue
+        deformed = any(mod.type == 'ARMATURE' and mod.object == armature for mod in obj.modifiers)
+        if obj.parent == armature or deformed:
+            meshes.append(obj)
+    return meshes
+
+def get_evaluated_vertices(meshes, depsgraph=None):
+    """ポーズを反映したメッシュの全頂点のワールド座標 (V, 3) を foreach_get でまとめて読み出す"""
+    return get_evaluated_geometry(meshes, depsgraph, with_triangles=False)[0]
+
+def get_evaluated_geometry(meshes, depsgraph=None, with_triangles=True):
+    """ポーズを反映したメッシュの頂点 (V, 3) と三角形の頂点番号 (T, 3) をまとめて読み出す"""
+    if depsgraph is None:
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+
+    vertices = []
+    triangles = []
+    offset = 0
+    for obj in meshes:
+        obj_eval = obj.evaluated_get(depsgraph)
+        mesh = obj_eval.to_mesh()
+        co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get('co', co)
+        matrix_world = np.array(obj_eval.matrix_world, dtype=np.float64)
+        vertices.append(co.reshape(-1, 3).astype(np.float64) @ matrix_world[:3, :3].T + matrix_world[:3, 3])
+
+        if with_triangles:
+            mesh.calc_loop_triangles()
+            indices = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+            mesh.loop_triangles.foreach_get('vertices', indices)
+            triangles.append(indices.reshape(-1, 3) + offset)
+        offset += len(mesh.vertices)
+        obj_eval.to_mesh_clear()
+
+    if not vertices:
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int32)
+    return np.concatenate(vertices), (np.concatenate(triangles) if triangles else np.zeros((0, 3), dtype=np.int32))
+
+def compute_bboxes(projected, resolution_x, resolution_y):
+    """投影した頂点 (C, V, 3) から、画像内に切り詰めたボックス (C, 4) と画像の端で切れているかどうか (C,) を求める"""
+    u, v, depth = projected[..., 0], projected[..., 1], projected[..., 2]
+    in_front = depth > 0
+    inside = camera_projection.in_frame(projected, resolution_x, resolution_y)
+
+    # カメラの後ろの頂点は除いてから最小・最大を求める
+    x_min = np.where(in_front, u, np.inf).min(axis=-1)
+    y_min = np.where(in_front, v, np.inf).min(axis=-1)
+    x_max = np.where(in_front, u, -np.inf).max(axis=-1)
+    y_max = np.where(in_front, v, -np.inf).max(axis=-1)
+    bboxes = np.stack([
+        np.clip(x_min, 0, resolution_x), np.clip(y_min, 0, resolution_y),
+        np.clip(x_max, 0, resolution_x), np.clip(y_max, 0, resolution_y),
+    ], axis=-1)
+
+    # 画角内の頂点が1つもなければ (0, 0, 0, 0)
+    empty = ~np.any(inside, axis=-1)
+    bboxes[empty] = 0.0
+    truncated = ~np.all(inside, axis=-1)
+    return bboxes, truncated
+
+def compute_person_bboxes(scene, camera_names, armature_name):
+    """全カメラの人物のバウンディングボックスを、頂点の読み出しと投影を1回ずつ行って求める"""
+    armature = bpy.data.objects.get(armature_name)
+    meshes = find_character_meshes(armature) if armature else []
+    if not meshes or not camera_names:
+        print("警告: バウンディングボックスに使うメッシュが見つかりません。")
+        return {}
+
+    vertices = get_evaluated_vertices(meshes)
+    projected = camera_projection.project_points(get_projection_matrices(scene, camera_names), vertices)[0]
+    bboxes, truncated = compute_bboxes(projected, scene.render.resolution_x, scene.render.resolution_y)
+    return {
+        name: {'bbox': bboxes[c], 'bbox_truncated': np.uint8(truncated[c])}
+        for c, name in enumerate(camera_names)
+    }
 
-    return keypoint_2d
-    
 def get_keypoint3d(scene, camera, armature_name):
     keypoint_3d = {}
 
@@ -251,6 +801,308 @@ def get_keypoint3d(scene, camera, armature_name):
 
     return keypoint_3d            
             
+# ====================================================================
+# カメラの射影行列 (カメラごとに1回だけ計算してキャッシュする)
+# ====================================================================
+PROJECTION_CACHE = {}
+
+def get_camera_params(scene, camera):
+    """射影行列の計算に必要なカメラとレンダリングの設定を取り出す"""
+    return {
+        'lens': camera.data.lens,
+        'sensor_width': camera.data.sensor_width,
+        'sensor_height': camera.data.sensor_height,
+        'sensor_fit': camera.data.sensor_fit,
+        'shift_x': camera.data.shift_x,
+        'shift_y': camera.data.shift_y,
+        'resolution_x': scene.render.resolution_x,
+        'resolution_y': scene.render.resolution_y,
+        'pixel_aspect_x': scene.render.pixel_aspect_x,
+        'pixel_aspect_y': scene.render.pixel_aspect_y,
+    }
+
+def get_projection_matrices(scene, camera_names):
+    """カメラごとの 3x4 の射影行列を (C, 3, 4) で返す (設定が変わった場合のみ計算し直す)"""
+    track = get_camera_track(scene, camera_names)
+    if track is not None:
+        return track['projection']
+
+    matrices = []
+    for camera_name in camera_names:
+        camera = bpy.data.objects.get(camera_name)
+        if camera.data.type != 'PERSP':
+            print(f"警告: カメラ '{camera_name}' は透視投影ではありません。射影行列は透視投影として計算します。")
+
+        params = get_camera_params(scene, camera)
+        matrix_world = np.array([list(row) for row in camera.matrix_world])
+        cached = PROJECTION_CACHE.get(camera_name)
+        if cached is None or cached['params'] != params or not np.array_equal(cached['matrix_world'], matrix_world):
+            K = camera_projection.intrinsics_from_params(params)
+            extrinsic = camera_projection.world_to_camera_matrix(matrix_world)
+            PROJECTION_CACHE[camera_name] = {
+                'params': params,
+                'matrix_world': matrix_world,
+                'K': K,
+                'extrinsic': extrinsic,
+                'projection': camera_projection.projection_matrix(K, extrinsic),
+            }
+        matrices.append(PROJECTION_CACHE[camera_name]['projection'])
+    return np.stack(matrices)
+
+def get_camera_extrinsics(scene, camera_names):
+    """カメラごとの [R | t] (OpenCVの向き) を (C, 3, 4) で返す"""
+    track = get_camera_track(scene, camera_names)
+    if track is not None:
+        return track['extrinsic']
+
+    get_projection_matrices(scene, camera_names)
+    return np.stack([PROJECTION_CACHE[name]['extrinsic'] for name in camera_names])
+
+# ====================================================================
+# 動くカメラ (フレームごとの外部パラメータをまとめてキャッシュする)
+# ====================================================================
+CAMERA_TRACK = {}
+
+def is_camera_animated(camera):
+    """アニメーション・コンストレイント・親子関係で動く (焦点距離などが変わる) 可能性があるカメラかどうか"""
+    return (camera.animation_data is not None or len(camera.constraints) > 0 or camera.parent is not None
+            or camera.data.animation_data is not None)
+
+def scene_frame_for_image(scene, image_number):
+    """image_number (1始まり) に対応するシーンのフレーム番号"""
+    return scene.frame_start + image_number - 1
+
+def sample_camera_tracks(scene, camera_names, frames):
+    """全カメラの外部パラメータを全フレーム分まとめて取り出し、(F, C, 3, 4) でキャッシュする
+
+    カメラがない場合と、内部パラメータ (焦点距離・シフトなど) がフレームによって変わる場合はキャッシュしない (None)。
+    キャッシュしない場合は、フレームごとにシーンのカメラから射影行列を計算する
+    """
+    CAMERA_TRACK.clear()
+    camera_names = [name for name in camera_names
+                    if bpy.data.objects.get(name) and bpy.data.objects[name].type == 'CAMERA']
+    if not camera_names:
+        print("警告: 外部パラメータをキャッシュするカメラがありません。")
+        return None
+    cameras = [bpy.data.objects[name] for name in camera_names]
+    animated = any(is_camera_animated(camera) for camera in cameras)
+    frames = np.asarray(frames, dtype=np.int64)
+
+    def read_matrix_worlds():
+        return np.stack([np.array(camera.matrix_world, dtype=np.float64) for camera in cameras])
+
+    if animated:
+        # 1フレームにつき1回だけ frame_set し、全カメラの matrix_world をまとめて読む
+        # 内部パラメータもフレームごとに読み、変わっていないことを確かめる
+        frame_current = scene.frame_current
+        matrix_worlds = np.empty((len(frames), len(cameras), 4, 4))
+        params_frames = []
+        for f, frame in enumerate(frames):
+            scene.frame_set(int(frame))
+            matrix_worlds[f] = read_matrix_worlds()
+            params_frames.append([get_camera_params(scene, camera) for camera in cameras])
+        scene.frame_set(frame_current)
+
+        changed = [name for c, name in enumerate(camera_names)
+                   if any(params[c] != params_frames[0][c] for params in params_frames[1:])]
+        if changed:
+            print(f"警告: カメラ {', '.join(changed)} の内部パラメータがフレームによって変わるため、"
+                  f"キャッシュせずにフレームごとに射影行列を計算します。")
+            return None
+        params_list = params_frames[0]
+    else:
+        # 静止しているカメラは1回だけ読んで全フレームで共有する
+        matrix_worlds = np.broadcast_to(read_matrix_worlds(), (len(frames), len(cameras), 4, 4))
+        params_list = [get_camera_params(scene, camera) for camera in cameras]
+
+    K = np.stack([camera_projection.intrinsics_from_params(params) for params in params_list])
+    extrinsic = camera_projection.world_to_camera_matrix(matrix_worlds)
+
+    CAMERA_TRACK.update({
+        'animated': animated,
+        'camera_animated': np.array([is_camera_animated(camera) for camera in cameras]),
+        'camera_names': list(camera_names),
+        'camera_lookup': {name: c for c, name in enumerate(camera_names)},
+        'frames': frames,
+        'frame_lookup': {int(frame): f for f, frame in enumerate(frames)},
+        'params': params_list,
+        'matrix_world': matrix_worlds,
+        'K': K,
+        'extrinsic': extrinsic,
+        'projection': K @ extrinsic,
+    })
+    print(f"✅ {len(cameras)} 台のカメラの外部パラメータを {len(frames)} フレーム分キャッシュしました "
+          f"({'動くカメラあり' if animated else 'すべて静止'})")
+    return CAMERA_TRACK
+
+def track_cameras(camera_names):
+    """CAMERA_TRACK の中のカメラの番号のリスト (キャッシュしていないカメラがあれば None)"""
+    if not CAMERA_TRACK or any(name not in CAMERA_TRACK['camera_lookup'] for name in camera_names):
+        return None
+    return [CAMERA_TRACK['camera_lookup'][name] for name in camera_names]
+
+def is_track_animated(camera_names):
+    """camera_names に動くカメラが含まれるかどうか (キャッシュしていない場合は、動く可能性があるとして True)"""
+    cameras = track_cameras(camera_names)
+    return cameras is None or bool(CAMERA_TRACK['camera_animated'][cameras].any())
+
+def get_camera_track(scene, camera_names):
+    """現在のフレームのカメラの射影行列などをキャッシュから取り出す (なければ None)
+
+    すべて静止している場合は、全フレームで同じ値なので現在のフレームによらず最初のフレームを使う
+    """
+    cameras = track_cameras(camera_names)
+    if cameras is None:
+        return None
+    if not is_track_animated(camera_names):
+        f = 0
+    elif scene.frame_current in CAMERA_TRACK['frame_lookup']:
+        f = CAMERA_TRACK['frame_lookup'][scene.frame_current]
+    else:
+        return None
+    return {key: CAMERA_TRACK[key][f, cameras] for key in ('projection', 'extrinsic', 'matrix_world')}
+
+def validate_projection(armature_name=ARMATURE_NAME, camera_names=None, tolerance=1e-3):
+    """キャッシュした射影行列の結果を world_to_camera_view と比較する"""
+    scene = bpy.context.scene
+    camera_names = camera_names or CAMERA_NAMES
+    obj = bpy.data.objects[armature_name]
+    points_world = [obj.matrix_world @ pbone.tail for pbone in obj.pose.bones]
+
+    projected = camera_projection.project_points(
+        get_projection_matrices(scene, camera_names), np.array([list(v) for v in points_world]))[0]
+    max_error = 0.0
+    for c, camera_name in enumerate(camera_names):
+        camera = bpy.data.objects[camera_name]
+        for i, point in enumerate(points_world):
+            view = world_to_camera_view(scene, camera, point)
+            expected = (view.x * scene.render.resolution_x, (1.0 - view.y) * scene.render.resolution_y, view.z)
+            max_error = max(max_error, max(abs(a - b) for a, b in zip(projected[c, i], expected)))
+
+    if max_error <= tolerance:
+        print(f"✅ 射影行列の結果が world_to_camera_view と一致しました (最大誤差 {max_error:.2e} px)")
+    else:
+        print(f"❌ 射影行列の結果が world_to_camera_view と一致しません (最大誤差 {max_error:.2e} px)")
+    return max_error
+
+def scene_camera_names(scene):
+    """シーンの全カメラの名前 (Camera2 < Camera10 の順)"""
+    return sorted((obj.name for obj in scene.objects if obj.type == 'CAMERA'), key=pose_metrics.natural_key)
+
+def export_camera_calibration(scene, camera_names=None, output_filepath=CALIBRATION_FILE):
+    """カメラの内部・外部パラメータを書き出す (実行ごとに1回, camera_names がなければシーンの全カメラ)"""
+    camera_names = [name for name in (camera_names or scene_camera_names(scene))
+                    if bpy.data.objects.get(name) and bpy.data.objects[name].type == 'CAMERA']
+    if not camera_names:
+        print("警告: キャリブレーションを書き出すカメラがありません。")
+        return None
+
+    cameras = track_cameras(camera_names)
+    if cameras is not None and is_track_animated(camera_names):
+        # 動くカメラがある場合は、フレームごとの外部パラメータを書き出す
+        calibration = camera_projection.save_calibration(
+            output_filepath, camera_names, [CAMERA_TRACK['params'][c] for c in cameras],
+            CAMERA_TRACK['matrix_world'][:, cameras], frames=CAMERA_TRACK['frames'])
+    elif cameras is not None:
+        # すべて静止している場合は、キャッシュの最初のフレームの値を書き出す
+        calibration = camera_projection.save_calibration(
+            output_filepath, camera_names, [CAMERA_TRACK['params'][c] for c in cameras],
+            CAMERA_TRACK['matrix_world'][0, cameras])
+    else:
+        # キャッシュにないカメラを含む場合は、現在のフレームの値を読む (PROJECTION_CACHE に入る)
+        get_projection_matrices(scene, camera_names)
+        calibration = camera_projection.save_calibration(
+            output_filepath,
+            camera_names,
+            [PROJECTION_CACHE[name]['params'] for name in camera_names],
+            [PROJECTION_CACHE[name]['matrix_world'] for name in camera_names],
+        )
+    print(f"✅ {len(camera_names)} 台のカメラのキャリブレーションを書き出しました: {output_filepath}")
+    return calibration
+
+def validate_camera_calibration(camera_names=None, num_frames=3, output_filepath=None, tolerance=1e-6):
+    """sample_camera_tracks でキャッシュした後に export_camera_calibration を呼び、
+    書き出した K, matrix_world, P が現在のフレームのカメラと一致することを確かめる (静止したカメラも確認する)"""
+    scene = bpy.context.scene
+    camera_names = [name for name in (camera_names or CAMERA_NAMES)
+                    if bpy.data.objects.get(name) and bpy.data.objects[name].type == 'CAMERA']
+    if not camera_names:
+        print("警告: 確認するカメラがありません。")
+        return None
+    output_filepath = output_filepath or os.path.join(tempfile.gettempdir(), 'validate_camera_calibration.npz')
+
+    # 現在のフレームから num_frames フレーム分をキャッシュする (動くカメラは最初のフレームと比べる)
+    frame_current = scene.frame_current
+    sample_camera_tracks(scene, camera_names, [frame_current + f for f in range(num_frames)])
+    calibration = export_camera_calibration(scene, camera_names, output_filepath)
+    CAMERA_TRACK.clear()
+    if calibration is None:
+        print("❌ キャリブレーションを書き出せませんでした")
+        return False
+
+    num_cameras = len(camera_names)
+    rotations = calibration['R_blender'].reshape(-1, num_cameras, 3, 3)[0]
+    locations = calibration['t_blender'].reshape(-1, num_cameras, 3)[0]
+    projections = calibration['P'].reshape(-1, num_cameras, 3, 4)[0]
+    ok = True
+    for c, name in enumerate(camera_names):
+        camera = bpy.data.objects[name]
+        K = camera_projection.intrinsics_from_params(get_camera_params(scene, camera))
+        matrix_world = np.array(camera.matrix_world, dtype=np.float64)
+        rotation = matrix_world[:3, :3] / np.linalg.norm(matrix_world[:3, :3], axis=0, keepdims=True)
+        P = K @ camera_projection.world_to_camera_matrix(matrix_world)
+        errors = [np.abs(calibration['K'][c] - K).max() / max(1.0, np.abs(K).max()),
+                  np.abs(rotations[c] - rotation).max(),
+                  np.abs(locations[c] - matrix_world[:3, 3]).max(),
+                  np.abs(projections[c] - P).max() / max(1.0, np.abs(P).max())]
+        if max(errors) > tolerance:
+            print(f"❌ カメラ '{name}' のキャリブレーションがシーンと一致しません (最大誤差 {max(errors):.2e})")
+            ok = False
+    if ok:
+        print(f"✅ {num_cameras} 台のカメラのキャリブレーションがシーンと一致しました: {output_filepath}")
+    return ok
+
+def create_cameras_from_calibration(calibration_file, camera_names=None, collection_name=VIRTUAL_CAMERA_COLLECTION):
+    """キャリブレーション (virtual_camera.py などで作ったもの) からシーンにカメラを作る
+
+    camera_names で一部のカメラだけを選べる。作ったカメラ名を CAMERA_NAMES に加えればレンダリングできる
+    """
+    calibration = camera_projection.load_calibration(calibration_file)
+    collection = bpy.data.collections.get(collection_name)
+    if collection is None:
+        collection = bpy.data.collections.new(collection_name)
+        bpy.context.scene.collection.children.link(collection)
+
+    created = []
+    for c, name in enumerate(calibration['camera_names']):
+        if camera_names is not None and name not in camera_names:
+            continue
+        params = calibration['params'][c]
+
+        # 同じ名前のカメラがあれば設定を上書きする
+        camera = bpy.data.objects.get(name)
+        if camera is None:
+            camera = bpy.data.objects.new(name, bpy.data.cameras.new(name))
+            collection.objects.link(camera)
+        camera.data.lens = params['lens']
+        camera.data.sensor_width = params['sensor_width']
+        camera.data.sensor_height = params['sensor_height']
+        camera.data.sensor_fit = params['sensor_fit']
+        camera.data.shift_x = params['shift_x']
+        camera.data.shift_y = params['shift_y']
+
+        # 動くカメラのキャリブレーションの場合は最初のフレームの位置にする
+        rotation = calibration['R_blender'][..., c, :, :].reshape(-1, 3, 3)[0]
+        location = calibration['t_blender'][..., c, :].reshape(-1, 3)[0]
+        matrix_world = np.eye(4)
+        matrix_world[:3, :3] = rotation
+        matrix_world[:3, 3] = location
+        camera.matrix_world = Matrix(matrix_world.tolist())
+        created.append(name)
+
+    print(f"✅ {len(created)} 台のカメラをシーンに追加しました ({collection_name})")
+    return created
+
 # ====================================================================
 # npzファイルを読み込む
 # ====================================================================
@@ -288,7 +1140,7 @@ def load_keypoints_data_from_npz(filepath, scale_factor=1):
             return None
             
         # 座標のスケール調整
-        keypoints_array_scaled = keypoints_data
+        keypoints_array_scaled = keypoints_data * scale_factor
             
         # NumPy配列を mathutils.Vector のリストに変換
         keypoints_list = [Vector(kp) for kp in keypoints_array_scaled]
@@ -421,6 +1273,113 @@ def apply_clear_pose_fk_method(armature):
     print("✅ ポーズのクリアが完了しました")
     
     
+# ====================================================================
+# リセットとポーズ適用をまとめて1回で書き込む
+# ====================================================================
+# リセットの回転はレストポーズだけで決まるので、アーマチュアごとに1回だけ計算する
+CLEAR_ROTATION_CACHE = {}
+
+def get_clear_rotation_quaternions(armature):
+    """calculate_clear_rotation の結果をクォータニオンにしてキャッシュする"""
+    if armature.name not in CLEAR_ROTATION_CACHE:
+        clear_rotation_list = calculate_clear_rotation(armature.name)
+        CLEAR_ROTATION_CACHE[armature.name] = {
+            pair: rotation.to_quaternion() for pair, rotation in clear_rotation_list.items()
+        }
+    return CLEAR_ROTATION_CACHE[armature.name]
+
+def apply_pose_fused(armature, keypoints_list, use_clear_correction=USE_CLEAR_CORRECTION):
+    """リセットの回転と目標の回転を合成し、各ボーンに最終的なクォータニオンを1回だけ書き込む"""
+    rotation_list = calculate_rotation_from_npz(keypoints_list)
+    clear_rotation_list = get_clear_rotation_quaternions(armature) if use_clear_correction else {}
+
+    # ローカル回転を書き込むだけなので、モード切替やヒエラルキー順の処理は不要
+    for pbone in armature.pose.bones:
+        bone_index = BONE_INDEX_MAP.get(pbone.name)
+        rotation = Quaternion((1.0, 0.0, 0.0, 0.0))
+        if bone_index in rotation_list:
+            # リセットの回転 (親と同じ向きにそろえる) の後に目標の回転を適用する
+            rotation = rotation_list[bone_index]
+            if bone_index in clear_rotation_list:
+                rotation = clear_rotation_list[bone_index] @ rotation
+
+        pbone.rotation_mode = 'QUATERNION'
+        pbone.rotation_quaternion = rotation
+        pbone.location = (0.0, 0.0, 0.0)
+
+    bpy.context.view_layer.update()
+    print("✅ ポーズのリセットと適用を1回で完了しました。")
+
+# ====================================================================
+# 反復IKでポーズを微調整して適用する
+# ====================================================================
+# アーマチュアのレスト情報 (ボーンの長さを変更したら削除する)
+ARMATURE_REST_CACHE = {}
+# 前フレームのIKの解 (シーケンスの最初でリセットする)
+IK_WARM_START = {}
+# フレームごとの反復回数と処理時間
+IK_STATS = {'iterations': [], 'times': []}
+
+def get_armature_rest(armature):
+    if armature.name not in ARMATURE_REST_CACHE:
+        ARMATURE_REST_CACHE[armature.name] = collect_armature_rest(armature)
+    return ARMATURE_REST_CACHE[armature.name]
+
+def apply_pose_ik_refined(armature, keypoints_list):
+    """apply_pose_fused と同じ回転を初期値にIKで微調整し、各ボーンに1回だけ書き込む"""
+    start = time.perf_counter()
+    rest = get_armature_rest(armature)
+    keypoints = np.array([list(kp) for kp in keypoints_list])
+
+    initial = numpy_fk.solve_rotations(rest, keypoints, USE_CLEAR_CORRECTION)[0]
+    quaternions, iterations, error = ik_refine.refine_frame_warm(
+        rest, initial, IK_WARM_START.get(armature.name), keypoints, IK_MAX_ITERATIONS)
+    IK_WARM_START[armature.name] = quaternions
+
+    for pbone in armature.pose.bones:
+        pbone.rotation_mode = 'QUATERNION'
+        pbone.rotation_quaternion = quaternions[rest['bone_lookup'][pbone.name]]
+        pbone.location = (0.0, 0.0, 0.0)
+    bpy.context.view_layer.update()
+
+    elapsed = time.perf_counter() - start
+    IK_STATS['iterations'].append(iterations)
+    IK_STATS['times'].append(elapsed)
+    print(f"✅ IKで微調整したポーズを適用しました (反復 {iterations} 回, {elapsed * 1000:.1f} ms, 誤差 {error * 1000:.1f} mm)")
+
+def validate_fused_pose(npz_filepath, tolerance=1e-5):
+    """従来の2段階処理 (クリア → 適用) と apply_pose_fused の結果を比較する"""
+    armature = bpy.data.objects[ARMATURE_NAME]
+    keypoints_list = load_keypoints_data_from_npz(npz_filepath, SCALE_FACTOR)
+    if keypoints_list is None:
+        return None
+
+    def read_pose_matrices():
+        bpy.context.view_layer.update()
+        return {pbone.name: pbone.matrix.copy() for pbone in armature.pose.bones}
+
+    def max_difference(matrices_a, matrices_b):
+        return max(
+            max(abs(a - b) for row_a, row_b in zip(matrices_a[name], matrices_b[name]) for a, b in zip(row_a, row_b))
+            for name in matrices_a
+        )
+
+    apply_clear_pose_fk_method(armature)
+    apply_pose_fk_method(armature, keypoints_list)
+    two_step = read_pose_matrices()
+
+    # 従来の処理では rotation_mode の切り替え後に単位クォータニオンで上書きされるため、
+    # 合成なし (USE_CLEAR_CORRECTION = False) なら結果が一致する。実際に使う設定で比較する
+    apply_pose_fused(armature, keypoints_list, use_clear_correction=USE_CLEAR_CORRECTION)
+    error = max_difference(two_step, read_pose_matrices())
+    if error <= tolerance:
+        print(f"✅ 2段階処理と1回書き込みの結果が一致しました (最大誤差 {error:.2e})")
+    elif USE_CLEAR_CORRECTION:
+        print(f"❌ USE_CLEAR_CORRECTION = True のため、2段階処理とポーズが変わります (最大誤差 {error:.2e})")
+    else:
+        print(f"❌ 2段階処理と1回書き込みの結果が一致しません (最大誤差 {error:.2e} > {tolerance:.0e})")
+    return error
+
 # ====================================================================
 # ボーンの向きを同じ方向にそろえる
 # ====================================================================
@@ -527,12 +1486,75 @@ def calculate_rotation_from_npz (keypoints_list):
 
     return rotation_list
 
+# ====================================================================
+# シーケンスごとにボーンの長さを入力の骨格に合わせる
+# ====================================================================
+def retarget_bone_lengths(armature, bone_lengths):
+    """エディットボーンの長さを変更する (向きとロールはそのまま、子ボーンは親の tail に合わせて移動)
+
+    アーマチュアを直接書き換えるので、保存すると .blend も変更される。
+    スキンのメッシュはバインドし直さないため、メッシュ (レンダリング・bbox・遮蔽) はボーンと合わなくなる
+    """
+    view_layer = bpy.context.view_layer
+    bpy.ops.object.mode_set(mode='OBJECT')
+    view_layer.objects.active = armature
+    bpy.ops.object.mode_set(mode='EDIT')
+
+    edit_bones = armature.data.edit_bones
+    # ワールド座標の長さをアーマチュア空間の長さに変換する
+    scale = sum(armature.matrix_world.to_scale()) / 3.0
+
+    # 接続されたボーンは head/tail の変更が親子に伝わるので、変更前の値を保存しておく
+    original = {ebone.name: (ebone.head.copy(), ebone.tail.copy()) for ebone in edit_bones}
+
+    def get_bone_hierarchy(bone, hierarchy_list):
+        hierarchy_list.append(bone.name)
+        for child in bone.children: get_bone_hierarchy(child, hierarchy_list)
+        return hierarchy_list
+
+    sorted_bones = []
+    for ebone in edit_bones:
+        if ebone.parent is None:
+            get_bone_hierarchy(ebone, sorted_bones)
+
+    # 親 → 子の順に、親の tail の移動量を子に引き継ぐ
+    tail_offsets = {}
+    for bone_name in sorted_bones:
+        ebone = edit_bones[bone_name]
+        head, tail = original[bone_name]
+        offset = tail_offsets.get(ebone.parent.name, Vector((0.0, 0.0, 0.0))) if ebone.parent else Vector((0.0, 0.0, 0.0))
+
+        new_head = head + offset
+        if bone_name in bone_lengths:
+            new_tail = new_head + (tail - head).normalized() * (bone_lengths[bone_name] / scale)
+        else:
+            new_tail = tail + offset
+
+        ebone.head = new_head
+        ebone.tail = new_tail
+        tail_offsets[bone_name] = new_tail - tail
+
+    bpy.ops.object.mode_set(mode='OBJECT')
+    print(f"✅ {len(bone_lengths)} 本のボーンの長さを入力の骨格に合わせました。")
+
+def retarget_sequence(armature, target_dir=None):
+    """シーケンス全体のキーポイントからボーンの長さ (中央値) を求め、1回だけ合わせ込む"""
+    files, keypoints = numpy_fk.load_keypoints_sequence(target_dir or TAGET_DIR, EXTENSION)
+    if len(files) == 0:
+        return None
+
+    bone_lengths = numpy_fk.measure_bone_lengths(keypoints * SCALE_FACTOR)
+    retarget_bone_lengths(armature, bone_lengths)
+    # ボーンの長さが変わったので、IK で使うレスト情報を読み直す
+    ARMATURE_REST_CACHE.pop(armature.name, None)
+    return bone_lengths
+
 # ====================================================================
 # 信頼性
 # ====================================================================
-def check_visibility(scene, camera, target_world_location):
+def visibility_ray_hit(scene, camera, target_world_location, depsgraph=None):
     """
-    カメラからターゲット点に向かってレイを飛ばし、メッシュに遮られているか判定する
+    カメラからターゲット点に向かってレイを飛ばし、メッシュに遮られていれば (位置, 面の番号, オブジェクト) を返す
     """
     # カメラのワールド位置を取得
     cam_location = camera.matrix_world.to_translation()
@@ -541,15 +1563,301 @@ def check_visibility(scene, camera, target_world_location):
     direction = target_world_location - cam_location
     
     # シーン内の全てのオブジェクトに対してレイキャストを実行
-    # depsgraph（依存グラフ）が必要
-    depsgraph = bpy.context.evaluated_depsgraph_get()
+    # depsgraph（依存グラフ）が必要 (同じフレームで何度も呼ぶ場合は、呼び出し側で1回だけ取得して渡す)
+    if depsgraph is None:
+        depsgraph = bpy.context.evaluated_depsgraph_get()
     
     # ray_cast(起点, 方向, 距離)
     # ターゲットまでの距離を計算して、それ以上の遠くの壁に当たらないようにする
     hit, loc, norm, index, obj, matrix = scene.ray_cast(depsgraph, cam_location, direction, distance=direction.length - 0.1)
 
     # hitがTrueなら、ターゲットの手前で何かのメッシュに当たった＝隠れている
-    return 0 if hit else 1
+    # (当たった位置・面の番号・オブジェクトは遮蔽の種類の判定に使う)
+    return (loc, index, obj) if hit else None
+
+def check_visibility(scene, camera, target_world_location, depsgraph=None):
+    """
+    カメラからターゲット点に向かってレイを飛ばし、メッシュに遮られているか判定する
+    """
+    return 0 if visibility_ray_hit(scene, camera, target_world_location, depsgraph) else 1
+
+# ====================================================================
+# 遮蔽物のメッシュだけの BVHTree で、全カメラ × 全関節をまとめて判定する
+# ====================================================================
+def get_occluder_meshes(armature, collection_name=OCCLUDER_COLLECTION):
+    """遮蔽物とするメッシュ (コレクションの指定がなければ人物のメッシュ)"""
+    if collection_name is None:
+        return find_character_meshes(armature)
+    collection = bpy.data.collections.get(collection_name)
+    if collection is None:
+        print(f"警告: コレクション '{collection_name}' が見つかりません。人物のメッシュを遮蔽物とします。")
+        return find_character_meshes(armature)
+    return [obj for obj in collection.all_objects if obj.type == 'MESH']
+
+class OcclusionEngine:
+    """1フレーム分の遮蔽物のメッシュから BVHTree を1回だけ作り、全カメラで共有する
+
+    レイの判定はシーン全体ではなく遮蔽物の三角形だけに対して行うので、
+    処理時間はシーンの大きさではなく人物 (遮蔽物) の三角形の数で決まる
+    """
+    def __init__(self, meshes, depsgraph=None):
+        if depsgraph is None:
+            depsgraph = bpy.context.evaluated_depsgraph_get()
+        self.vertices, self.triangles = get_evaluated_geometry(meshes, depsgraph)
+        # 三角形ごとのメッシュの番号 (当たったオブジェクトを調べるのに使う)
+        vertex_counts = [len(obj.evaluated_get(depsgraph).data.vertices) for obj in meshes]
+        self.mesh_names = [obj.name for obj in meshes]
+        self.triangle_meshes = np.searchsorted(np.cumsum(vertex_counts), self.triangles[:, 0], side='right')
+        self.tree = BVHTree.FromPolygons(self.vertices.tolist(), self.triangles.tolist(), all_triangles=True)
+
+    def ray_cast(self, origin, target, end_offset=VISIBILITY_END_OFFSET):
+        """origin から target の手前 end_offset までに三角形があれば (位置, 三角形の番号, 距離) を返す"""
+        direction = Vector(target) - Vector(origin)
+        distance = direction.length - end_offset
+        if distance <= 0:
+            return None
+        location, normal, index, hit_distance = self.tree.ray_cast(Vector(origin), direction.normalized(), distance)
+        if location is None:
+            return None
+        return location, index, hit_distance
+
+    def hit_record(self, hit):
+        """ray_cast の結果を (位置, 当たったオブジェクト名) にする"""
+        return np.array(hit[0]), self.mesh_names[self.triangle_meshes[hit[1]]]
+
+    def query(self, origins, points, mask=None, end_offset=VISIBILITY_END_OFFSET, hits=None):
+        """カメラ位置 (C, 3) から全点 (N, 3) へのレイをまとめて判定し、可視性 (C, N) を返す (mask が False の組は0)
+
+        hits を渡すと、遮ったレイの当たりを (カメラ, 点) : (位置, オブジェクト名) で追加する
+        """
+        origins = np.asarray(origins, dtype=np.float64)
+        points = np.asarray(points, dtype=np.float64)
+        if mask is None:
+            mask = np.ones((len(origins), len(points)), dtype=bool)
+
+        visibility = np.zeros(mask.shape, dtype=np.uint8)
+        for c, i in zip(*np.nonzero(mask)):
+            hit = self.ray_cast(origins[c], points[i], end_offset)
+            visibility[c, i] = 0 if hit else 1
+            if hit and hits is not None:
+                hits[c, i] = self.hit_record(hit)
+        return visibility
+
+    def query_fraction(self, origins, points, mask=None, num_rays=STENCIL_RAYS, radius=STENCIL_RADIUS,
+                       end_offset=VISIBILITY_END_OFFSET, hits=None):
+        """関節のまわりの円盤 (視線に垂直) に num_rays 本のレイを飛ばし、
+        中心のレイの可視性 (C, N) と見えている割合 (C, N, 0~255) を返す"""
+        origins = np.asarray(origins, dtype=np.float64)
+        points = np.asarray(points, dtype=np.float64)
+        if mask is None:
+            mask = np.ones((len(origins), len(points)), dtype=bool)
+
+        # 全カメラ × 全点の円盤上の目標点をまとめて作る (C, N, R, 3)
+        offsets = stencil_offsets(num_rays, radius)
+        view = numpy_fk.normalize(points[np.newaxis] - origins[:, np.newaxis])
+        helper = np.where(np.abs(view[..., 2:3]) < 0.9, [0.0, 0.0, 1.0], [1.0, 0.0, 0.0])
+        axis_u = numpy_fk.normalize(np.cross(view, helper))
+        axis_v = np.cross(view, axis_u)
+        targets = (points[np.newaxis, :, np.newaxis]
+                   + offsets[:, 0, np.newaxis] * axis_u[:, :, np.newaxis]
+                   + offsets[:, 1, np.newaxis] * axis_v[:, :, np.newaxis])
+
+        visibility = np.zeros(mask.shape, dtype=np.uint8)
+        fraction = np.zeros(mask.shape, dtype=np.uint8)
+        for c, i in zip(*np.nonzero(mask)):
+            stencil_hits = [self.ray_cast(origins[c], target, end_offset) for target in targets[c, i]]
+            occluded = sum(hit is not None for hit in stencil_hits)
+            visibility[c, i] = 0 if stencil_hits[0] else 1
+            fraction[c, i] = int(round(255 * (num_rays - occluded) / num_rays))
+            if stencil_hits[0] and hits is not None:
+                hits[c, i] = self.hit_record(stencil_hits[0])
+        return visibility, fraction
+
+def stencil_offsets(num_rays=STENCIL_RAYS, radius=STENCIL_RADIUS):
+    """円盤上に均等に並べた (num_rays, 2) の点 (最初の点は中心, フィボナッチ螺旋)"""
+    k = np.arange(num_rays)
+    r = radius * np.sqrt(k / max(num_rays - 1, 1))
+    angle = k * np.pi * (3.0 - np.sqrt(5.0))
+    return np.stack([r * np.cos(angle), r * np.sin(angle)], axis=-1)
+
+def export_occlusion_scene(armature_name=ARMATURE_NAME, camera_names=None, output_filepath=OCCLUSION_SCENE_FILE):
+    """現在のフレームの全メッシュの三角形・カメラ位置・関節と check_visibility の結果を書き出し、
+    occlusion_numpy.py の結果と比較する"""
+    scene = bpy.context.scene
+    cameras = [bpy.data.objects[name] for name in (camera_names or CAMERA_NAMES)
+               if bpy.data.objects.get(name) and bpy.data.objects[name].type == 'CAMERA']
+    snapshot = ArmatureSnapshot(bpy.data.objects[armature_name])
+
+    # scene.ray_cast と同じく、表示されている全メッシュを遮蔽物とする
+    meshes = [obj for obj in scene.objects if obj.type == 'MESH' and obj.visible_get()]
+    vertices, triangles = get_evaluated_geometry(meshes)
+
+    projection = get_projection_matrices(scene, [camera.name for camera in cameras])
+    projected = camera_projection.project_points(projection, snapshot.tails)[0]
+    in_view = camera_projection.in_frame(projected, scene.render.resolution_x, scene.render.resolution_y)
+    visibility = raycast_visibility(scene, cameras, snapshot.tails, in_view)
+
+    np.savez_compressed(output_filepath, vertices=vertices, triangles=triangles,
+                        camera_locations=camera_locations(cameras), points=snapshot.tails,
+                        in_view=in_view, visibility=visibility)
+    print(f"✅ 遮蔽の判定に使うシーンを書き出しました: {output_filepath}")
+    return occlusion_numpy.compare_with_scene(output_filepath)
+
+# ====================================================================
+# Blenderなしで FK を計算するためのレスト情報を書き出す
+# ====================================================================
+def collect_armature_rest(armature):
+    """アーマチュアのレスト行列・ボーンの長さ・親子関係を NumPy 配列にまとめる"""
+    # pose.bones の並び順で保存する (get_keypoint3d のキーポイントの上書き順と同じにする)
+    bone_names = [pbone.name for pbone in armature.pose.bones]
+    bones = armature.data.bones
+    parent_index = [bone_names.index(bones[name].parent.name) if bones[name].parent else -1 for name in bone_names]
+
+    rest = {
+        'bone_names': bone_names,
+        'parent_index': np.array(parent_index, dtype=np.int64),
+        'matrix_local': np.array([[list(row) for row in bones[name].matrix_local] for name in bone_names]),
+        'length': np.array([bones[name].length for name in bone_names]),
+        'matrix_world': np.array([list(row) for row in armature.matrix_world]),
+    }
+    return numpy_fk.prepare_armature_rest(rest)
+
+def export_armature_rest(armature_name=ARMATURE_NAME, output_filepath=ARMATURE_REST_FILE):
+    """レスト情報を npz に書き出す (.blend ごとに1回だけ実行すればよい)"""
+    obj = bpy.data.objects.get(armature_name)
+    if not obj or obj.type != 'ARMATURE':
+        print(f"❌ アーマチュア '{armature_name}' が見つかりません。")
+        return None
+
+    rest = collect_armature_rest(obj)
+    np.savez_compressed(
+        output_filepath,
+        bone_names=np.array(rest['bone_names']),
+        parent_index=rest['parent_index'],
+        matrix_local=rest['matrix_local'],
+        length=rest['length'],
+        matrix_world=rest['matrix_world'],
+    )
+    print(f"✅ アーマチュアのレスト情報を書き出しました: {output_filepath}")
+    return rest
+
+def export_skinning(armature_name=ARMATURE_NAME, output_filepath=SKINNING_FILE, max_influences=SKINNING_MAX_INFLUENCES):
+    """人物のメッシュのレストの頂点 (アーマチュア空間), 三角形, ボーンのウェイトを書き出す (.blend ごとに1回)"""
+    armature = bpy.data.objects.get(armature_name)
+    if not armature or armature.type != 'ARMATURE':
+        print(f"❌ アーマチュア '{armature_name}' が見つかりません。")
+        return None
+    meshes = find_character_meshes(armature)
+    if not meshes:
+        print("❌ アーマチュアで変形するメッシュが見つかりません。")
+        return None
+
+    bone_names = [pbone.name for pbone in armature.pose.bones]
+    bone_lookup = {name: b for b, name in enumerate(bone_names)}
+    armature_inv = np.linalg.inv(np.array(armature.matrix_world, dtype=np.float64))
+
+    vertices, triangles, triangle_uvs, bone_indices, bone_weights = [], [], [], [], []
+    offset = 0
+    for obj in meshes:
+        mesh = obj.data
+        co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get('co', co)
+        # アーマチュアモディファイアと同じく、アーマチュア空間で変形する
+        to_armature = armature_inv @ np.array(obj.matrix_world, dtype=np.float64)
+        vertices.append(co.reshape(-1, 3).astype(np.float64) @ to_armature[:3, :3].T + to_armature[:3, 3])
+
+        mesh.calc_loop_triangles()
+        indices = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+        mesh.loop_triangles.foreach_get('vertices', indices)
+        triangles.append(indices.reshape(-1, 3) + offset)
+
+        # 三角形の角ごとのUV座標 (dense_uv.py で使う, UVがないメッシュは0)
+        uv = np.zeros((len(mesh.loop_triangles), 3, 2), dtype=np.float32)
+        if mesh.uv_layers.active:
+            loops = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+            mesh.loop_triangles.foreach_get('loops', loops)
+            loop_uvs = np.empty(len(mesh.loops) * 2, dtype=np.float32)
+            mesh.uv_layers.active.data.foreach_get('uv', loop_uvs)
+            uv = loop_uvs.reshape(-1, 2)[loops.reshape(-1, 3)]
+        triangle_uvs.append(uv)
+
+        # 頂点グループのうちボーンと同じ名前のものだけをウェイトとする
+        group_bones = {group.index: bone_lookup[group.name] for group in obj.vertex_groups if group.name in bone_lookup}
+        indices = np.zeros((len(mesh.vertices), max_influences), dtype=np.int32)
+        weights = np.zeros((len(mesh.vertices), max_influences), dtype=np.float32)
+        for vertex in mesh.vertices:
+            influences = sorted(((g.weight, group_bones[g.group]) for g in vertex.groups
+                                 if g.group in group_bones and g.weight > 0), reverse=True)[:max_influences]
+            total = sum(weight for weight, _ in influences)
+            for k, (weight, bone) in enumerate(influences):
+                indices[vertex.index, k] = bone
+                weights[vertex.index, k] = weight / total
+        bone_indices.append(indices)
+        bone_weights.append(weights)
+        offset += len(mesh.vertices)
+
+    skinning = {
+        'vertices': np.concatenate(vertices),
+        'triangles': np.concatenate(triangles),
+        'triangle_uvs': np.concatenate(triangle_uvs),
+        'bone_indices': np.concatenate(bone_indices),
+        'bone_weights': np.concatenate(bone_weights),
+        'bone_names': np.array(bone_names),
+        'mesh_names': np.array([obj.name for obj in meshes]),
+        'mesh_offsets': np.cumsum([0] + [len(obj.data.vertices) for obj in meshes]),
+    }
+    np.savez_compressed(output_filepath, **skinning)
+    print(f"✅ {len(meshes)} 個のメッシュ ({len(skinning['vertices'])} 頂点) のウェイトを書き出しました: {output_filepath}")
+    return skinning
+
+def validate_numpy_lbs(skinning_filepath=SKINNING_FILE, tolerance=1e-3):
+    """現在のポーズで、Blenderで変形したメッシュと numpy_lbs の結果を比較する"""
+    armature = bpy.data.objects[ARMATURE_NAME]
+    bpy.context.view_layer.update()
+    blender_vertices = get_evaluated_vertices(find_character_meshes(armature))
+
+    rest = collect_armature_rest(armature)
+    snapshot = ArmatureSnapshot(armature)
+    numpy_vertices = numpy_lbs.deform_vertices(rest, snapshot.matrices[np.newaxis], numpy_lbs.load_skinning(skinning_filepath))[0]
+
+    max_error = float(np.abs(blender_vertices - numpy_vertices).max())
+    if max_error <= tolerance:
+        print(f"✅ numpy_lbs の結果が一致しました (最大誤差 {max_error:.2e})")
+    else:
+        print(f"❌ numpy_lbs の結果が一致しません (最大誤差 {max_error:.2e} > {tolerance:.0e})")
+    return max_error
+
+def validate_numpy_fk(npz_filepath, tolerance=1e-4):
+    """Blenderでポーズをつけた結果 (get_keypoint3d) と numpy_fk の結果を比較する"""
+    armature = bpy.data.objects[ARMATURE_NAME]
+    scene = bpy.context.scene
+    camera = bpy.data.objects.get(CAMERA_NAMES[0])
+
+    keypoints_list = load_keypoints_data_from_npz(npz_filepath, SCALE_FACTOR)
+    if keypoints_list is None:
+        return None
+
+    # Blender でのポーズ適用とキーポイントの取得
+    if USE_FUSED_POSE:
+        apply_pose_fused(armature, keypoints_list)
+    else:
+        apply_clear_pose_fk_method(armature)
+        apply_pose_fk_method(armature, keypoints_list)
+    bpy.context.view_layer.update()
+    keypoint_3d = get_keypoint3d(scene, camera, ARMATURE_NAME)
+    blender_keypoints = np.array([list(keypoint_3d[k])[:3] for k in sorted(keypoint_3d.keys(), key=lambda x: int(x))])
+
+    # NumPy での FK
+    rest = collect_armature_rest(armature)
+    use_clear_correction = USE_FUSED_POSE and USE_CLEAR_CORRECTION
+    numpy_keypoints = numpy_fk.compute_keypoints3d(rest, np.array([list(kp) for kp in keypoints_list]), use_clear_correction)[0]
+
+    max_error = float(np.abs(blender_keypoints - numpy_keypoints).max())
+    if max_error <= tolerance:
+        print(f"✅ numpy_fk の結果が一致しました (最大誤差 {max_error:.2e})")
+    else:
+        print(f"❌ numpy_fk の結果が一致しません (最大誤差 {max_error:.2e} > {tolerance:.0e})")
+    return max_error
 
 # ====================================================================
 # 2. メイン実行関数
@@ -571,7 +1879,7 @@ def run_pose_application(npz_filepath):
         print(f"❌ エラー: アーマチュア '{ARMATURE_NAME}' がシーンに見つかりません。")
         return
         
-    keypoints_list = load_keypoints_data_from_npz(npz_filepath, DATA_KEY_NAME)
+    keypoints_list = load_keypoints_data_from_npz(npz_filepath, SCALE_FACTOR)
     
     #print(str(keypoints_list[0]))
     
@@ -579,7 +1887,12 @@ def run_pose_application(npz_filepath):
         print("処理を中断します。")
         return
         
-    apply_pose_fk_method(armature, keypoints_list)
+    if USE_IK_REFINEMENT:
+        apply_pose_ik_refined(armature, keypoints_list)
+    elif USE_FUSED_POSE:
+        apply_pose_fused(armature, keypoints_list)
+    else:
+        apply_pose_fk_method(armature, keypoints_list)
 
 # ====================================================================
 # 複数のnpzファイルを読み込む
@@ -592,36 +1905,96 @@ def read_npz_files():
     if not files:
         print("ファイルが見つかりませんでした。")
     else:
+        # カメラのキャリブレーションはフレームごとではなく、実行ごとに1回だけ書き出す
+        scene = bpy.context.scene
+        setup_render_settings(scene, OUTPUT_DIR, render_image_format())
+        # レンダリングするカメラだけでなく、シーンの全カメラをキャッシュしてキャリブレーションに書き出す
+        camera_names = scene_camera_names(scene)
+        camera_names += [name for name in CAMERA_NAMES if name not in camera_names]
+        sample_camera_tracks(scene, camera_names, [scene_frame_for_image(scene, n + 1) for n in range(len(files))])
+        export_camera_calibration(scene)
+        if VISIBILITY_MODE == 'depth':
+            setup_depth_pass(scene)
+        if USE_EXR_RENDER:
+            setup_exr_render(scene)
+
+        # ボーンの長さの合わせ込みはフレームごとではなく、シーケンスごとに1回だけ行う
+        if USE_RETARGET:
+            retarget_sequence(bpy.data.objects[ARMATURE_NAME])
+        IK_WARM_START.clear()
+        VISIBILITY_CACHE.reset()
+        IK_STATS['iterations'].clear()
+        IK_STATS['times'].clear()
+
         for f in files:
             print(str(f))
             generate_anotation_from_frame(f, image_number)
             image_number = image_number + 1
 
+        if USE_IK_REFINEMENT and IK_STATS['iterations']:
+            print(f"IK微調整: 反復回数 平均 {np.mean(IK_STATS['iterations']):.1f} / 最大 {np.max(IK_STATS['iterations'])}, "
+                  f"1フレームあたり 平均 {np.mean(IK_STATS['times']) * 1000:.1f} ms / 最大 {np.max(IK_STATS['times']) * 1000:.1f} ms")
+
+        if VISIBILITY_MODE == 'bvh' and USE_VISIBILITY_CACHE:
+            VISIBILITY_CACHE.report()
+
+        # ポーズの再現精度 (MPJPE, ボーンの向き・長さの誤差) と外れ値のフレーム
+        # (Root基準で比較するので、ワールド座標か Root基準の3Dアノテーションを使う)
+        metrics_frame = next((frame for frame in ('world', 'root') if frame in OUTPUT_3D_FRAMES), None)
+        if USE_POSE_METRICS and metrics_frame is None:
+            print("警告: OUTPUT_3D_FRAMES に 'world' も 'root' もないため、ポーズの評価をスキップします。")
+        elif USE_POSE_METRICS:
+            pose_metrics.evaluate_motion(TAGET_DIR, [OUTPUT_3d], os.path.splitext(OUTPUT_3d)[0], num_cameras=len(CAMERA_NAMES),
+                                         scale_factor=SCALE_FACTOR, key=OUTPUT_3D_KEYS[metrics_frame])
+
     print("すべての処理が完了しました。")
 
 # ====================================================================
 # poseをリセットする、poseをつける、レンダリング、アノテーションデータの作成
 # ====================================================================
 def generate_anotation_from_frame(npz_filepath, image_number):
-    print("========================================================================")
-    print("=============================poseのリセット=============================")
-    print("=======================================================================")
-    apply_clear_pose_fk_method(bpy.data.objects["Armature"])
+    # 動くカメラがある場合は、レンダリングとキャッシュに合わせてシーンのフレームを進める
+    scene = bpy.context.scene
+    # (すべて静止している場合はフレームを変えない。内部パラメータが変わるためキャッシュしなかった場合は進める)
+    if is_track_animated(CAMERA_NAMES):
+        scene.frame_set(scene_frame_for_image(scene, image_number))
+
+    if not (USE_FUSED_POSE or USE_IK_REFINEMENT):
+        print("========================================================================")
+        print("=============================poseのリセット=============================")
+        print("=======================================================================")
+        apply_clear_pose_fk_method(bpy.data.objects["Armature"])
     
     print("========================================================================")
     print("=============================poseをつける=============================")
     print("========================================================================")
+    # USE_FUSED_POSE が True の場合はリセットもここで同時に行う
     run_pose_application(npz_filepath)
+
+    # このフレームのボーンの座標を1回だけ読み出し、以降の処理で共有する
+    bpy.context.view_layer.update()
+    snapshot = ArmatureSnapshot(bpy.data.objects[ARMATURE_NAME])
+    if USE_POSE_METRICS:
+        print_frame_metrics(npz_filepath, snapshot)
     
     print("========================================================================")
     print("=============================レンダリング、アノテーションデータの作成=============================")
     print("========================================================================")
-    render_from_multiple_cameras(ARMATURE_NAME, image_number)
+    render_from_multiple_cameras(ARMATURE_NAME, image_number, snapshot)
+
+def print_frame_metrics(npz_filepath, snapshot):
+    """このフレームの入力キーポイントとの誤差を表示する"""
+    keypoints_list = load_keypoints_data_from_npz(npz_filepath, SCALE_FACTOR)
+    if keypoints_list is None:
+        return
+    keypoints = np.array([list(kp) for kp in keypoints_list])
+    metrics = pose_metrics.compute_pose_metrics(keypoints[np.newaxis], snapshot.keypoints_world()[np.newaxis, np.newaxis])
+    print(f"MPJPE: {metrics['mpjpe'][0, 0] * 1000:.1f} mm, ボーンの向きの誤差: 平均 {np.nanmean(metrics['angle_error']):.2f} deg")
     
 # ====================================================================
 # 連想配列を2次元配列に変換
 # ====================================================================
-def arrange_keypoint(keypoint_data, output_filepath, numpy_key):
+def keypoint_to_array(keypoint_data):
     # 2. 辞書の要素を順番に取り出して2次元配列にする
     # キーを整数(int)として評価して昇順に並べ替えます
     sorted_keys = sorted(keypoint_data.keys(), key=lambda x: int(x))
@@ -630,7 +2003,10 @@ def arrange_keypoint(keypoint_data, output_filepath, numpy_key):
     two_d_list = [keypoint_data[k] for k in sorted_keys]
 
     # 3. NumPy配列に変換（形状: 行数 x 要素数）
-    two_d_array = np.array(two_d_list)
+    return np.array(two_d_list)
+
+def arrange_keypoint(keypoint_data, output_filepath, numpy_key):
+    two_d_array = keypoint_to_array(keypoint_data)
 
     generate_npz_file(output_filepath, two_d_array, numpy_key)
 
@@ -657,27 +2033,41 @@ def arrange_keypoint(keypoint_data, output_filepath, numpy_key):
 
 #     np.savez_compressed(output_filepath, **{key: combined_data})
 def generate_npz_file(output_filepath, keypoint, key):
+    generate_npz_arrays(output_filepath, {key: keypoint})
+
+def generate_npz_arrays(output_filepath, arrays):
+    """複数のキーの配列をまとめて追記する (ファイル内のほかのキーはそのまま残す)"""
     # keypoint の形状が (17, 4) の場合、(1, 17, 4) に変換して「1フレーム分」として扱う
-    if keypoint.ndim == 2:
-        keypoint = keypoint[np.newaxis, ...]
+    # bbox (4,) などの1フレーム分の値も同じく (1, 4) にする
+    arrays = {key: (np.asarray(keypoint)[np.newaxis, ...] if np.ndim(keypoint) <= 2 else keypoint)
+              for key, keypoint in arrays.items()}
 
+    combined = {}
     if os.path.exists(output_filepath) and os.path.getsize(output_filepath) > 0:
         # 1. 既存データの読み込み
         with np.load(output_filepath, allow_pickle=True) as data:
-            combined_data = data[key]
-        
-        # 2. 0番目の軸（フレーム軸）方向に結合
-        # これにより (N, 17, 4) + (1, 17, 4) = (N+1, 17, 4) になる
-        combined_data = np.concatenate([combined_data, keypoint], axis=0)
+            combined = {key: data[key] for key in data.files}
     else:
-        # 新規作成時は (1, 17, 4) の状態で保存
-        combined_data = keypoint
         print(f"新規ファイルとして作成を開始します: {output_filepath}")
 
-    np.savez_compressed(output_filepath, **{key: combined_data})
+    # 2. 0番目の軸（フレーム軸）方向に結合
+    # これにより (N, 17, 4) + (1, 17, 4) = (N+1, 17, 4) になる
+    for key, keypoint in arrays.items():
+        if key in combined:
+            combined[key] = np.concatenate([combined[key], keypoint], axis=0)
+        else:
+            # 新規作成時は (1, 17, 4) の状態で保存
+            combined[key] = keypoint
+
+    np.savez_compressed(output_filepath, **combined)
 
 # 実行
 if __name__ == "__main__":
+    if CAMERA_PLACEMENT_FILE:
+        if os.path.exists(CAMERA_PLACEMENT_FILE):
+            CAMERA_NAMES = create_cameras_from_calibration(CAMERA_PLACEMENT_FILE)
+        else:
+            print(f"警告: '{CAMERA_PLACEMENT_FILE}' が見つかりません。CAMERA_NAMES のカメラを使います。")
     read_npz_files()
     # print("========================================================================")
     # print("=============================poseのリセット=============================")
@@ -0,0 +1,212 @@
+import os
+import glob
+import time
+import struct
+import zlib
+import numpy as np
+
+# ====================================================================
+# マルチレイヤー EXR の読み込み (Blender・OpenEXR不要)
+# edit_pose_ver16.py の USE_EXR_RENDER で書き出した EXR (カメラ × フレームごとに1つ) から、
+# 画像・深度・オブジェクトの番号などのパスを NumPy 配列に分け、深度と人物のマスクを書き出す
+# 対応する形式: 1パートのスキャンライン, 圧縮なし / ZIPS / ZIP, HALF / FLOAT / UINT
+# ====================================================================
+
+# --- 設定 ---
+# edit_pose_ver16.py の OUTPUT_DIR (output_{カメラ名}_{フレーム番号}.exr)
+EXR_DIR = './img'
+# 人物のメッシュのオブジェクトの番号 (edit_pose_ver16.py の PERSON_PASS_INDEX と同じ)
+PERSON_PASS_INDEX = 1
+# 書き出し先 (None なら EXR と同じフォルダに同じ名前の .npz)
+OUTPUT_DIR = None
+# --------------------
+
+# Blenderのパス名 (チャンネル名は "ビューレイヤー名.パス名.チャンネル")
+COMBINED_PASS = 'Combined'
+DEPTH_PASS = 'Depth'
+INDEX_PASS = 'IndexOB'
+
+EXR_MAGIC = 20000630
+# version のフラグ (タイル形式, ディープデータ, マルチパート)
+UNSUPPORTED_FLAGS = 0x200 | 0x800 | 0x1000
+
+PIXEL_TYPES = {0: np.dtype('<u4'), 1: np.dtype('<f2'), 2: np.dtype('<f4')}
+# 対応する圧縮と1チャンクあたりのスキャンライン数
+COMPRESSION_NAMES = {0: 'NONE', 1: 'RLE', 2: 'ZIPS', 3: 'ZIP', 4: 'PIZ', 5: 'PXR24',
+                     6: 'B44', 7: 'B44A', 8: 'DWAA', 9: 'DWAB'}
+SCANLINES_PER_CHUNK = {0: 1, 2: 1, 3: 16}
+# レイヤーの中のチャンネルの並び (EXR ではアルファベット順に保存されている)
+CHANNEL_ORDER = 'RGBAXYZUVW'
+
+# ====================================================================
+# ヘッダー
+# ====================================================================
+def read_string(data, offset):
+    end = data.index(b'\0', offset)
+    return data[offset:end].decode('utf-8'), end + 1
+
+def read_channels(value):
+    """chlist 属性を (チャンネル名, 型, x方向の間引き, y方向の間引き) のリストにする"""
+    channels = []
+    offset = 0
+    while value[offset] != 0:
+        name, offset = read_string(value, offset)
+        # pixel_type (int), pLinear (uchar), 予約 (3バイト), xSampling (int), ySampling (int)
+        pixel_type, _, x_sampling, y_sampling = struct.unpack_from('<iB3xii', value, offset)
+        channels.append((name, PIXEL_TYPES[pixel_type], x_sampling, y_sampling))
+        offset += 16
+    return channels
+
+def read_header(data):
+    """ヘッダーの属性を辞書で返し (channels, compression, dataWindow は値に変換する)、オフセット表の位置も返す"""
+    magic, version = struct.unpack_from('<ii', data, 0)
+    if magic != EXR_MAGIC:
+        raise ValueError("EXR ファイルではありません。")
+    if version & UNSUPPORTED_FLAGS:
+        raise ValueError("タイル形式・ディープデータ・マルチパートの EXR には対応していません。")
+
+    header = {}
+    offset = 8
+    while data[offset] != 0:
+        name, offset = read_string(data, offset)
+        attribute_type, offset = read_string(data, offset)
+        size, = struct.unpack_from('<i', data, offset)
+        value = data[offset + 4:offset + 4 + size]
+        offset += 4 + size
+
+        if attribute_type == 'chlist':
+            header[name] = read_channels(value)
+        elif attribute_type == 'compression':
+            header[name] = value[0]
+        elif attribute_type == 'box2i':
+            header[name] = struct.unpack('<iiii', value)
+        else:
+            header[name] = value
+    return header, offset + 1
+
+# ====================================================================
+# ピクセル
+# ====================================================================
+def undo_zip_predictor(data):
+    """ZIP 圧縮の前処理 (差分と、バイトの並べ替え) を元に戻す"""
+    values = np.frombuffer(data, dtype=np.uint8).astype(np.int64)
+    values[1:] -= 128
+    values = (np.cumsum(values) & 0xff).astype(np.uint8)
+
+    # 前半が偶数番目, 後半が奇数番目のバイト
+    restored = np.empty_like(values)
+    half = (len(values) + 1) // 2
+    restored[0::2] = values[:half]
+    restored[1::2] = values[half:]
+    return restored
+
+def read_exr(filepath):
+    """EXR の全チャンネルを {チャンネル名: (H, W) の配列} で返す (左上原点)"""
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    header, offset = read_header(data)
+
+    compression = header['compression']
+    if compression not in SCANLINES_PER_CHUNK:
+        raise ValueError(f"圧縮 {COMPRESSION_NAMES.get(compression, compression)} には対応していません "
+                         f"({', '.join(COMPRESSION_NAMES[c] for c in SCANLINES_PER_CHUNK)} のみ)。")
+    channels = header['channels']
+    if any(x_sampling != 1 or y_sampling != 1 for _, _, x_sampling, y_sampling in channels):
+        raise ValueError("間引きのあるチャンネルには対応していません。")
+
+    x_min, y_min, x_max, y_max = header['dataWindow']
+    width, height = x_max - x_min + 1, y_max - y_min + 1
+    lines_per_chunk = SCANLINES_PER_CHUNK[compression]
+    num_chunks = (height + lines_per_chunk - 1) // lines_per_chunk
+    chunk_offsets = np.frombuffer(data, dtype='<u8', count=num_chunks, offset=offset)
+
+    # 1行は、チャンネルごとに width 個の値が並ぶ
+    row_bytes = width * sum(dtype.itemsize for _, dtype, _, _ in channels)
+    rows = np.empty((height, row_bytes), dtype=np.uint8)
+    for chunk_offset in chunk_offsets:
+        y, size = struct.unpack_from('<ii', data, int(chunk_offset))
+        start = y - y_min
+        num_lines = min(lines_per_chunk, height - start)
+        chunk = data[int(chunk_offset) + 8:int(chunk_offset) + 8 + size]
+        # 圧縮しても小さくならないチャンクは、そのまま保存されている
+        if compression != 0 and size < num_lines * row_bytes:
+            chunk = undo_zip_predictor(zlib.decompress(chunk))
+        rows[start:start + num_lines] = np.frombuffer(chunk, dtype=np.uint8).reshape(num_lines, row_bytes)
+
+    images = {}
+    column = 0
+    for name, dtype, _, _ in channels:
+        size = width * dtype.itemsize
+        images[name] = rows[:, column:column + size].copy().view(dtype).reshape(height, width)
+        column += size
+    return images
+
+def split_layers(images):
+    """チャンネルを "ビューレイヤー名.パス名" ごとにまとめ、(H, W, チャンネル数) にする"""
+    layers = {}
+    for name in images:
+        layer, _, channel = name.rpartition('.')
+        layers.setdefault(layer, []).append(channel)
+
+    def channel_key(channel):
+        return (CHANNEL_ORDER.index(channel), '') if channel in CHANNEL_ORDER else (len(CHANNEL_ORDER), channel)
+
+    return {layer: np.stack([images[f"{layer}.{channel}" if layer else channel]
+                             for channel in sorted(channels, key=channel_key)], axis=-1)
+            for layer, channels in layers.items()}
+
+def find_pass(layers, pass_name):
+    """パス名 (ビューレイヤー名は問わない) のレイヤーを返す (なければ None)"""
+    for layer, image in layers.items():
+        if layer == pass_name or layer.endswith('.' + pass_name):
+            return image
+    return None
+
+# ====================================================================
+# アノテーション用の配列
+# ====================================================================
+def render_targets(filepath, person_index=PERSON_PASS_INDEX):
+    """1つの EXR から、画像 (H, W, 4), 深度 (H, W), オブジェクトの番号 (H, W), 人物のマスク (H, W) を返す
+
+    オブジェクトの番号のパスがない場合は、アルファ (背景は透明) をマスクとする
+    """
+    layers = split_layers(read_exr(filepath))
+    targets = {}
+    image = find_pass(layers, COMBINED_PASS)
+    if image is not None:
+        targets['image'] = image
+    depth = find_pass(layers, DEPTH_PASS)
+    if depth is not None:
+        targets['depth'] = depth[..., 0].astype(np.float32)
+
+    index = find_pass(layers, INDEX_PASS)
+    if index is not None:
+        targets['object_index'] = np.round(index[..., 0]).astype(np.uint16)
+        targets['mask'] = (targets['object_index'] == person_index).astype(np.uint8)
+    elif image is not None and image.shape[-1] == 4:
+        targets['mask'] = (image[..., 3] > 0).astype(np.uint8)
+    return targets
+
+def convert_exr_directory(exr_dir=EXR_DIR, output_dir=OUTPUT_DIR, person_index=PERSON_PASS_INDEX):
+    """フォルダの全 EXR を読み込み、深度・オブジェクトの番号・人物のマスクを EXR ごとの .npz に書き出す"""
+    files = sorted(glob.glob(os.path.join(exr_dir, '*.exr')))
+    if not files:
+        print("ファイルが見つかりませんでした。")
+        return
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    for filepath in files:
+        targets = render_targets(filepath, person_index)
+        targets.pop('image', None)
+        output_filepath = os.path.join(output_dir or exr_dir, os.path.splitext(os.path.basename(filepath))[0] + '.npz')
+        np.savez_compressed(output_filepath, **targets)
+
+    elapsed = time.perf_counter() - start
+    print(f"✅ {len(files)} 個の EXR を読み込みました ({elapsed:.2f} 秒, 1ファイルあたり "
+          f"{elapsed / len(files) * 1000:.1f} ms): {output_dir or exr_dir}")
+
+# 実行
+if __name__ == "__main__":
+    convert_exr_directory()
@@ -0,0 +1,193 @@
+import time
+import numpy as np
+
+import numpy_fk
+
+# ====================================================================
+# 反復IKでポーズを微調整する
+# rotation_difference による方向だけの解を初期値として、
+# 入力キーポイントとの3D誤差 (Root基準) が小さくなるように全ボーンの回転をまとめて更新する
+# ====================================================================
+
+# --- 設定 ---
+MAX_ITERATIONS = 10
+# 二乗平均誤差の改善量がこれより小さくなったら終了する [m]
+TOLERANCE = 1e-5
+# Levenberg-Marquardt の減衰係数の初期値
+DAMPING = 1e-3
+# --------------------
+
+# Root (spine.001) の head を原点として比較する
+ROOT_BONE_NAME = numpy_fk.BONE_INDEX_MAP_REVERSE[list(numpy_fk.PAIR_LIST)[0]]
+
+# ====================================================================
+# 比較に使う関節と、各関節に影響するボーンの前計算
+# ====================================================================
+def prepare_ik(rest):
+    """関節 (PAIR_LIST の子) ごとに対応するボーンと、その祖先のボーンを求める"""
+    if 'ik' in rest:
+        return rest['ik']
+
+    lookup = rest['bone_lookup']
+    joints = [child for child in numpy_fk.PAIR_LIST if numpy_fk.BONE_INDEX_MAP_REVERSE[child] in lookup]
+    joint_bones = np.array([lookup[numpy_fk.BONE_INDEX_MAP_REVERSE[child]] for child in joints])
+
+    # 最適化するのはキーポイントを持つボーンのみ (feet などは動かさない)
+    bones = np.array(sorted({lookup[name] for name in numpy_fk.BONE_INDEX_MAP_REVERSE.values() if name in lookup}))
+
+    # influence[j, k] : ボーン bones[k] が関節 j の祖先 (自身を含む) かどうか
+    influence = np.zeros((len(joints), len(bones)), dtype=bool)
+    position = {bone: k for k, bone in enumerate(bones)}
+    for j, bone in enumerate(joint_bones):
+        while bone >= 0:
+            if bone in position:
+                influence[j, position[bone]] = True
+            bone = rest['parent_index'][bone]
+
+    rest['ik'] = {
+        'joints': np.array(joints),
+        'joint_bones': joint_bones,
+        'bones': bones,
+        'influence': influence,
+        'root_bone': lookup[ROOT_BONE_NAME],
+    }
+    return rest['ik']
+
+def skew(vectors):
+    """(..., 3) のベクトルから外積行列 (..., 3, 3) を作る (skew(a) @ b = a x b)"""
+    x, y, z = np.moveaxis(vectors, -1, 0)
+    zero = np.zeros_like(x)
+    return np.stack([zero, -z, y, z, zero, -x, -y, x, zero], axis=-1).reshape(vectors.shape + (3,))
+
+def axis_angle_to_matrix(vectors):
+    """(..., 3) の回転ベクトルを回転行列に変換する (ロドリゲスの公式)"""
+    angle = np.linalg.norm(vectors, axis=-1)[..., np.newaxis, np.newaxis]
+    k = skew(numpy_fk.normalize(vectors))
+    identity = np.broadcast_to(np.eye(3), k.shape)
+    return identity + np.sin(angle) * k + (1 - np.cos(angle)) * (k @ k)
+
+# ====================================================================
+# 1フレーム分の誤差とヤコビアン
+# ====================================================================
+def evaluate(rest, quaternions, target):
+    """Root基準の関節位置の残差 (J, 3) と、ボーンの head・ワールド回転を返す"""
+    ik = prepare_ik(rest)
+    heads, tails, pose_matrix = numpy_fk.forward_kinematics(rest, quaternions[np.newaxis])
+    heads, tails = heads[0], tails[0]
+
+    root = heads[ik['root_bone']]
+    joints = tails[ik['joint_bones']] - root
+    target_joints = target[ik['joints']] - target[numpy_fk.PAIR_LIST[list(numpy_fk.PAIR_LIST)[0]]]
+
+    # スケールを除いたボーンのワールド回転
+    world_rotation = rest['matrix_world'][:3, :3] @ pose_matrix[0, :, :3, :3]
+    world_rotation = world_rotation / np.linalg.norm(world_rotation, axis=-2, keepdims=True)
+    return target_joints - joints, joints + root, heads, world_rotation
+
+def jacobian(ik, joints, heads):
+    """ボーン (ワールド空間の微小回転) に対する関節位置の偏微分 (3J, 3K)"""
+    # d(p_j) / d(w_b) = w_b x (p_j - head_b) → -skew(p_j - head_b)
+    offsets = joints[:, np.newaxis, :] - heads[ik['bones']][np.newaxis, :, :]
+    blocks = -skew(offsets) * ik['influence'][..., np.newaxis, np.newaxis]
+    num_joints, num_bones = ik['influence'].shape
+    return blocks.transpose(0, 2, 1, 3).reshape(num_joints * 3, num_bones * 3)
+
+def apply_update(ik, quaternions, world_rotation, delta):
+    """ワールド空間の微小回転を各ボーンのローカル回転に変換して掛け合わせる (全ボーンまとめて)"""
+    bones = ik['bones']
+    rotation = axis_angle_to_matrix(delta.reshape(-1, 3))
+    w = world_rotation[bones]
+    # basis' = basis @ (W^-1 @ R @ W)
+    local_delta = np.swapaxes(w, -1, -2) @ rotation @ w
+    updated = quaternions.copy()
+    updated[bones] = numpy_fk.normalize(numpy_fk.quaternion_multiply(quaternions[bones], numpy_fk.matrix_to_quaternion(local_delta)))
+    return updated
+
+# ====================================================================
+# 1フレーム分の反復IK
+# ====================================================================
+def refine_frame(rest, quaternions, target, max_iterations=MAX_ITERATIONS, tolerance=TOLERANCE, damping=DAMPING):
+    """初期値 (B, 4) から Levenberg-Marquardt で回転を更新し、(回転, 反復回数, 誤差) を返す"""
+    ik = prepare_ik(rest)
+    target = np.asarray(target, dtype=np.float64)
+    quaternions = np.asarray(quaternions, dtype=np.float64).copy()
+
+    residual, joints, heads, world_rotation = evaluate(rest, quaternions, target)
+    error = np.sqrt(np.mean(np.sum(residual ** 2, axis=-1)))
+
+    iterations = 0
+    for iterations in range(1, max_iterations + 1):
+        J = jacobian(ik, joints, heads)
+        JtJ = J.T @ J
+        delta = np.linalg.solve(JtJ + damping * np.eye(JtJ.shape[0]), J.T @ residual.reshape(-1))
+
+        candidate = apply_update(ik, quaternions, world_rotation, delta)
+        candidate_result = evaluate(rest, candidate, target)
+        candidate_error = np.sqrt(np.mean(np.sum(candidate_result[0] ** 2, axis=-1)))
+
+        if candidate_error < error:
+            improvement = error - candidate_error
+            quaternions = candidate
+            residual, joints, heads, world_rotation = candidate_result
+            error = candidate_error
+            damping *= 0.5
+            if improvement < tolerance:
+                break
+        else:
+            # 誤差が増えた場合は更新せず、減衰を強くしてやり直す
+            damping *= 4.0
+            if damping > 1e6:
+                break
+
+    return quaternions, iterations, error
+
+# ====================================================================
+# シーケンス全体 (前フレームの解から開始する)
+# ====================================================================
+def refine_sequence(rest, keypoints, initial_quaternions=None, max_iterations=MAX_ITERATIONS, tolerance=TOLERANCE):
+    """全フレームを順番に微調整し、前フレームの解を次のフレームの初期値に使う"""
+    keypoints = np.asarray(keypoints, dtype=np.float64)
+    if initial_quaternions is None:
+        initial_quaternions = numpy_fk.solve_rotations(rest, keypoints)
+
+    num_frames = keypoints.shape[0]
+    quaternions = np.empty_like(initial_quaternions)
+    iterations = np.zeros(num_frames, dtype=np.int64)
+    errors = np.zeros(num_frames)
+    times = np.zeros(num_frames)
+
+    previous = None
+    for frame in range(num_frames):
+        start = time.perf_counter()
+        quaternions[frame], iterations[frame], errors[frame] = refine_frame_warm(
+            rest, initial_quaternions[frame], previous, keypoints[frame], max_iterations, tolerance)
+        previous = quaternions[frame]
+        times[frame] = time.perf_counter() - start
+
+    print_refine_report(iterations, errors, times)
+    return quaternions, {'iterations': iterations, 'errors': errors, 'times': times}
+
+def refine_frame_warm(rest, initial, previous, target, max_iterations=MAX_ITERATIONS, tolerance=TOLERANCE):
+    """前フレームの解と方向だけの解のうち、誤差が小さい方から反復を始める"""
+    start = initial
+    if previous is not None:
+        initial_error = np.sum(evaluate(rest, initial, target)[0] ** 2)
+        previous_error = np.sum(evaluate(rest, previous, target)[0] ** 2)
+        if previous_error <= initial_error:
+            start = previous
+    return refine_frame(rest, start, target, max_iterations, tolerance)
+
+def print_refine_report(iterations, errors, times):
+    print(f"✅ IK微調整: {len(iterations)} フレーム, "
+          f"反復回数 平均 {np.mean(iterations):.1f} / 最大 {np.max(iterations)}, "
+          f"1フレームあたり 平均 {np.mean(times) * 1000:.2f} ms / 最大 {np.max(times) * 1000:.2f} ms, "
+          f"誤差 (RMS) 平均 {np.mean(errors) * 1000:.1f} mm")
+
+# 実行
+if __name__ == "__main__":
+    rest = numpy_fk.load_armature_rest(numpy_fk.ARMATURE_REST_FILE)
+    files, keypoints = numpy_fk.load_keypoints_sequence(numpy_fk.TAGET_DIR)
+    keypoints = keypoints * numpy_fk.SCALE_FACTOR
+    if numpy_fk.USE_RETARGET:
+        rest = numpy_fk.retarget_armature_rest(rest, numpy_fk.measure_bone_lengths(keypoints))
+    refine_sequence(rest, keypoints)
@@ -0,0 +1,450 @@
+import os
+import glob
+import time
+import numpy as np
+
+# ====================================================================
+# Blenderを使わずにFK（フォワードキネマティクス）を計算する
+# edit_pose_ver16.py の export_armature_rest で書き出したレスト情報を使う
+# ====================================================================
+
+# 【重要】キーポイントインデックスとボーン名の対応付け (edit_pose_ver16.py などもここを参照する)
+BONE_INDEX_MAP = {
+    'spine.001': 7,
+    'spine.002': 8,
+    'head.001': 9,
+    'head.002': 10,
+    'waist.001.l': 4,
+    'waist.001.r': 1,
+    'shoulder.001.l': 11,
+    'arm.001.l': 12,
+    'arm.002.l': 13,
+    'shoulder.001.r': 14,
+    'arm.001.r': 15,
+    'arm.002.r': 16,
+    'leg.001.l': 5,
+    'leg.002.l': 6,
+    'feet.001.l': 0,
+    'leg.001.r': 2,
+    'leg.002.r': 3,
+    'feet.001.r': 0,
+}
+
+BONE_INDEX_MAP_REVERSE = {
+    7: 'spine.001',
+    8: 'spine.002',
+    9: 'head.001',
+    10: 'head.002',
+    4: 'waist.001.l',
+    1: 'waist.001.r',
+    11: 'shoulder.001.l',
+    12: 'arm.001.l',
+    13: 'arm.002.l',
+    14: 'shoulder.001.r',
+    15: 'arm.001.r',
+    16: 'arm.002.r',
+    5: 'leg.001.l',
+    6: 'leg.002.l',
+    2: 'leg.001.r',
+    3: 'leg.002.r'
+}
+
+PAIR_LIST = {
+    7: 0,
+    8: 7,
+    11: 8,
+    12: 11,
+    13: 12,
+    9: 8,
+    10: 9,
+    14: 8,
+    15: 14,
+    16: 15,
+    4: 0,
+    5: 4,
+    6: 5,
+    1: 0,
+    2: 1,
+    3: 2
+}
+
+# 回転の計算に用いる, 子ボーンのtail：親ボーンのtail
+PARENT_LIST = {
+    8: 7,
+    9: 8,
+    10: 9,
+    11: 8,
+    12: 11,
+    13: 12,
+    14: 8,
+    15: 14,
+    16: 15,
+    1: 7,
+    2: 1,
+    3: 2,
+    4: 7,
+    5: 4,
+    6: 5
+}
+
+NUM_KEYPOINTS = 17
+
+# Root (骨盤) のキーポイントと、左右の腰のキーポイント
+# 3Dアノテーションのキーポイント0は feet.001.l / r の tail で上書きされているため、
+# Root には左右の腰の中点を使う (入力キーポイントの0とほぼ同じ位置)
+ROOT_INDEX = 0
+HIP_INDICES = [1, 4]
+
+# --- 設定 ---
+TAGET_DIR = './m1_npz'
+EXTENSION = 'npz'
+
+# edit_pose_ver16.py で書き出したアーマチュアのレスト情報
+ARMATURE_REST_FILE = 'armature_rest.npz'
+
+# アノテーションデータの書き出し先ファイル
+OUTPUT_3d = 'numpy_fk_3d_anotation.npz'
+
+# 以下は edit_pose_ver16.py などでも共通の設定 (ここだけで変更する)
+# リセットの回転 (calculate_clear_rotation) を目標の回転に合成する
+# (True にすると従来の2段階処理とポーズが変わる。False なら結果は従来と同じ)
+USE_CLEAR_CORRECTION = False
+
+# 入力キーポイントのスケールと、シーケンスごとのボーンの長さの合わせ込み
+# USE_RETARGET は edit_pose_ver16.py ではアーマチュアのエディットボーンを書き換える (.blend が変更される)。
+# スキンのメッシュはバインドし直さないので、レンダリング・bbox・遮蔽・マスクはキーポイントと合わなくなる
+SCALE_FACTOR = 1.0
+USE_RETARGET = False
+# --------------------
+
+# ====================================================================
+# クォータニオン (w, x, y, z) の計算
+# ====================================================================
+def normalize(vectors, eps=1e-12):
+    """最後の軸で正規化する (長さ0のベクトルは0のまま)"""
+    vectors = np.asarray(vectors, dtype=np.float64)
+    norm = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.where(norm > eps, vectors / np.maximum(norm, eps), 0.0)
+
+def quaternion_multiply(q1, q2):
+    """q1 @ q2 (mathutils.Quaternion と同じ順番) をまとめて計算する"""
+    w1, x1, y1, z1 = np.moveaxis(np.asarray(q1, dtype=np.float64), -1, 0)
+    w2, x2, y2, z2 = np.moveaxis(np.asarray(q2, dtype=np.float64), -1, 0)
+    return np.stack([
+        w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+        w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+        w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+        w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2,
+    ], axis=-1)
+
+def quaternion_to_matrix(quaternions):
+    """(..., 4) のクォータニオンを (..., 3, 3) の回転行列に変換する"""
+    q = normalize(quaternions)
+    w, x, y, z = np.moveaxis(q, -1, 0)
+    matrix = np.stack([
+        1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y),
+        2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x),
+        2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y),
+    ], axis=-1)
+    return matrix.reshape(q.shape[:-1] + (3, 3))
+
+def matrix_to_quaternion(matrices):
+    """(..., 3, 3) の回転行列を (..., 4) のクォータニオンに変換する (w >= 0)"""
+    m = np.asarray(matrices, dtype=np.float64)
+    m00, m01, m02 = m[..., 0, 0], m[..., 0, 1], m[..., 0, 2]
+    m10, m11, m12 = m[..., 1, 0], m[..., 1, 1], m[..., 1, 2]
+    m20, m21, m22 = m[..., 2, 0], m[..., 2, 1], m[..., 2, 2]
+
+    # 4通りの候補から、分母が一番大きいものを選ぶ (数値的に安定)
+    candidates = np.stack([
+        np.stack([1 + m00 + m11 + m22, m21 - m12, m02 - m20, m10 - m01], axis=-1),
+        np.stack([m21 - m12, 1 + m00 - m11 - m22, m01 + m10, m02 + m20], axis=-1),
+        np.stack([m02 - m20, m01 + m10, 1 - m00 + m11 - m22, m12 + m21], axis=-1),
+        np.stack([m10 - m01, m02 + m20, m12 + m21, 1 - m00 - m11 + m22], axis=-1),
+    ], axis=-2)
+    diagonal = np.stack([m00 + m11 + m22, m00, m11, m22], axis=-1)
+    best = np.argmax(diagonal, axis=-1)
+    q = np.take_along_axis(candidates, best[..., np.newaxis, np.newaxis], axis=-2)[..., 0, :]
+    q = normalize(q)
+    return np.where(q[..., :1] < 0, -q, q)
+
+def rotation_difference(vec_from, vec_to):
+    """Vector.rotation_difference と同じく、vec_from を vec_to に向ける最短回転を求める"""
+    a = normalize(vec_from)
+    b = normalize(vec_to)
+    dot = np.sum(a * b, axis=-1)
+    q = np.concatenate([(1.0 + dot)[..., np.newaxis], np.cross(a, b)], axis=-1)
+
+    # 真逆を向いている場合は、a に直交する任意の軸で180度回転させる
+    opposite = (1.0 + dot) < 1e-8
+    if np.any(opposite):
+        helper = np.where(np.abs(a[..., :1]) < 0.9, [1.0, 0.0, 0.0], [0.0, 1.0, 0.0])
+        axis = normalize(np.cross(a, helper))
+        q = np.where(opposite[..., np.newaxis], np.concatenate([np.zeros_like(dot)[..., np.newaxis], axis], axis=-1), q)
+
+    # ゼロベクトルが含まれる場合は単位クォータニオン
+    degenerate = (np.linalg.norm(a, axis=-1) == 0) | (np.linalg.norm(b, axis=-1) == 0)
+    q[degenerate] = (1.0, 0.0, 0.0, 0.0)
+    return normalize(q)
+
+# ====================================================================
+# アーマチュアのレスト情報を読み込む
+# ====================================================================
+def load_armature_rest(filepath=ARMATURE_REST_FILE):
+    """export_armature_rest で書き出したnpzを読み込み、FKに必要な値を前計算する"""
+    with np.load(filepath, allow_pickle=False) as data:
+        rest = {key: data[key] for key in data.files}
+
+    rest['bone_names'] = [str(name) for name in rest['bone_names']]
+    return prepare_armature_rest(rest)
+
+def prepare_armature_rest(rest):
+    """親子関係から処理順と、親から見たレスト行列 (offset) を前計算する"""
+    parent_index = np.asarray(rest['parent_index'], dtype=np.int64)
+    matrix_local = np.asarray(rest['matrix_local'], dtype=np.float64)
+
+    # 親が先に来るように並べる
+    order = []
+    visited = set()
+    def visit(bone):
+        if bone in visited:
+            return
+        if parent_index[bone] >= 0:
+            visit(parent_index[bone])
+        visited.add(bone)
+        order.append(bone)
+    for bone in range(len(parent_index)):
+        visit(bone)
+
+    # offset = 親のレスト行列の逆行列 @ 自分のレスト行列 (Rootはレスト行列そのもの)
+    offset = matrix_local.copy()
+    has_parent = parent_index >= 0
+    offset[has_parent] = np.linalg.inv(matrix_local[parent_index[has_parent]]) @ matrix_local[has_parent]
+
+    rest['parent_index'] = parent_index
+    rest['matrix_local'] = matrix_local
+    rest['length'] = np.asarray(rest['length'], dtype=np.float64)
+    rest['matrix_world'] = np.asarray(rest['matrix_world'], dtype=np.float64)
+    rest['order'] = np.asarray(order, dtype=np.int64)
+    rest['offset'] = offset
+    rest['bone_lookup'] = {name: i for i, name in enumerate(rest['bone_names'])}
+    return rest
+
+# ====================================================================
+# シーケンスごとのボーンの長さ
+# ====================================================================
+def measure_bone_lengths(keypoints):
+    """(F, 17, 3) のキーポイントから PAIR_LIST の各ボーンの長さ (全フレームの中央値) を求める"""
+    keypoints = np.asarray(keypoints, dtype=np.float64)
+    children = list(PAIR_LIST.keys())
+    parents = list(PAIR_LIST.values())
+    lengths = np.linalg.norm(keypoints[:, children] - keypoints[:, parents], axis=-1)
+    medians = np.nanmedian(lengths, axis=0)
+    return {BONE_INDEX_MAP_REVERSE[child]: float(length) for child, length in zip(children, medians) if np.isfinite(length)}
+
+def retarget_armature_rest(rest, bone_lengths):
+    """ボーンの向きはそのままで長さを変え、子ボーンの head を親の tail に合わせて移動する"""
+    matrix_local = rest['matrix_local'].copy()
+    length = rest['length'].copy()
+    # ワールド座標の長さをアーマチュア空間の長さに変換する
+    scale = np.cbrt(abs(np.linalg.det(rest['matrix_world'][:3, :3])))
+
+    tail_offsets = np.zeros((len(length), 3))
+    for bone in rest['order']:
+        parent = rest['parent_index'][bone]
+        old_tail = matrix_local[bone, :3, 3] + matrix_local[bone, :3, 1] * length[bone]
+        if parent >= 0:
+            matrix_local[bone, :3, 3] += tail_offsets[parent]
+        name = rest['bone_names'][bone]
+        if name in bone_lengths:
+            length[bone] = bone_lengths[name] / scale
+        new_tail = matrix_local[bone, :3, 3] + matrix_local[bone, :3, 1] * length[bone]
+        tail_offsets[bone] = new_tail - old_tail
+
+    retargeted = {key: rest[key] for key in ('bone_names', 'parent_index', 'matrix_world')}
+    retargeted['matrix_local'] = matrix_local
+    retargeted['length'] = length
+    return prepare_armature_rest(retargeted)
+
+# ====================================================================
+# ボーンの向きを同じ方向にそろえる回転 (calculate_clear_rotation のNumPy版)
+# ====================================================================
+def clear_rotations(rest):
+    """子ボーンを親ボーン (PARENT_LIST) と同じ向きにする (B, 4) のローカル回転を求める"""
+    num_bones = len(rest['bone_names'])
+    quaternions = np.zeros((num_bones, 4))
+    quaternions[:, 0] = 1.0
+
+    for pair in list(PAIR_LIST)[1:]:
+        if pair not in PARENT_LIST:
+            continue
+        bone_name = BONE_INDEX_MAP_REVERSE.get(pair)
+        parent_bone_name = BONE_INDEX_MAP_REVERSE.get(PARENT_LIST[pair])
+        if bone_name not in rest['bone_lookup'] or parent_bone_name not in rest['bone_lookup']:
+            continue
+        bone = rest['bone_lookup'][bone_name]
+        parent = rest['bone_lookup'][parent_bone_name]
+
+        # Local_Diff = (Child_Rest_Matrix^-1) @ Target_Matrix (Target は親のレスト行列)
+        m_diff = np.linalg.inv(rest['matrix_local'][bone]) @ rest['matrix_local'][parent]
+        quaternions[bone] = matrix_to_quaternion(m_diff[:3, :3])
+    return quaternions
+
+# ====================================================================
+# キーポイントから各ボーンの回転を求める (calculate_rotation_from_npz のバッチ版)
+# ====================================================================
+def solve_rotations(rest, keypoints, use_clear_correction=USE_CLEAR_CORRECTION):
+    """(F, 17, 3) のキーポイントから (F, B, 4) のポーズ回転を求める"""
+    keypoints = np.asarray(keypoints, dtype=np.float64)
+    if keypoints.ndim == 2:
+        keypoints = keypoints[np.newaxis]
+    num_frames = keypoints.shape[0]
+    num_bones = len(rest['bone_names'])
+
+    quaternions = np.zeros((num_frames, num_bones, 4))
+    quaternions[..., 0] = 1.0
+
+    bone_indices, child, child_parent, parent, parent_parent = [], [], [], [], []
+    # PAIR_LIST の最初の要素は基準として保持するのでスキップする
+    for pair in list(PAIR_LIST)[1:]:
+        if pair not in PARENT_LIST:
+            continue
+        bone_name = BONE_INDEX_MAP_REVERSE.get(pair)
+        if bone_name not in rest['bone_lookup']:
+            continue
+        bone_indices.append(rest['bone_lookup'][bone_name])
+        child.append(pair)
+        child_parent.append(PAIR_LIST[pair])
+        parent.append(PARENT_LIST[pair])
+        parent_parent.append(PAIR_LIST[PARENT_LIST[pair]])
+
+    # 親ボーンの方向ベクトルから子ボーンの方向ベクトルへの回転
+    parent_vec = keypoints[:, parent] - keypoints[:, parent_parent]
+    target_vec = keypoints[:, child] - keypoints[:, child_parent]
+    quaternions[:, bone_indices] = rotation_difference(parent_vec, target_vec)
+
+    # リセットの回転の後に目標の回転を適用する (apply_pose_fused と同じ合成)
+    if use_clear_correction:
+        quaternions = quaternion_multiply(clear_rotations(rest)[np.newaxis], quaternions)
+    return quaternions
+
+# ====================================================================
+# FK本体
+# ====================================================================
+def forward_kinematics(rest, quaternions):
+    """(F, B, 4) の回転から全ボーンのワールド座標の head / tail と行列を求める"""
+    quaternions = np.asarray(quaternions, dtype=np.float64)
+    if quaternions.ndim == 2:
+        quaternions = quaternions[np.newaxis]
+    num_frames, num_bones = quaternions.shape[:2]
+
+    # pose_bone.location は0にリセットしているので、回転のみのローカル行列
+    basis = np.zeros((num_frames, num_bones, 4, 4))
+    basis[..., :3, :3] = quaternion_to_matrix(quaternions)
+    basis[..., 3, 3] = 1.0
+    local = rest['offset'][np.newaxis] @ basis
+
+    # 親 → 子の順番で、フレーム方向はまとめて行列を合成する
+    pose_matrix = np.empty_like(local)
+    parent_index = rest['parent_index']
+    for bone in rest['order']:
+        parent = parent_index[bone]
+        if parent < 0:
+            pose_matrix[:, bone] = local[:, bone]
+        else:
+            pose_matrix[:, bone] = pose_matrix[:, parent] @ local[:, bone]
+
+    # アーマチュア空間 → ワールド空間
+    world_matrix = rest['matrix_world'] @ pose_matrix
+    heads = world_matrix[..., :3, 3]
+    tails = heads + world_matrix[..., :3, 1] * rest['length'][np.newaxis, :, np.newaxis]
+    return heads, tails, pose_matrix
+
+def bones_to_keypoints(rest, heads, tails):
+    """get_keypoint3d と同じ規則で、ボーンの head / tail を17点のキーポイントに並べる"""
+    # ボーンの並び順に上書きしていくので、最後に書き込んだものを採用する
+    source = {}
+    for bone, name in enumerate(rest['bone_names']):
+        if name not in BONE_INDEX_MAP:
+            continue
+        source[BONE_INDEX_MAP[name]] = (bone, False)
+        if name == 'spine.001':
+            source[0] = (bone, True)
+
+    keypoints = np.zeros(heads.shape[:-2] + (NUM_KEYPOINTS, 3))
+    for index, (bone, use_head) in source.items():
+        keypoints[..., index, :] = heads[..., bone, :] if use_head else tails[..., bone, :]
+    return keypoints
+
+def compute_keypoints3d(rest, keypoints, use_clear_correction=USE_CLEAR_CORRECTION):
+    """入力キーポイントからFKで求めた17点のワールド座標を返す"""
+    quaternions = solve_rotations(rest, keypoints, use_clear_correction)
+    heads, tails, _ = forward_kinematics(rest, quaternions)
+    return bones_to_keypoints(rest, heads, tails)
+
+# ====================================================================
+# Root (骨盤)
+# ====================================================================
+def root_position(keypoints):
+    """(..., 17, 3) の左右の腰の中点を Root の位置 (..., 3) とする"""
+    return np.asarray(keypoints, dtype=np.float64)[..., HIP_INDICES, :].mean(axis=-2)
+
+def replace_root(keypoints):
+    """キーポイント0を左右の腰の中点に置き換えた配列を返す (0につながるボーンも腰の中点から求め直す)"""
+    keypoints = np.array(keypoints, dtype=np.float64)
+    keypoints[..., ROOT_INDEX, :] = root_position(keypoints)
+    return keypoints
+
+# ====================================================================
+# npzファイルをまとめて読み込む
+# ====================================================================
+def load_keypoints_sequence(target_dir=TAGET_DIR, extension=EXTENSION):
+    """ディレクトリ内のnpzを名前順に読み込み、(F, 17, 3) の配列にまとめる"""
+    files = []
+    frames = []
+    for f in sorted(glob.glob(os.path.join(target_dir, f'*.{extension}'))):
+        with np.load(f) as data:
+            if 'keypoints_4d' in data:
+                keypoints_data = data['keypoints_4d']
+            elif 'keypoints_3d' in data:
+                keypoints_data = data['keypoints_3d']
+            else:
+                print(f"エラー: {f} に 'keypoints_4d' または 'keypoints_3d' キーが見つかりません。")
+                continue
+
+        # 複数のフレームが含まれている場合、最初のフレーム ([0]) を取得 (ver16と同じ)
+        if keypoints_data.ndim == 3:
+            keypoints_data = keypoints_data[0]
+        # 読み込めなかったファイルは files にも含めない (files と配列のフレームを対応させる)
+        files.append(f)
+        frames.append(keypoints_data[:, :3])
+
+    if not frames:
+        return files, np.zeros((0, NUM_KEYPOINTS, 3))
+    return files, np.stack(frames).astype(np.float64)
+
+# ====================================================================
+# Blenderなしで3Dアノテーションだけを作成する
+# ====================================================================
+def run_annotation_only(target_dir=TAGET_DIR, rest_filepath=ARMATURE_REST_FILE, output_filepath=OUTPUT_3d):
+    rest = load_armature_rest(rest_filepath)
+    files, keypoints = load_keypoints_sequence(target_dir)
+    if len(files) == 0:
+        print("ファイルが見つかりませんでした。")
+        return None
+
+    start = time.perf_counter()
+    keypoints = keypoints * SCALE_FACTOR
+    if USE_RETARGET:
+        rest = retarget_armature_rest(rest, measure_bone_lengths(keypoints))
+    keypoints_3d = compute_keypoints3d(rest, keypoints)
+    elapsed = time.perf_counter() - start
+
+    np.savez_compressed(output_filepath, S=keypoints_3d)
+    print(f"✅ {len(files)} フレームのFKが完了しました ({elapsed * 1000:.1f} ms): {output_filepath}")
+    print("\n形状 (フレーム数, キーポイント数, 座標):", keypoints_3d.shape)
+    return keypoints_3d
+
+# 実行
+if __name__ == "__main__":
+    run_annotation_only()
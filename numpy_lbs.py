@@ -0,0 +1,103 @@
+import time
+import numpy as np
+
+import numpy_fk
+
+# ====================================================================
+# NumPyによる線形ブレンドスキニング (Blender不要)
+# edit_pose_ver16.py の export_skinning で書き出したメッシュ (レストの頂点, 三角形, ウェイト) を
+# numpy_fk のボーンの行列で、複数フレームまとめて変形する
+# ====================================================================
+
+# --- 設定 ---
+# edit_pose_ver16.py で書き出した人物のメッシュとウェイト
+SKINNING_FILE = 'character_skinning.npz'
+# 一度に変形するフレーム数 (メモリの使用量を抑える)
+FRAME_CHUNK = 32
+
+# 変形した頂点の書き出し先ファイル
+OUTPUT_FILE = 'numpy_lbs_vertices.npz'
+# --------------------
+
+# ====================================================================
+# 読み込み
+# ====================================================================
+def load_skinning(filepath=SKINNING_FILE):
+    """メッシュとウェイトを読み込む (頂点はアーマチュア空間のレスト位置)"""
+    with np.load(filepath, allow_pickle=False) as data:
+        skinning = {key: data[key] for key in data.files}
+    skinning['bone_names'] = [str(name) for name in skinning['bone_names']]
+    return skinning
+
+def bind_skinning(rest, skinning):
+    """ウェイトのボーン番号を rest のボーンの並びに合わせる (rest にないボーンのウェイトは0)"""
+    lookup = np.array([rest['bone_lookup'].get(name, -1) for name in skinning['bone_names']], dtype=np.int64)
+    bone_indices = lookup[skinning['bone_indices']]
+    bone_weights = np.where(bone_indices >= 0, skinning['bone_weights'], 0.0).astype(np.float64)
+    return np.maximum(bone_indices, 0), bone_weights
+
+# ====================================================================
+# スキニング
+# ====================================================================
+def skinning_matrices(rest, pose_matrix):
+    """アーマチュア空間でレスト → ポーズに移す行列 (F, B, 4, 4)"""
+    return pose_matrix @ np.linalg.inv(rest['matrix_local'])[np.newaxis]
+
+def deform_vertices(rest, pose_matrix, skinning):
+    """(F, B, 4, 4) のポーズ行列で全頂点を変形し、ワールド座標 (F, V, 3) を返す
+
+    ボーンの行列を頂点ごとにウェイトで混ぜてから1回だけ掛ける。
+    ウェイトの合計が0の頂点は Blender のアーマチュアモディファイアと同じく動かさない
+    """
+    bone_indices, bone_weights = bind_skinning(rest, skinning)
+    vertices = np.asarray(skinning['vertices'], dtype=np.float64)
+    matrices = skinning_matrices(rest, pose_matrix)[..., :3, :]
+
+    blended = np.zeros((matrices.shape[0], len(vertices), 3, 4))
+    for k in range(bone_indices.shape[1]):
+        blended += bone_weights[np.newaxis, :, k, np.newaxis, np.newaxis] * matrices[:, bone_indices[:, k]]
+
+    # ウェイトの合計が1に満たない分は元の位置のまま
+    identity = np.eye(4)[:3]
+    blended += (1.0 - bone_weights.sum(axis=1))[np.newaxis, :, np.newaxis, np.newaxis] * identity
+
+    deformed = np.einsum('fvij,vj->fvi', blended[..., :3], vertices) + blended[..., 3]
+    return deformed @ rest['matrix_world'][:3, :3].T + rest['matrix_world'][:3, 3]
+
+def deform_sequence(rest, quaternions, skinning, frame_chunk=FRAME_CHUNK):
+    """全フレームの回転 (F, B, 4) から、変形した頂点 (F, V, 3) を FRAME_CHUNK フレームずつ求める"""
+    num_frames = quaternions.shape[0]
+    deformed = np.empty((num_frames, len(skinning['vertices']), 3), dtype=np.float32)
+    for start in range(0, num_frames, frame_chunk):
+        _, _, pose_matrix = numpy_fk.forward_kinematics(rest, quaternions[start:start + frame_chunk])
+        deformed[start:start + frame_chunk] = deform_vertices(rest, pose_matrix, skinning)
+    return deformed
+
+# ====================================================================
+# 入力キーポイントから全フレームのメッシュを作る
+# ====================================================================
+def run_skinning(target_dir=numpy_fk.TAGET_DIR, rest_filepath=numpy_fk.ARMATURE_REST_FILE,
+                 skinning_filepath=SKINNING_FILE, output_filepath=OUTPUT_FILE):
+    rest = numpy_fk.load_armature_rest(rest_filepath)
+    skinning = load_skinning(skinning_filepath)
+    files, keypoints = numpy_fk.load_keypoints_sequence(target_dir)
+    if len(files) == 0:
+        print("ファイルが見つかりませんでした。")
+        return None
+
+    start = time.perf_counter()
+    keypoints = keypoints * numpy_fk.SCALE_FACTOR
+    if numpy_fk.USE_RETARGET:
+        rest = numpy_fk.retarget_armature_rest(rest, numpy_fk.measure_bone_lengths(keypoints))
+    quaternions = numpy_fk.solve_rotations(rest, keypoints)
+    deformed = deform_sequence(rest, quaternions, skinning)
+    elapsed = time.perf_counter() - start
+
+    np.savez_compressed(output_filepath, vertices=deformed, triangles=skinning['triangles'])
+    print(f"✅ {len(files)} フレーム × {deformed.shape[1]} 頂点のスキニングが完了しました "
+          f"({elapsed:.2f} 秒, 1フレームあたり {elapsed / len(files) * 1000:.1f} ms): {output_filepath}")
+    return deformed
+
+# 実行
+if __name__ == "__main__":
+    run_skinning()
@@ -0,0 +1,176 @@
+import time
+import numpy as np
+
+# ====================================================================
+# NumPyだけで遮蔽を判定する (Blender不要, ワーカープロセスの中でも使える)
+# ポーズをつけたメッシュの三角形 (トライアングルスープ) に対して、カメラ → 関節の全線分を
+# Möller–Trumbore 法でまとめて判定する。三角形は一様グリッドに登録しておき、線分が通るセルの三角形だけを調べる
+# ====================================================================
+
+# --- 設定 ---
+# edit_pose_ver16.py の export_occlusion_scene で書き出したファイル (頂点, 三角形, カメラ位置, 関節, 判定結果)
+OCCLUSION_SCENE_FILE = 'occlusion_scene.npz'
+# 一様グリッドの最も長い辺の分割数
+GRID_RESOLUTION = 32
+# check_visibility と同じく、関節の手前 0.1 m までを遮蔽の判定に使う
+END_OFFSET = 0.1
+# 交差判定で平行とみなす行列式の大きさ
+EPSILON = 1e-9
+# --------------------
+
+# ====================================================================
+# 一様グリッド
+# ====================================================================
+class UniformGrid:
+    """三角形を AABB が重なるセルに登録した一様グリッド (セルごとの三角形を CSR 形式で保持する)
+
+    線分はセルの半分の間隔で点を取り、その点のセルの三角形を調べる。
+    取りこぼしがないように、三角形の AABB はサンプル間隔の半分だけ広げて登録する
+    """
+    def __init__(self, vertices, triangles, resolution=GRID_RESOLUTION):
+        self.vertices = np.asarray(vertices, dtype=np.float64)
+        self.triangles = np.asarray(triangles, dtype=np.int64)
+        corners = self.vertices[self.triangles]
+
+        low = corners.min(axis=(0, 1)) if len(corners) else np.zeros(3)
+        high = corners.max(axis=(0, 1)) if len(corners) else np.ones(3)
+        self.cell_size = max(float(np.max(high - low)), 1e-6) / resolution
+        self.step = 0.5 * self.cell_size
+        margin = 0.5 * self.step
+        self.origin = low - margin
+        self.shape = np.maximum(np.ceil((high + margin - self.origin) / self.cell_size).astype(np.int64), 1)
+
+        # 三角形ごとのセルの範囲
+        cell_low = self.cell_index(corners.min(axis=1) - margin)
+        cell_high = self.cell_index(corners.max(axis=1) + margin)
+        extent = cell_high - cell_low + 1
+        counts = np.prod(extent, axis=1)
+
+        # 三角形を範囲内の全セルに展開する
+        triangle_ids = np.repeat(np.arange(len(self.triangles)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        nx, ny = extent[triangle_ids, 0], extent[triangle_ids, 1]
+        cells = cell_low[triangle_ids] + np.stack([local % nx, (local // nx) % ny, local // (nx * ny)], axis=-1)
+        cell_ids = self.flatten(cells)
+
+        order = np.argsort(cell_ids, kind='stable')
+        self.cell_triangles = triangle_ids[order]
+        self.offsets = np.zeros(np.prod(self.shape) + 1, dtype=np.int64)
+        np.add.at(self.offsets, cell_ids + 1, 1)
+        self.offsets = np.cumsum(self.offsets)
+
+    def cell_index(self, points):
+        return np.clip(np.floor((points - self.origin) / self.cell_size).astype(np.int64), 0, self.shape - 1)
+
+    def flatten(self, cells):
+        return (cells[..., 2] * self.shape[1] + cells[..., 1]) * self.shape[0] + cells[..., 0]
+
+    def candidate_pairs(self, origins, ends):
+        """線分 (R本) が通るセルの三角形を、重複なしの (線分の番号, 三角形の番号) の組で返す"""
+        length = np.linalg.norm(ends - origins, axis=-1)
+        num_samples = np.ceil(length / self.step).astype(np.int64) + 1
+
+        # 線分ごとにサンプル点を展開する
+        ray_ids = np.repeat(np.arange(len(origins)), num_samples)
+        local = np.arange(num_samples.sum()) - np.repeat(np.cumsum(num_samples) - num_samples, num_samples)
+        ratio = local / np.maximum(num_samples[ray_ids] - 1, 1)
+        points = origins[ray_ids] + ratio[:, np.newaxis] * (ends - origins)[ray_ids]
+
+        # グリッドの外の点は三角形がないので除く
+        cells = np.floor((points - self.origin) / self.cell_size).astype(np.int64)
+        inside = np.all((cells >= 0) & (cells < self.shape), axis=-1)
+        ray_ids = ray_ids[inside]
+        cell_ids = self.flatten(cells[inside])
+
+        # (線分, セル) の重複を除いてから、セルの三角形に展開する
+        pairs = np.unique(ray_ids * len(self.offsets) + cell_ids)
+        ray_ids, cell_ids = pairs // len(self.offsets), pairs % len(self.offsets)
+        counts = self.offsets[cell_ids + 1] - self.offsets[cell_ids]
+        ray_ids = np.repeat(ray_ids, counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        triangle_ids = self.cell_triangles[np.repeat(self.offsets[cell_ids], counts) + local]
+
+        pairs = np.unique(ray_ids * len(self.triangles) + triangle_ids)
+        return pairs // len(self.triangles), pairs % len(self.triangles)
+
+# ====================================================================
+# 交差判定
+# ====================================================================
+def ray_triangle_distance(origins, directions, v0, v1, v2, epsilon=EPSILON):
+    """Möller–Trumbore 法で、レイ (単位方向) と三角形の交点までの距離を求める (交差しなければ inf)"""
+    edge1 = v1 - v0
+    edge2 = v2 - v0
+    p = np.cross(directions, edge2)
+    det = np.sum(edge1 * p, axis=-1)
+    parallel = np.abs(det) < epsilon
+    inv_det = 1.0 / np.where(parallel, 1.0, det)
+
+    s = origins - v0
+    u = np.sum(s * p, axis=-1) * inv_det
+    q = np.cross(s, edge1)
+    v = np.sum(directions * q, axis=-1) * inv_det
+    t = np.sum(edge2 * q, axis=-1) * inv_det
+
+    hit = ~parallel & (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0) & (t > epsilon)
+    return np.where(hit, t, np.inf)
+
+def segment_occlusion(vertices, triangles, origins, points, mask=None, end_offset=END_OFFSET, grid=None):
+    """カメラ位置 (C, 3) から全点 (N, 3) への線分をまとめて判定し、可視性 (C, N) を返す
+
+    check_visibility と同じく、点の手前 end_offset までに三角形があれば0、なければ1 (mask が False の組は0)
+    """
+    origins = np.asarray(origins, dtype=np.float64)
+    points = np.asarray(points, dtype=np.float64)
+    if mask is None:
+        mask = np.ones((len(origins), len(points)), dtype=bool)
+    if grid is None:
+        grid = UniformGrid(vertices, triangles)
+
+    camera_ids, point_ids = np.nonzero(mask)
+    ray_origins = origins[camera_ids]
+    offset = points[point_ids] - ray_origins
+    length = np.linalg.norm(offset, axis=-1)
+    directions = offset / np.maximum(length, 1e-12)[:, np.newaxis]
+    distance = length - end_offset
+    ends = ray_origins + directions * np.maximum(distance, 0.0)[:, np.newaxis]
+
+    occluded = np.zeros(len(camera_ids), dtype=bool)
+    if len(grid.triangles):
+        ray_ids, triangle_ids = grid.candidate_pairs(ray_origins, ends)
+        corners = grid.vertices[grid.triangles[triangle_ids]]
+        t = ray_triangle_distance(ray_origins[ray_ids], directions[ray_ids], corners[:, 0], corners[:, 1], corners[:, 2])
+        hit = t < distance[ray_ids]
+        occluded[ray_ids[hit]] = True
+
+    visibility = np.zeros(mask.shape, dtype=np.uint8)
+    visibility[camera_ids, point_ids] = ~occluded
+    return visibility
+
+# ====================================================================
+# check_visibility との比較
+# ====================================================================
+def compare_with_scene(filepath=OCCLUSION_SCENE_FILE):
+    """export_occlusion_scene で書き出した判定結果と一致するかを調べる"""
+    with np.load(filepath) as data:
+        scene = {key: data[key] for key in data.files}
+
+    start = time.perf_counter()
+    grid = UniformGrid(scene['vertices'], scene['triangles'])
+    build_time = time.perf_counter() - start
+    visibility = segment_occlusion(scene['vertices'], scene['triangles'], scene['camera_locations'],
+                                   scene['points'], scene['in_view'].astype(bool), grid=grid)
+    query_time = time.perf_counter() - start - build_time
+
+    expected = scene['visibility'].astype(np.uint8)
+    mismatch = np.count_nonzero(visibility != expected)
+    print(f"三角形 {len(scene['triangles'])}, レイ {np.count_nonzero(scene['in_view'])} 本: "
+          f"グリッド {build_time * 1000:.1f} ms, 判定 {query_time * 1000:.1f} ms")
+    if mismatch == 0:
+        print("✅ check_visibility の結果と一致しました")
+    else:
+        print(f"❌ check_visibility の結果と {mismatch} / {expected.size} 個が一致しません")
+    return visibility, mismatch
+
+# 実行
+if __name__ == "__main__":
+    compare_with_scene()
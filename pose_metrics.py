@@ -0,0 +1,205 @@
+import os
+import re
+import glob
+import numpy as np
+
+import numpy_fk
+
+# ====================================================================
+# ポーズの再現精度を評価する
+# 入力キーポイント (keypoints_3d) と、ポーズをつけたアーマチュアから書き出した
+# 3Dアノテーション (S) を全フレーム・全カメラまとめて比較する
+# ====================================================================
+
+# --- 設定 ---
+# (入力のnpzディレクトリ, 3Dアノテーションのファイルパターン)
+MOTIONS = [
+    ('./m1_npz', './m1_anotation/c*_output_3d_anotation.npz'),
+    ('./m2_npz', './m2_anotation/c*_output_3d_anotation.npz'),
+    ('./m3_npz', './m3_anotation/c*_output_3d_anotation.npz'),
+]
+EXTENSION = 'npz'
+
+# Root基準で比較するときの原点のキーポイント (入力・アノテーションとも左右の腰の中点に置き換える)
+ROOT_INDEX = numpy_fk.ROOT_INDEX
+# 比較する3Dアノテーションのキー ('S': ワールド座標, 'S_root': Root基準。どちらも Root基準に直して比較する)
+ANNOTATION_KEY = 'S'
+
+# MPJPE が 中央値 + OUTLIER_MAD_K * (1.4826 * MAD) を超えたフレームを外れ値とする
+OUTLIER_MAD_K = 3.0
+# --------------------
+
+# 比較するボーン (子のキーポイント : 親のキーポイント)
+BONE_CHILDREN = np.array(list(numpy_fk.PAIR_LIST.keys()))
+BONE_PARENTS = np.array(list(numpy_fk.PAIR_LIST.values()))
+
+def natural_key(path):
+    """c2 < c10 のように、ファイル名の数字を数値として並べる"""
+    return [int(text) if text.isdigit() else text for text in re.split(r'(\d+)', path)]
+
+# ====================================================================
+# データの読み込み
+# ====================================================================
+def load_annotation_3d(filepaths, num_cameras=1, key=ANNOTATION_KEY):
+    """3Dアノテーションを (C, F, 17, 3) にまとめる (key がないファイルがあれば None)
+
+    ファイルが1つで num_cameras > 1 の場合は、edit_pose_ver16.py の書き出し順
+    (フレームごとにカメラの順番で追記) として並べ替える
+    """
+    arrays = []
+    for f in filepaths:
+        with np.load(f) as data:
+            if key not in data:
+                print(f"❌ {f} に '{key}' キーが見つかりません。")
+                return None
+            arrays.append(data[key][..., :3].astype(np.float64))
+
+    if len(arrays) == 1 and num_cameras > 1:
+        frames = arrays[0].shape[0] // num_cameras
+        return arrays[0][:frames * num_cameras].reshape(frames, num_cameras, -1, 3).transpose(1, 0, 2, 3)
+    return np.stack(arrays)
+
+# ====================================================================
+# 評価指標 (全カメラ・全フレームまとめて計算)
+# ====================================================================
+def compute_pose_metrics(keypoints, annotations, root_index=ROOT_INDEX):
+    """入力 (F, 17, 3) と出力 (C, F, 17, 3) から評価指標を求める
+
+    アノテーションのキーポイント0は足の tail なので、両方とも左右の腰の中点に置き換えてから比較する
+    (Root につながるボーン 7-0, 4-0, 1-0 も腰の中点から求める)
+    """
+    keypoints = numpy_fk.replace_root(keypoints)[np.newaxis]
+    annotations = numpy_fk.replace_root(annotations)
+
+    # 1. MPJPE (Root基準の関節位置の誤差)
+    input_rel = keypoints - keypoints[:, :, root_index:root_index + 1]
+    output_rel = annotations - annotations[:, :, root_index:root_index + 1]
+    joint_error = np.linalg.norm(output_rel - input_rel, axis=-1)
+    joint_error[..., root_index] = np.nan
+    mpjpe = np.nanmean(joint_error, axis=-1)
+
+    # 2. ボーンごとの向きの誤差 [deg]
+    input_bones = keypoints[:, :, BONE_CHILDREN] - keypoints[:, :, BONE_PARENTS]
+    output_bones = annotations[:, :, BONE_CHILDREN] - annotations[:, :, BONE_PARENTS]
+    cosine = np.sum(numpy_fk.normalize(input_bones) * numpy_fk.normalize(output_bones), axis=-1)
+    angle_error = np.degrees(np.arccos(np.clip(cosine, -1.0, 1.0)))
+
+    # 3. ボーンの長さの誤差
+    length_error = np.linalg.norm(output_bones, axis=-1) - np.linalg.norm(input_bones, axis=-1)
+
+    return {
+        'mpjpe': mpjpe,
+        'joint_error': joint_error,
+        'angle_error': angle_error,
+        'length_error': length_error,
+    }
+
+def find_outlier_frames(mpjpe, k=OUTLIER_MAD_K):
+    """カメラ平均の MPJPE が中央値から大きく外れたフレームを返す"""
+    per_frame = np.nanmean(mpjpe, axis=0)
+    median = np.nanmedian(per_frame)
+    mad = 1.4826 * np.nanmedian(np.abs(per_frame - median))
+    threshold = median + k * max(mad, 1e-9)
+    return np.flatnonzero(per_frame > threshold), threshold
+
+# ====================================================================
+# レポートの書き出し
+# ====================================================================
+def write_report(output_prefix, metrics, outliers, threshold, files=None):
+    """評価指標を npz に、要約をテキストに書き出す"""
+    np.savez_compressed(
+        f"{output_prefix}_pose_metrics.npz",
+        mpjpe=metrics['mpjpe'].astype(np.float32),
+        joint_error=metrics['joint_error'].astype(np.float32),
+        angle_error=metrics['angle_error'].astype(np.float32),
+        length_error=metrics['length_error'].astype(np.float32),
+        bone_children=BONE_CHILDREN,
+        bone_parents=BONE_PARENTS,
+        outlier_frames=outliers,
+        outlier_threshold=threshold,
+    )
+
+    lines = [
+        f"フレーム数: {metrics['mpjpe'].shape[1]}, カメラ数: {metrics['mpjpe'].shape[0]}",
+        f"MPJPE: 平均 {np.nanmean(metrics['mpjpe']) * 1000:.1f} mm, 最大 {np.nanmax(metrics['mpjpe']) * 1000:.1f} mm",
+        f"ボーンの向きの誤差: 平均 {np.nanmean(metrics['angle_error']):.2f} deg",
+        f"ボーンの長さの誤差: 平均 {np.nanmean(np.abs(metrics['length_error'])) * 1000:.1f} mm",
+        "ボーンごとの向きの誤差 [deg] / 長さの誤差 [mm]:",
+    ]
+    for b, (child, parent) in enumerate(zip(BONE_CHILDREN, BONE_PARENTS)):
+        lines.append(f"  {numpy_fk.BONE_INDEX_MAP_REVERSE[child]:>15} ({parent:>2}-{child:>2}): "
+                     f"{np.nanmean(metrics['angle_error'][..., b]):7.2f} / "
+                     f"{np.nanmean(np.abs(metrics['length_error'][..., b])) * 1000:7.1f}")
+    lines.append(f"外れ値のフレーム (MPJPE > {threshold * 1000:.1f} mm): {len(outliers)}")
+    for frame in outliers:
+        name = os.path.basename(files[frame]) if files is not None else str(frame)
+        lines.append(f"  {frame:5d} {name}: {np.nanmean(metrics['mpjpe'][:, frame]) * 1000:.1f} mm")
+
+    with open(f"{output_prefix}_pose_metrics.txt", 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    print("\n".join(lines[:4]))
+    print(lines[-len(outliers) - 1])
+
+def evaluate_motion(target_dir, annotation_files, output_prefix=None, num_cameras=1,
+                    scale_factor=numpy_fk.SCALE_FACTOR, key=ANNOTATION_KEY):
+    """1つのモーションについて評価指標を計算し、レポートを書き出す
+
+    scale_factor はアノテーションを書き出したときの入力キーポイントのスケール
+    """
+    files, keypoints = numpy_fk.load_keypoints_sequence(target_dir, EXTENSION)
+    annotations = load_annotation_3d(annotation_files, num_cameras, key)
+    if annotations is None:
+        return None
+    if len(files) == 0 or annotations.shape[1] != len(files):
+        print(f"❌ フレーム数が一致しません: 入力 {len(files)}, アノテーション {annotations.shape[1]}")
+        return None
+
+    metrics = compute_pose_metrics(keypoints * scale_factor, annotations)
+    outliers, threshold = find_outlier_frames(metrics['mpjpe'])
+    if output_prefix is None:
+        output_prefix = os.path.normpath(target_dir)
+    write_report(output_prefix, metrics, outliers, threshold, files)
+    return metrics
+
+# ====================================================================
+# 確認
+# ====================================================================
+def validate_root(target_dir=MOTIONS[0][0], pattern=MOTIONS[0][1], tolerance=0.1):
+    """保存済みのアノテーションで、キーポイント0 (足の tail) が評価指標に影響しないことと、
+    腰の中点が入力の Root (キーポイント0) から tolerance [m] 以内にあることを確かめる"""
+    annotation_files = sorted(glob.glob(pattern), key=natural_key)
+    files, keypoints = numpy_fk.load_keypoints_sequence(target_dir, EXTENSION)
+    annotations = load_annotation_3d(annotation_files) if annotation_files else None
+    if annotations is None or annotations.shape[1] != len(files):
+        print(f"警告: '{target_dir}' と '{pattern}' のデータがそろっていません。確認をスキップします。")
+        return None
+
+    metrics = compute_pose_metrics(keypoints, annotations)
+    moved = annotations.copy()
+    moved[..., ROOT_INDEX, :] += 10.0
+    moved_metrics = compute_pose_metrics(keypoints, moved)
+    ok = all(np.allclose(metrics[key], moved_metrics[key], equal_nan=True) for key in metrics)
+    if not ok:
+        print("❌ アノテーションのキーポイント0を動かすと評価指標が変わります")
+
+    input_offset = np.linalg.norm(keypoints[:, ROOT_INDEX] - numpy_fk.root_position(keypoints), axis=-1)
+    if input_offset.max() > tolerance:
+        print(f"❌ 入力の腰の中点が Root から最大 {input_offset.max() * 1000:.1f} mm 離れています")
+        ok = False
+
+    stored_offset = np.linalg.norm(annotations[..., ROOT_INDEX, :] - numpy_fk.root_position(annotations), axis=-1)
+    if ok:
+        print(f"✅ {target_dir}: 入力の腰の中点と Root の距離 最大 {input_offset.max() * 1000:.1f} mm "
+              f"(アノテーションのキーポイント0は腰の中点から平均 {stored_offset.mean() * 1000:.1f} mm)")
+    return ok
+
+# 実行
+if __name__ == "__main__":
+    validate_root()
+    for target_dir, pattern in MOTIONS:
+        annotation_files = sorted(glob.glob(pattern), key=natural_key)
+        if not annotation_files:
+            print(f"警告: '{pattern}' に一致するファイルがありません。スキップします。")
+            continue
+        print(f"=== {target_dir} ({len(annotation_files)} カメラ) ===")
+        evaluate_motion(target_dir, annotation_files)
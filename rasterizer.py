@@ -0,0 +1,282 @@
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy_fk
+import numpy_lbs
+import camera_projection
+import reproject_anotation
+
+# ====================================================================
+# NumPyだけのZバッファによるラスタライズ (Blender・GPU不要)
+# numpy_lbs で変形した人物のメッシュだけをカメラごとに画像に描き、人物のマスク・深度・関節の可視性を求める
+# (背景や床などのシーンのメッシュは描かない。関節は numpy_fk で求めた17点のキーポイント)
+# カメラごとの処理はプロセスプールで並列に行う
+# ====================================================================
+
+# --- 設定 ---
+# edit_pose_ver16.py の export_skinning で書き出した人物のメッシュ (頂点, 三角形, ウェイト)
+SKINNING_FILE = numpy_lbs.SKINNING_FILE
+CALIBRATION_FILE = 'camera_calibration.npz'
+# 出力の解像度 (None ならキャリブレーションの解像度)
+RESOLUTION_X = None
+RESOLUTION_Y = None
+# 書き出すフレーム (None なら全フレーム)
+FRAMES = None
+# 関節の深度が深度マップよりこの値以上奥なら遮蔽とする [m] (edit_pose_ver16.py の DEPTH_TOLERANCE と同じ)
+DEPTH_TOLERANCE = 0.1
+# カメラの手前この距離より近い頂点を含む三角形は描かない [m]
+NEAR_CLIP = 0.01
+# 一度に処理する (三角形, ピクセル) の組の数の上限 (メモリの使用量を抑える)
+MAX_FRAGMENTS = 4000000
+# 並列に処理するプロセス数 (1 なら並列にしない)
+NUM_WORKERS = 4
+
+# フレームごとの書き出し先 (OUTPUT_DIR/rasterized_0001.npz)
+OUTPUT_DIR = './rasterized'
+# --------------------
+
+# ====================================================================
+# ラスタライズ (1カメラ分)
+# ====================================================================
+def triangle_fragments(screen, triangles, resolution_x, resolution_y):
+    """三角形ごとの画素の範囲 (AABB) を展開し、(三角形の番号, x, y) の組を返す"""
+    corners = screen[triangles]
+    x_min = np.clip(np.floor(corners[..., 0].min(axis=1) - 0.5), 0, resolution_x - 1).astype(np.int64)
+    x_max = np.clip(np.ceil(corners[..., 0].max(axis=1) - 0.5), 0, resolution_x - 1).astype(np.int64)
+    y_min = np.clip(np.floor(corners[..., 1].min(axis=1) - 0.5), 0, resolution_y - 1).astype(np.int64)
+    y_max = np.clip(np.ceil(corners[..., 1].max(axis=1) - 0.5), 0, resolution_y - 1).astype(np.int64)
+
+    width = x_max - x_min + 1
+    counts = width * (y_max - y_min + 1)
+    triangle_ids = np.repeat(np.arange(len(triangles)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    x = x_min[triangle_ids] + local % width[triangle_ids]
+    y = y_min[triangle_ids] + local // width[triangle_ids]
+    return triangle_ids, x, y
+
+def barycentric(screen, triangles, triangle_ids, x, y):
+    """画素の中心の重心座標 (F, 3) を求める"""
+    corners = screen[triangles[triangle_ids]]
+    px, py = x + 0.5, y + 0.5
+    x0, y0 = corners[:, 0, 0], corners[:, 0, 1]
+    x1, y1 = corners[:, 1, 0], corners[:, 1, 1]
+    x2, y2 = corners[:, 2, 0], corners[:, 2, 1]
+
+    area = (x1 - x0) * (y2 - y0) - (x2 - x0) * (y1 - y0)
+    # 面積が0の三角形は NaN になり、内外判定で除かれる
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w1 = ((px - x0) * (y2 - y0) - (x2 - x0) * (py - y0)) / area
+        w2 = ((x1 - x0) * (py - y0) - (px - x0) * (y1 - y0)) / area
+        return np.stack([1.0 - w1 - w2, w1, w2], axis=-1)
+
+def rasterize(vertices, triangles, projection, resolution_x, resolution_y, near=NEAR_CLIP, max_fragments=MAX_FRAGMENTS):
+    """1カメラ分のZバッファを作り、深度 (H, W) と各画素の三角形の番号 (H, W, 背景は -1) を返す
+
+    深度はカメラの前方向の距離 (OpenCV の Z)。透視補正のため 1/Z を画面上で線形に補間する
+    """
+    resolution_x, resolution_y = int(resolution_x), int(resolution_y)
+    projected = camera_projection.project_points(projection, vertices)[0, 0]
+    screen, depth = projected[:, :2], projected[:, 2]
+
+    # カメラの後ろ (近すぎる) 頂点を含む三角形と、画面の外の三角形を除く
+    corners = screen[triangles]
+    keep = (np.all(depth[triangles] > near, axis=1)
+            & (corners[..., 0].max(axis=1) >= 0) & (corners[..., 0].min(axis=1) <= resolution_x)
+            & (corners[..., 1].max(axis=1) >= 0) & (corners[..., 1].min(axis=1) <= resolution_y))
+    visible_triangles = np.flatnonzero(keep)
+
+    depth_buffer = np.full(resolution_x * resolution_y, np.inf)
+    face_buffer = np.full(resolution_x * resolution_y, -1, dtype=np.int64)
+
+    # 画素の多い三角形が続いてもメモリが足りるように、三角形を分けて処理する
+    corners = screen[triangles[visible_triangles]]
+    areas = np.prod(corners.max(axis=1) - corners.min(axis=1) + 2.0, axis=1)
+    chunk_ids = np.floor(np.cumsum(areas) / max_fragments).astype(np.int64)
+    for chunk in np.unique(chunk_ids):
+        chunk_triangles = visible_triangles[chunk_ids == chunk]
+        triangle_ids, x, y = triangle_fragments(screen, triangles[chunk_triangles], resolution_x, resolution_y)
+        weights = barycentric(screen, triangles[chunk_triangles], triangle_ids, x, y)
+        inside = np.all(weights >= 0.0, axis=1)
+        triangle_ids, x, y, weights = triangle_ids[inside], x[inside], y[inside], weights[inside]
+
+        inverse_depth = np.sum(weights / depth[triangles[chunk_triangles[triangle_ids]]], axis=1)
+        fragment_depth = 1.0 / inverse_depth
+        pixels = y * resolution_x + x
+
+        # 同じ画素では最も手前の三角形を残す
+        np.minimum.at(depth_buffer, pixels, fragment_depth)
+        front = fragment_depth <= depth_buffer[pixels]
+        face_buffer[pixels[front]] = chunk_triangles[triangle_ids[front]]
+
+    return depth_buffer.reshape(resolution_y, resolution_x), face_buffer.reshape(resolution_y, resolution_x)
+
+def joint_visibility(depth_buffer, projection, joints, resolution_x, resolution_y, tolerance=DEPTH_TOLERANCE):
+    """関節の深度を深度マップとまとめて比較し、可視性 (J,) を返す (画角外は0)"""
+    projected = camera_projection.project_points(projection, joints)[0, 0]
+    in_view = camera_projection.in_frame(projected, resolution_x, resolution_y)
+    x = np.clip(projected[:, 0].astype(np.int64), 0, int(resolution_x) - 1)
+    y = np.clip(projected[:, 1].astype(np.int64), 0, int(resolution_y) - 1)
+    return (in_view & (projected[:, 2] - depth_buffer[y, x] <= tolerance)).astype(np.uint8)
+
+def render_camera(args):
+    """1カメラ分のマスク・深度・三角形の番号・関節の可視性 (プロセスプールから呼ぶ)"""
+    vertices, triangles, projection, resolution_x, resolution_y, joints = args
+    depth_buffer, face_buffer = rasterize(vertices, triangles, projection, resolution_x, resolution_y)
+    visibility = joint_visibility(depth_buffer, projection, joints, resolution_x, resolution_y)
+    return face_buffer >= 0, depth_buffer.astype(np.float32), face_buffer.astype(np.int32), visibility
+
+# ====================================================================
+# 全カメラ
+# ====================================================================
+def frame_projections(projections, frame):
+    """動くカメラを含むキャリブレーション (F, C, 3, 4) から、フレームの (C, 3, 4) を取り出す"""
+    projections = np.asarray(projections)
+    return projections[frame] if projections.ndim == 4 else projections
+
+def stack_results(results):
+    """カメラごとの結果をまとめる (カメラごとに解像度が異なる場合は画像をリストで返す)"""
+    masks, depths, faces, visibility = zip(*results)
+    if len({mask.shape for mask in masks}) == 1:
+        return np.stack(masks), np.stack(depths), np.stack(faces), np.stack(visibility)
+    return list(masks), list(depths), list(faces), np.stack(visibility)
+
+def rasterize_cameras(vertices, triangles, projections, resolutions, joints, frame=0, num_workers=NUM_WORKERS):
+    """全カメラをラスタライズし、マスク (C, H, W), 深度 (C, H, W), 三角形の番号 (C, H, W), 関節の可視性 (C, J) を返す
+
+    projections が (F, C, 3, 4) の場合は frame 番目のフレームの射影行列を使う。
+    カメラごとに解像度が異なる場合はリストで返す (1フレームだけの場合に使う。シーケンスは rasterize_sequence)
+    """
+    projections = frame_projections(projections, frame)
+    tasks = [(vertices, triangles, projections[c], resolutions[c][0], resolutions[c][1], joints)
+             for c in range(len(projections))]
+    if num_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(render_camera, tasks))
+    else:
+        results = [render_camera(task) for task in tasks]
+    return stack_results(results)
+
+# ====================================================================
+# シーケンス (プロセスプールは1回だけ作る)
+# ====================================================================
+# 各プロセスに1回だけ渡す、全フレームの頂点・三角形・関節
+WORKER_SEQUENCE = {}
+
+def init_worker(vertices, triangles, joints):
+    """プロセスプールの各プロセスの初期化 (全フレームのメッシュを1回だけ受け取る)"""
+    WORKER_SEQUENCE.update(vertices=vertices, triangles=triangles, joints=joints)
+
+def render_frame_camera(args):
+    """(フレーム, カメラ) の組を1つラスタライズする (タスクには射影行列と解像度だけを渡す)"""
+    f, projection, resolution_x, resolution_y = args
+    return render_camera((WORKER_SEQUENCE['vertices'][f], WORKER_SEQUENCE['triangles'], projection,
+                          resolution_x, resolution_y, WORKER_SEQUENCE['joints'][f]))
+
+def write_frame(output_filepath, results, camera_names, resolutions):
+    """1フレーム分の全カメラの結果を書き出す"""
+    masks, depths, faces, visibility = stack_results(results)
+    if isinstance(masks, list):
+        # カメラごとに解像度が異なる場合は、カメラ名ごとのキーで書き出す
+        images = {}
+        for c, name in enumerate(camera_names):
+            images.update({f'mask_{name}': masks[c].astype(np.uint8), f'depth_{name}': depths[c],
+                           f'face_index_{name}': faces[c]})
+    else:
+        images = {'mask': masks.astype(np.uint8), 'depth': depths, 'face_index': faces}
+    np.savez_compressed(output_filepath, joint_visibility=visibility, camera_names=camera_names,
+                        resolution=resolutions, **images)
+
+def rasterize_sequence(target_dir=numpy_fk.TAGET_DIR, skinning_filepath=SKINNING_FILE,
+                       calibration_file=CALIBRATION_FILE, output_dir=OUTPUT_DIR, frames=FRAMES,
+                       num_workers=NUM_WORKERS):
+    """入力キーポイントから人物のメッシュを変形し、フレームごとに全カメラのマスク・深度・関節の可視性を書き出す
+
+    全フレームの (フレーム, カメラ) の組を1つのプロセスプールで処理する。頂点はプロセスの初期化で1回だけ渡す
+    (Windows の spawn では、プロセスの起動とメッシュの受け渡しがフレームごとに起きないようにする)
+    """
+    skinning = numpy_lbs.load_skinning(skinning_filepath)
+    rest = numpy_fk.load_armature_rest(numpy_fk.ARMATURE_REST_FILE)
+    files, keypoints = numpy_fk.load_keypoints_sequence(target_dir)
+    if len(files) == 0:
+        print("ファイルが見つかりませんでした。")
+        return
+    keypoints = keypoints * numpy_fk.SCALE_FACTOR
+    if numpy_fk.USE_RETARGET:
+        rest = numpy_fk.retarget_armature_rest(rest, numpy_fk.measure_bone_lengths(keypoints))
+    frames = np.arange(len(files)) if frames is None else np.asarray(frames)
+    quaternions = numpy_fk.solve_rotations(rest, keypoints[frames])
+    heads, tails, _ = numpy_fk.forward_kinematics(rest, quaternions)
+    joints = numpy_fk.bones_to_keypoints(rest, heads, tails)
+
+    cameras = reproject_anotation.load_cameras(calibration_file, [], None)
+    projections, resolutions = reproject_anotation.build_projection(cameras, RESOLUTION_X, RESOLUTION_Y)
+    camera_names = np.array([name for name, _, _ in cameras])
+    num_cameras = len(cameras)
+    os.makedirs(output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    vertices = numpy_lbs.deform_sequence(rest, quaternions, skinning)
+    tasks = [(f, frame_projections(projections, frame)[c], resolutions[c][0], resolutions[c][1])
+             for f, frame in enumerate(frames) for c in range(num_cameras)]
+    initargs = (vertices, skinning['triangles'], joints)
+
+    def write_results(results):
+        # 結果はタスクの順番 (フレームごとに全カメラ) で返るので、カメラの台数ずつ取り出して書き出す
+        results = iter(results)
+        for frame in frames:
+            write_frame(os.path.join(output_dir, f"rasterized_{frame + 1:04d}.npz"),
+                        [next(results) for _ in range(num_cameras)], camera_names, resolutions)
+
+    if num_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker, initargs=initargs) as executor:
+            write_results(executor.map(render_frame_camera, tasks, chunksize=max(1, num_cameras // num_workers)))
+    else:
+        init_worker(*initargs)
+        write_results(map(render_frame_camera, tasks))
+    WORKER_SEQUENCE.clear()
+
+    elapsed = time.perf_counter() - start
+    print(f"✅ {len(frames)} フレーム × {num_cameras} カメラ, 三角形 {len(skinning['triangles'])} をラスタライズしました "
+          f"({elapsed:.2f} 秒): {output_dir}")
+
+# ====================================================================
+# 確認
+# ====================================================================
+def validate_animated_calibration():
+    """動くカメラのキャリブレーション (F, C, 3, 4) で、各フレームの射影行列が使われることを確かめる"""
+    # z = 5 の平面上の正方形 (2つの三角形) と、その中心の関節
+    vertices = np.array([[-1.0, -1.0, 5.0], [1.0, -1.0, 5.0], [1.0, 1.0, 5.0], [-1.0, 1.0, 5.0]])
+    triangles = np.array([[0, 1, 2], [0, 2, 3]])
+    joints = np.array([[0.0, 0.0, 5.0]])
+    resolutions = np.array([[64.0, 64.0], [64.0, 64.0]])
+
+    # 2フレーム × 2カメラ。カメラ1はフレーム1で横に 20 m 動き、正方形が画角の外になる
+    K = np.array([[32.0, 0.0, 32.0], [0.0, 32.0, 32.0], [0.0, 0.0, 1.0]])
+    extrinsics = np.zeros((2, 2, 3, 4))
+    extrinsics[..., :3, :3] = np.eye(3)
+    extrinsics[1, 1, 0, 3] = -20.0
+    projections = K @ extrinsics
+
+    ok = True
+    for frame in range(len(projections)):
+        masks, _, _, visibility = rasterize_cameras(vertices, triangles, projections, resolutions, joints,
+                                                    frame, num_workers=1)
+        for c in range(projections.shape[1]):
+            depth_buffer, face_buffer = rasterize(vertices, triangles, projections[frame, c], 64, 64)
+            expected = joint_visibility(depth_buffer, projections[frame, c], joints, 64, 64)
+            if not np.array_equal(masks[c], face_buffer >= 0) or not np.array_equal(visibility[c], expected):
+                print(f"❌ フレーム {frame}, カメラ {c}: 射影行列が一致しません")
+                ok = False
+    if ok and masks[1].any():
+        print("❌ フレーム 1 で動いたカメラ 1 に、正方形が描かれています")
+        ok = False
+    if ok:
+        print(f"✅ {projections.shape[0]} フレーム × {projections.shape[1]} カメラで、フレームごとの射影行列が使われました")
+    return ok
+
+# 実行
+if __name__ == "__main__":
+    validate_animated_calibration()
+    rasterize_sequence()
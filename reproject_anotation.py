@@ -0,0 +1,132 @@
+import os
+import time
+import numpy as np
+
+import camera_projection
+
+# ====================================================================
+# 3Dアノテーションとキャリブレーションから2Dアノテーションを作り直す (Blender不要)
+# 解像度の変更やカメラの追加のたびに、Blenderでの処理をやり直さなくてよい
+# ====================================================================
+
+# --- 設定 ---
+# ワールド座標の3Dアノテーション ('S' キー, (F, 17, 3) または (F, 17, 4))
+INPUT_3d_FILES = [
+    './m1_anotation/c1_output_3d_anotation.npz',
+    './m2_anotation/c1_output_3d_anotation.npz',
+    './m3_anotation/c1_output_3d_anotation.npz',
+]
+# 3Dアノテーションを書き出したときのカメラ台数 (edit_pose_ver16.py はフレームごとにカメラの台数分追記する)
+INPUT_NUM_CAMERAS = 1
+
+# edit_pose_ver16.py で書き出したキャリブレーション
+CALIBRATION_FILE = 'camera_calibration.npz'
+# 追加するカメラのキャリブレーション (別のシーンや virtual_camera.py で作ったもの)
+EXTRA_CALIBRATION_FILES = []
+# 使うカメラ (None なら全カメラ)
+CAMERA_NAMES = None
+
+# 出力の解像度 (None ならキャリブレーションの解像度)
+RESOLUTION_X = None
+RESOLUTION_Y = None
+
+# 書き出し先ファイル名の末尾 (入力ファイル名の '_3d_anotation' を置き換える)
+OUTPUT_SUFFIX = '_reprojected_2d_anotation.npz'
+# --------------------
+
+# ====================================================================
+# 読み込み
+# ====================================================================
+def load_world_keypoints(filepath, num_cameras=INPUT_NUM_CAMERAS):
+    """3Dアノテーションから (F, 17, 3) のワールド座標を取り出す"""
+    with np.load(filepath) as data:
+        keypoints = data['S'][..., :3].astype(np.float64)
+    # ワールド座標はカメラによらず同じなので、各フレームの最初のカメラの行だけを使う
+    return keypoints[::num_cameras]
+
+def load_cameras(calibration_file=CALIBRATION_FILE, extra_files=EXTRA_CALIBRATION_FILES, camera_names=CAMERA_NAMES):
+    """キャリブレーションを読み込み、(カメラ名, カメラ設定, matrix_world) のリストにまとめる"""
+    cameras = []
+    for filepath in [calibration_file] + list(extra_files):
+        calibration = camera_projection.load_calibration(filepath)
+        # 動くカメラの場合は (F, C, ...) で保存されている
+        animated = calibration['R_blender'].ndim == 4
+        for c, name in enumerate(calibration['camera_names']):
+            rotation = calibration['R_blender'][:, c] if animated else calibration['R_blender'][c]
+            location = calibration['t_blender'][:, c] if animated else calibration['t_blender'][c]
+            matrix_world = np.zeros(rotation.shape[:-2] + (4, 4))
+            matrix_world[..., :3, :3] = rotation
+            matrix_world[..., :3, 3] = location
+            matrix_world[..., 3, 3] = 1.0
+            cameras.append((name, calibration['params'][c], matrix_world))
+
+    if camera_names is not None:
+        lookup = {name: camera for name, *camera in cameras}
+        cameras = [(name, *lookup[name]) for name in camera_names if name in lookup]
+    return cameras
+
+def build_projection(cameras, resolution_x=None, resolution_y=None):
+    """全カメラの射影行列 (C, 3, 4) (動くカメラを含む場合は (F, C, 3, 4)) と、出力の解像度を求める"""
+    matrices = []
+    resolutions = []
+    for name, params, matrix_world in cameras:
+        res_x = params['resolution_x'] if resolution_x is None else resolution_x
+        res_y = params['resolution_y'] if resolution_y is None else resolution_y
+        K = camera_projection.intrinsics_from_params(params, res_x, res_y)
+        matrices.append(camera_projection.projection_matrix(K, camera_projection.world_to_camera_matrix(matrix_world)))
+        resolutions.append((res_x, res_y))
+
+    # 静止したカメラの (3, 4) は、動くカメラのフレーム数に合わせて並べる
+    num_frames = max((matrix.shape[0] for matrix in matrices if matrix.ndim == 3), default=None)
+    if num_frames is None:
+        return np.stack(matrices), np.array(resolutions, dtype=np.float64)
+    matrices = [np.broadcast_to(matrix, (num_frames, 3, 4)) for matrix in matrices]
+    return np.stack(matrices, axis=1), np.array(resolutions, dtype=np.float64)
+
+# ====================================================================
+# 再投影
+# ====================================================================
+def reproject_keypoints(keypoints_3d, projection, resolutions):
+    """(F, 17, 3) を全カメラに投影し、(F, C, 17, 3) の (u, v, 画角内なら1) を返す"""
+    projected = camera_projection.project_points(projection, keypoints_3d)
+    # カメラごとに解像度が異なる場合もあるので、(C, 1) にして比較する
+    in_view = camera_projection.in_frame(projected, resolutions[:, 0:1], resolutions[:, 1:2])
+
+    # 画角外は0、画角内は1 (遮蔽は判定しない)
+    keypoints_2d = projected.copy()
+    keypoints_2d[..., 2] = in_view
+    return keypoints_2d
+
+def output_filepath_for(filepath):
+    stem = os.path.splitext(filepath)[0]
+    if stem.endswith('_3d_anotation'):
+        stem = stem[:-len('_3d_anotation')]
+    return stem + OUTPUT_SUFFIX
+
+def reproject_files(input_files=INPUT_3d_FILES, cameras=None, resolution_x=RESOLUTION_X, resolution_y=RESOLUTION_Y):
+    """全モーションの2Dアノテーションを作り直して書き出す"""
+    if cameras is None:
+        cameras = load_cameras()
+    projection, resolutions = build_projection(cameras, resolution_x, resolution_y)
+    camera_names = np.array([name for name, _, _ in cameras])
+
+    start = time.perf_counter()
+    for filepath in input_files:
+        if not os.path.exists(filepath):
+            print(f"警告: '{filepath}' が見つかりません。スキップします。")
+            continue
+
+        keypoints_3d = load_world_keypoints(filepath)
+        if projection.ndim == 4 and projection.shape[0] != keypoints_3d.shape[0]:
+            print(f"警告: '{filepath}' のフレーム数 {keypoints_3d.shape[0]} がカメラの軌跡 {projection.shape[0]} と一致しません。スキップします。")
+            continue
+        keypoints_2d = reproject_keypoints(keypoints_3d, projection, resolutions)
+        output_filepath = output_filepath_for(filepath)
+        np.savez_compressed(output_filepath, keypoints_2d=keypoints_2d, camera_names=camera_names, resolution=resolutions)
+        print(f"✅ {output_filepath}: 形状 (フレーム数, カメラ数, キーポイント数, 3) = {keypoints_2d.shape}")
+
+    print(f"すべての処理が完了しました ({time.perf_counter() - start:.2f} 秒)")
+
+# 実行
+if __name__ == "__main__":
+    reproject_files()
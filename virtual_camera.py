@@ -0,0 +1,277 @@
+import os
+import time
+import numpy as np
+
+import numpy_fk
+import camera_projection
+import reproject_anotation
+
+# ====================================================================
+# 仮想カメラで2Dアノテーションを増やす (Blender不要)
+# 被写体のまわりにカメラを数百台並べ、保存済みの3Dアノテーション (ワールド座標) を
+# まとめて投影して、2D座標と可視性 (画角内 + カプセルによる自己遮蔽) を求める
+# レンダリングが必要な場合は、edit_pose_ver16.py の create_cameras_from_calibration で一部のカメラだけシーンに追加する
+# ====================================================================
+
+# --- 設定 ---
+# ワールド座標の3Dアノテーション ('S' キー)
+INPUT_3d_FILES = reproject_anotation.INPUT_3d_FILES
+INPUT_NUM_CAMERAS = reproject_anotation.INPUT_NUM_CAMERAS
+
+# カメラの並べ方 ('sphere': 球面上に均等, 'ring': 同じ高さの円周上, 'random': 距離・方位・仰角をランダムに)
+SAMPLING = 'sphere'
+NUM_VIRTUAL_CAMERAS = 200
+# 注視点からの距離 [m] ('random' の場合は RADIUS_RANGE の範囲)
+RADIUS = 4.0
+RADIUS_RANGE = (3.0, 6.0)
+# 仰角の範囲 [deg] ('sphere' と 'random')
+ELEVATION_RANGE = (-10.0, 60.0)
+# 'ring' のカメラの高さ [m]
+RING_HEIGHT = 1.2
+# 注視点 (None なら全フレームの Root (左右の腰の中点) の平均)
+LOOK_AT = None
+SEED = 0
+
+# 仮想カメラの設定
+CAMERA_PREFIX = 'Virtual'
+LENS = 50.0
+SENSOR_WIDTH = 36.0
+SENSOR_HEIGHT = 24.0
+SENSOR_FIT = 'AUTO'
+RESOLUTION_X = 1000
+RESOLUTION_Y = 1000
+
+# 自己遮蔽の判定に使うボーンのカプセルの半径 [m]
+CAPSULE_RADIUS = 0.06
+# check_visibility と同じく、関節の手前 0.1 m までを遮蔽の判定に使う
+VISIBILITY_END_OFFSET = 0.1
+# 一度に判定するフレーム数 (メモリの使用量を抑える)
+FRAME_CHUNK = 16
+
+OUTPUT_CALIBRATION = 'virtual_camera_calibration.npz'
+OUTPUT_SUFFIX = '_virtual_2d_anotation.npz'
+# --------------------
+
+# ボーン (PAIR_LIST の 親 → 子) の両端のキーポイント
+BONE_CHILDREN = np.array(list(numpy_fk.PAIR_LIST.keys()))
+BONE_PARENTS = np.array(list(numpy_fk.PAIR_LIST.values()))
+
+# アノテーションのキーポイント0は右足 (feet.001.r) の tail なので、右足首につながるボーンを除く
+# (カプセルのキーポイント0は左右の腰の中点に置き換える)
+RIGHT_ANKLE_INDEX = 3
+
+# 関節ごとに、その関節につながるボーン (遮蔽の判定から除く)
+ADJACENT_BONES = np.zeros((numpy_fk.NUM_KEYPOINTS, len(BONE_CHILDREN)), dtype=bool)
+for b, (child, parent) in enumerate(zip(BONE_CHILDREN, BONE_PARENTS)):
+    ADJACENT_BONES[child, b] = True
+    ADJACENT_BONES[parent, b] = True
+ADJACENT_BONES[numpy_fk.ROOT_INDEX] = ADJACENT_BONES[RIGHT_ANKLE_INDEX]
+
+# ====================================================================
+# カメラの配置
+# ====================================================================
+def look_at_matrix_world(locations, target, up=(0.0, 0.0, 1.0)):
+    """カメラの位置 (C, 3) から注視点を向く matrix_world (C, 4, 4) を作る (カメラは -Z 方向を向き Y が上)"""
+    locations = np.asarray(locations, dtype=np.float64)
+    forward = numpy_fk.normalize(np.asarray(target, dtype=np.float64) - locations)
+
+    # 真上・真下を向く場合は、上方向を Y 軸に変える
+    up = np.broadcast_to(np.asarray(up, dtype=np.float64), forward.shape).copy()
+    parallel = np.abs(np.sum(forward * up, axis=-1)) > 0.999
+    up[parallel] = (0.0, 1.0, 0.0)
+
+    right = numpy_fk.normalize(np.cross(forward, up))
+    camera_up = np.cross(right, forward)
+
+    matrix_world = np.zeros(locations.shape[:-1] + (4, 4))
+    matrix_world[..., :3, 0] = right
+    matrix_world[..., :3, 1] = camera_up
+    matrix_world[..., :3, 2] = -forward
+    matrix_world[..., :3, 3] = locations
+    matrix_world[..., 3, 3] = 1.0
+    return matrix_world
+
+def spherical_to_locations(target, radius, azimuth, elevation):
+    """注視点からの距離・方位角・仰角 [rad] からカメラの位置を求める"""
+    direction = np.stack([
+        np.cos(elevation) * np.cos(azimuth),
+        np.cos(elevation) * np.sin(azimuth),
+        np.sin(elevation),
+    ], axis=-1)
+    return np.asarray(target) + np.asarray(radius)[..., np.newaxis] * direction
+
+def sample_camera_locations(target, num_cameras=NUM_VIRTUAL_CAMERAS, sampling=SAMPLING, seed=SEED):
+    """SAMPLING の方法でカメラの位置 (C, 3) を求める"""
+    target = np.asarray(target, dtype=np.float64)
+    low, high = np.radians(ELEVATION_RANGE)
+
+    if sampling == 'sphere':
+        # 仰角の範囲内の球面 (帯) 上に、フィボナッチ格子で均等に並べる
+        z = np.linspace(np.sin(low), np.sin(high), num_cameras)
+        azimuth = np.arange(num_cameras) * np.pi * (3.0 - np.sqrt(5.0))
+        return spherical_to_locations(target, np.full(num_cameras, RADIUS), azimuth, np.arcsin(z))
+
+    if sampling == 'ring':
+        azimuth = np.linspace(0.0, 2.0 * np.pi, num_cameras, endpoint=False)
+        locations = spherical_to_locations(target, np.full(num_cameras, RADIUS), azimuth, np.zeros(num_cameras))
+        locations[:, 2] = RING_HEIGHT
+        return locations
+
+    if sampling == 'random':
+        rng = np.random.default_rng(seed)
+        radius = rng.uniform(*RADIUS_RANGE, num_cameras)
+        azimuth = rng.uniform(0.0, 2.0 * np.pi, num_cameras)
+        # 球面上で一様になるように、仰角は sin で一様に選ぶ
+        elevation = np.arcsin(rng.uniform(np.sin(low), np.sin(high), num_cameras))
+        return spherical_to_locations(target, radius, azimuth, elevation)
+
+    raise ValueError(f"未対応の SAMPLING です: {sampling}")
+
+def virtual_camera_params():
+    """仮想カメラの設定 (edit_pose_ver16.py の get_camera_params と同じ形式)"""
+    return {
+        'lens': LENS,
+        'sensor_width': SENSOR_WIDTH,
+        'sensor_height': SENSOR_HEIGHT,
+        'sensor_fit': SENSOR_FIT,
+        'shift_x': 0.0,
+        'shift_y': 0.0,
+        'resolution_x': RESOLUTION_X,
+        'resolution_y': RESOLUTION_Y,
+        'pixel_aspect_x': 1.0,
+        'pixel_aspect_y': 1.0,
+    }
+
+def build_virtual_cameras(target, num_cameras=NUM_VIRTUAL_CAMERAS, sampling=SAMPLING, seed=SEED):
+    """仮想カメラを (カメラ名, カメラ設定, matrix_world) のリストで返す (reproject_anotation.load_cameras と同じ形式)"""
+    matrix_worlds = look_at_matrix_world(sample_camera_locations(target, num_cameras, sampling, seed), target)
+    return [(f"{CAMERA_PREFIX}{c + 1:04d}", virtual_camera_params(), matrix_world)
+            for c, matrix_world in enumerate(matrix_worlds)]
+
+def save_virtual_calibration(cameras, output_filepath=OUTPUT_CALIBRATION):
+    """仮想カメラを camera_calibration.npz と同じ形式で書き出す"""
+    return camera_projection.save_calibration(
+        output_filepath,
+        [name for name, _, _ in cameras],
+        [params for _, params, _ in cameras],
+        [matrix_world for _, _, matrix_world in cameras],
+    )
+
+# ====================================================================
+# 自己遮蔽 (ボーンをカプセルで近似する)
+# ====================================================================
+def segment_distance(p0, p1, q0, q1):
+    """線分 p0-p1 と q0-q1 の最短距離 (ブロードキャスト可能な (..., 3))"""
+    d1 = p1 - p0
+    d2 = q1 - q0
+    r = p0 - q0
+    a = np.sum(d1 * d1, axis=-1)
+    e = np.sum(d2 * d2, axis=-1)
+    b = np.sum(d1 * d2, axis=-1)
+    c = np.sum(d1 * r, axis=-1)
+    f = np.sum(d2 * r, axis=-1)
+
+    a = np.maximum(a, 1e-12)
+    e_safe = np.maximum(e, 1e-12)
+    denom = a * e - b * b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.where(denom > 1e-12, np.clip((b * f - c * e) / denom, 0.0, 1.0), 0.0)
+    t = (b * s + f) / e_safe
+
+    # t が範囲外の場合は端点に固定して s を求め直す
+    s = np.where(t < 0.0, np.clip(-c / a, 0.0, 1.0), np.where(t > 1.0, np.clip((b - c) / a, 0.0, 1.0), s))
+    t = np.clip(t, 0.0, 1.0)
+
+    closest_p = p0 + s[..., np.newaxis] * d1
+    closest_q = q0 + t[..., np.newaxis] * d2
+    return np.linalg.norm(closest_p - closest_q, axis=-1)
+
+def capsule_occlusion(camera_locations, keypoints, radius=CAPSULE_RADIUS, end_offset=VISIBILITY_END_OFFSET,
+                      frame_chunk=FRAME_CHUNK):
+    """カメラ → 関節のレイがほかのボーンのカプセルに当たるかどうか (F, C, J) を返す
+
+    カプセルは Root を左右の腰の中点に置き換えたキーポイントで作る (レイは保存されている関節の位置まで)
+    """
+    camera_locations = np.asarray(camera_locations, dtype=np.float64)
+    keypoints = np.asarray(keypoints, dtype=np.float64)
+    capsule_keypoints = numpy_fk.replace_root(keypoints)
+    num_frames = keypoints.shape[0]
+    occluded = np.zeros((num_frames, len(camera_locations), keypoints.shape[1]), dtype=bool)
+
+    for start in range(0, num_frames, frame_chunk):
+        joints = keypoints[start:start + frame_chunk]
+        # レイは関節の手前 end_offset まで (F, C, J, 3)
+        ray_start = np.broadcast_to(camera_locations[np.newaxis, :, np.newaxis, :],
+                                    (joints.shape[0], len(camera_locations), joints.shape[1], 3))
+        offset = joints[:, np.newaxis] - ray_start
+        length = np.linalg.norm(offset, axis=-1, keepdims=True)
+        ray_end = ray_start + offset * np.maximum(length - end_offset, 0.0) / np.maximum(length, 1e-12)
+
+        # ボーン (F, B, 3) と全レイの距離 (F, C, J, B)
+        capsule_joints = capsule_keypoints[start:start + frame_chunk]
+        bone_start = capsule_joints[:, BONE_PARENTS][:, np.newaxis, np.newaxis]
+        bone_end = capsule_joints[:, BONE_CHILDREN][:, np.newaxis, np.newaxis]
+        distance = segment_distance(ray_start[..., np.newaxis, :], ray_end[..., np.newaxis, :], bone_start, bone_end)
+
+        hit = (distance < radius) & ~ADJACENT_BONES[:joints.shape[1]]
+        occluded[start:start + frame_chunk] = np.any(hit, axis=-1)
+    return occluded
+
+# ====================================================================
+# 2Dアノテーションと可視性
+# ====================================================================
+def annotate_virtual_cameras(keypoints_3d, cameras):
+    """(F, 17, 3) を全仮想カメラに投影し、(F, C, 17, 3) の (u, v, 可視性) と遮蔽の有無を返す"""
+    projection, resolutions = reproject_anotation.build_projection(cameras)
+    keypoints_2d = reproject_anotation.reproject_keypoints(keypoints_3d, projection, resolutions)
+
+    camera_locations = np.stack([matrix_world[:3, 3] for _, _, matrix_world in cameras])
+    occluded = capsule_occlusion(camera_locations, keypoints_3d)
+
+    # edit_pose_ver16.py と同じく、画角外または遮蔽されていれば0
+    in_view = keypoints_2d[..., 2].astype(bool)
+    keypoints_2d[..., 2] = in_view & ~occluded
+    return keypoints_2d, occluded
+
+def output_filepath_for(filepath):
+    stem = os.path.splitext(filepath)[0]
+    if stem.endswith('_3d_anotation'):
+        stem = stem[:-len('_3d_anotation')]
+    return stem + OUTPUT_SUFFIX
+
+def find_look_at(input_files=INPUT_3d_FILES):
+    """全モーション・全フレームの Root (左右の腰の中点) の平均を注視点にする"""
+    roots = [numpy_fk.root_position(reproject_anotation.load_world_keypoints(f, INPUT_NUM_CAMERAS))
+             for f in input_files if os.path.exists(f)]
+    return np.concatenate(roots).mean(axis=0)
+
+def generate_virtual_anotation(input_files=INPUT_3d_FILES, cameras=None):
+    """仮想カメラのキャリブレーションと、全モーションの2Dアノテーションを書き出す"""
+    if cameras is None:
+        target = np.asarray(LOOK_AT, dtype=np.float64) if LOOK_AT is not None else find_look_at(input_files)
+        cameras = build_virtual_cameras(target)
+    save_virtual_calibration(cameras)
+    print(f"✅ {len(cameras)} 台の仮想カメラ ({SAMPLING}) のキャリブレーションを書き出しました: {OUTPUT_CALIBRATION}")
+
+    camera_names = np.array([name for name, _, _ in cameras])
+    resolutions = np.array([[params['resolution_x'], params['resolution_y']] for _, params, _ in cameras])
+
+    start = time.perf_counter()
+    for filepath in input_files:
+        if not os.path.exists(filepath):
+            print(f"警告: '{filepath}' が見つかりません。スキップします。")
+            continue
+
+        keypoints_3d = reproject_anotation.load_world_keypoints(filepath, INPUT_NUM_CAMERAS)
+        keypoints_2d, occluded = annotate_virtual_cameras(keypoints_3d, cameras)
+        output_filepath = output_filepath_for(filepath)
+        np.savez_compressed(output_filepath, keypoints_2d=keypoints_2d, occluded=occluded,
+                            camera_names=camera_names, resolution=resolutions)
+        print(f"✅ {output_filepath}: 形状 (フレーム数, カメラ数, キーポイント数, 3) = {keypoints_2d.shape}, "
+              f"可視 {np.mean(keypoints_2d[..., 2]) * 100:.1f} %")
+
+    print(f"すべての処理が完了しました ({time.perf_counter() - start:.2f} 秒)")
+
+# 実行
+if __name__ == "__main__":
+    generate_virtual_anotation()